@@ -0,0 +1,182 @@
+'''
+Helpers for benchmarks that run against a real server on loopback.
+The server is started in a temporary working directory holding a copy of credentials.txt, so benchmarks never
+touch the message log or user log in server/.
+'''
+
+import sys
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+serverDir = os.path.join(parentDir, 'server')
+sys.path.append(parentDir)
+
+from protocol.protocol import Protocol
+
+'''
+Find a free TCP port on loopback
+'''
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+'''
+Username and password of the nth extra benchmark account
+'''
+def benchAccount(index):
+    return f'bench{index}', f'pass{index}'
+
+class BenchServer:
+    '''
+    serverArgs are extra arguments after the port and allowed login attempts, e.g. ['async']. seedFiles maps file
+    names to paths of files copied into the working directory under those names before the server starts, e.g. a
+    messagejournal.txt to start from or a credentials.txt to use instead of the one in server/. extraAccounts adds that many accounts, see benchAccount, to credentials.txt
+    '''
+    def __init__(self, serverArgs=(), port=None, workDir=None, extraAccounts=0, seedFiles=None):
+        self.port = port or freePort()
+        self.serverArgs = list(serverArgs)
+        self.workDir = workDir or tempfile.mkdtemp(prefix='toom-bench-')
+        self._ownsWorkDir = workDir is None
+        self.extraAccounts = extraAccounts
+        self.seedFiles = dict(seedFiles or {})
+        self.process = None
+
+    def start(self, timeout=10.0):
+        shutil.copy(os.path.join(serverDir, 'credentials.txt'), self.workDir)
+
+        for name, path in self.seedFiles.items():
+            shutil.copy(path, os.path.join(self.workDir, name))
+
+        if self.extraAccounts:
+            with open(os.path.join(self.workDir, 'credentials.txt'), 'a') as credentials:
+                for index in range(self.extraAccounts):
+                    credentials.write('%s %s\n' % benchAccount(index))
+
+        self._output = open(os.path.join(self.workDir, 'server-output.txt'), 'a')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(serverDir, 'server.py'), str(self.port), '5', *self.serverArgs],
+            cwd=self.workDir,
+            stdout=self._output,
+            stderr=subprocess.STDOUT,
+        )
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited during startup, see {self._output.name}')
+            try:
+                # The server logs the probe connection as a disconnect, which is harmless
+                socket.create_connection(('localhost', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+
+        raise RuntimeError('Server did not start listening in time')
+
+    '''
+    Stop the server the way Ctrl+C would, so it flushes its state
+    '''
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(2)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        self._output.close()
+
+        if self._ownsWorkDir:
+            shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+'''
+Connect and log in to the server, offering protocolVersion for requests. Returns a Protocol for the connection
+'''
+def connect(port, username='user', password='pass', udpPort=0, protocolVersion=1):
+    clientSocket = socket.create_connection(('localhost', port))
+    clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    connection = Protocol(clientSocket, 'localhost', port)
+    connection.sendMessage(username, {'Protocol': protocolVersion} if protocolVersion > 1 else None)
+    connection.sendMessage(password)
+
+    headers, loginResult = connection.recvFrame()
+    if loginResult != 'Welcome to TOOM!':
+        raise RuntimeError(f'Login failed for {username}: {loginResult}')
+
+    connection.protocolVersion = int(headers.get('Protocol', 1))
+    connection.sendMessage(str(udpPort))
+
+    return connection
+
+'''
+Process ids of pid and all of its descendants, e.g. the worker processes of a server in workers mode. Linux only
+'''
+def processTree(pid):
+    children = {}
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                # The process name is in parentheses and may contain spaces, so fields are counted from after it
+                parentPid = int(stat.read().rpartition(')')[2].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+
+        children.setdefault(parentPid, []).append(int(entry))
+
+    tree = [pid]
+    for treePid in tree:
+        tree.extend(children.get(treePid, ()))
+
+    return tree
+
+'''
+Total CPU seconds, user and system, used so far by the processes. Processes that have exited are skipped
+'''
+def cpuSeconds(pids):
+    total = 0
+
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as stat:
+                fields = stat.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+
+        # utime and stime are the 14th and 15th fields of /proc/<pid>/stat
+        total += int(fields[11]) + int(fields[12])
+
+    return total / os.sysconf('SC_CLK_TCK')
+
+'''
+Total resident set size of the processes in bytes
+'''
+def rssBytes(pids):
+    total = 0
+
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as statm:
+                total += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            continue
+
+    return total
@@ -0,0 +1,89 @@
+'''
+Benchmark for response compression.
+Builds RDM responses for message histories of increasing size, and reports the bytes on the wire for a raw frame
+and for zlib frames at several compression levels, along with the CPU time to encode and decode each frame body.
+Responses smaller than the compression threshold are sent raw, so their zlib rows match the raw row.
+'''
+
+import sys
+import os
+import time
+import random
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(parentDir)
+
+from protocol import protocol
+from protocol.protocol import encodeFrame, encodeBody, decodeBody
+
+usernames = ['Yoda', 'Hans', 'Obi-wan', 'Luke', 'Leia', 'Rey']
+words = 'the quick brown fox jumps over a lazy dog while meeting agenda notes are shared with everyone today'.split()
+
+'''
+Build an RDM response with count messages, formatted like the server formats them
+'''
+def buildRdmResponse(count, seed=0):
+    generator = random.Random(seed)
+    lines = []
+
+    for messageNumber in range(1, count + 1):
+        username = generator.choice(usernames)
+        message = ' '.join(generator.choices(words, k=generator.randint(3, 15)))
+        timestamp = f'01 Jan 2024 {messageNumber // 3600 % 24:02d}:{messageNumber // 60 % 60:02d}:{messageNumber % 60:02d}'
+        lines.append(f'#{messageNumber} {username}: "{message}", posted at {timestamp}\n')
+
+    return ''.join(lines)
+
+'''
+Time fn, repeating it until at least minTime seconds have passed. Returns the mean time per call in seconds
+'''
+def timeCall(fn, minTime=0.05):
+    calls = 0
+    start = time.perf_counter()
+
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            return elapsed / calls
+
+'''
+Returns the frame size in bytes and the mean time to encode and decode the body in seconds.
+level is the zlib compression level, or None for a raw frame
+'''
+def benchmark(message, level):
+    contentEncoding = None if level is None else 'zlib'
+    protocol.compressionLevel = level
+
+    frame = encodeFrame(message, contentEncoding=contentEncoding)
+    body, headers = encodeBody(message, contentEncoding=contentEncoding)
+
+    encodeTime = timeCall(lambda: encodeBody(message, contentEncoding=contentEncoding))
+    decodeTime = timeCall(lambda: decodeBody(body, headers or {}))
+
+    return len(frame), encodeTime, decodeTime
+
+
+if __name__ == '__main__':
+    historySizes = [int(size) for size in sys.argv[1:]] or [1, 10, 100, 1000, 10000, 100000]
+    levels = [None, 1, 6, 9]
+    defaultLevel = protocol.compressionLevel
+
+    print(f'compression threshold {protocol.compressionThreshold} bytes, default zlib level {defaultLevel}')
+    print(f'{"messages":>10}{"encoding":>12}{"wire bytes":>14}{"ratio":>8}{"encode ms":>12}{"decode ms":>12}')
+
+    for count in historySizes:
+        message = buildRdmResponse(count)
+        rawSize = len(encodeFrame(message))
+
+        for level in levels:
+            size, encodeTime, decodeTime = benchmark(message, level)
+            label = 'raw' if level is None else f'zlib-{level}'
+            print(
+                f'{count:>10}{label:>12}{size:>14,}{rawSize / size:>8.2f}'
+                f'{encodeTime * 1000:>12.3f}{decodeTime * 1000:>12.3f}'
+            )
+
+    protocol.compressionLevel = defaultLevel
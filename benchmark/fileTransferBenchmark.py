@@ -0,0 +1,156 @@
+'''
+Benchmark for the UDP file transfer used by UPD.
+Sends a file between two transfer endpoints over loopback and reports MB/s. Each scenario wraps both sockets so that
+a share of the datagrams are dropped and a share are held back and sent after the next one, to emulate a lossy,
+reordering network. The last row sends the file over the TCP peer channel instead. Every transfer is checked
+against the receiver's copy of the file.
+'''
+
+import sys
+import os
+import time
+import random
+import socket
+import filecmp
+import tempfile
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(os.path.join(parentDir, 'client'))
+
+import fileTransfer
+
+'''
+UDP socket wrapper that drops and reorders outgoing datagrams
+'''
+class LossySocket:
+    def __init__(self, udpSocket, lossRate, reorderRate, seed):
+        self._socket = udpSocket
+        self._lossRate = lossRate
+        self._reorderRate = reorderRate
+        self._random = random.Random(seed)
+        self._held = None
+        self._lock = threading.Lock()
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        return self.sendto(b''.join(buffers), addr)
+
+    def sendto(self, data, addr):
+        with self._lock:
+            if self._random.random() < self._lossRate:
+                return len(data)
+
+            if self._held is None and self._random.random() < self._reorderRate:
+                self._held = (bytes(data), addr)
+                return len(data)
+
+            sent = self._socket.sendto(data, addr)
+
+            if self._held is not None:
+                self._socket.sendto(*self._held)
+                self._held = None
+
+            return sent
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+def makeEndpoint(lossRate, reorderRate, seed, window, mtu, receiveDir):
+    udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    udpSocket.bind(('localhost', 0))
+    udpSocket.settimeout(0.5)
+
+    endpoint = fileTransfer.FileTransferEndpoint(LossySocket(udpSocket, lossRate, reorderRate, seed), window, mtu, receiveDir)
+    thread = threading.Thread(target=endpoint.serve, daemon=True)
+    thread.start()
+
+    return endpoint, udpSocket, thread
+
+'''
+Send path from one endpoint to another. Returns the elapsed time in seconds and the Sender
+'''
+def runTransfer(path, directory, lossRate, reorderRate, window, mtu):
+    sending, sendingSocket, sendingThread = makeEndpoint(lossRate, reorderRate, 1, window, mtu, directory)
+    receiving, receivingSocket, receivingThread = makeEndpoint(lossRate, reorderRate, 2, window, mtu, directory)
+
+    received = threading.Event()
+    receiving.onReceived = lambda username, filename, ok: received.set()
+
+    start = time.perf_counter()
+    sender = sending.upload(receivingSocket.getsockname(), path, f'bench; {os.path.basename(path)}')
+    received.wait(5)
+    elapsed = time.perf_counter() - start
+
+    for endpoint, udpSocket, thread in ((sending, sendingSocket, sendingThread), (receiving, receivingSocket, receivingThread)):
+        endpoint.stop()
+        thread.join()
+        udpSocket.close()
+
+    receivedPath = os.path.join(directory, f'bench_{os.path.basename(path)}')
+    sender.ok = sender.ok and filecmp.cmp(path, receivedPath, shallow=False)
+    os.remove(receivedPath)
+
+    return elapsed, sender
+
+'''
+Send path over the TCP peer channel. Returns the elapsed time in seconds and whether the copy is intact
+'''
+def runTcpTransfer(path, directory):
+    listenSocket = socket.create_server(('localhost', 0))
+    listenSocket.settimeout(0.5)
+
+    endpoint = fileTransfer.FileTransferEndpoint(None, receiveDir=directory)
+    received = threading.Event()
+    endpoint.onReceived = lambda username, filename, ok: received.set()
+    thread = threading.Thread(target=endpoint.serveTcp, args=(listenSocket,), daemon=True)
+    thread.start()
+
+    start = time.perf_counter()
+    ok = endpoint.uploadTcp(listenSocket.getsockname(), path, f'bench; {os.path.basename(path)}')
+    received.wait(5)
+    elapsed = time.perf_counter() - start
+
+    endpoint.stop()
+    thread.join()
+    listenSocket.close()
+
+    receivedPath = os.path.join(directory, f'bench_{os.path.basename(path)}')
+    ok = ok and filecmp.cmp(path, receivedPath, shallow=False)
+    os.remove(receivedPath)
+
+    return elapsed, ok
+
+
+if __name__ == '__main__':
+    sizeMb = float(sys.argv[1]) if len(sys.argv) > 1 else 16
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    # (label, loss rate, reorder rate, mtu)
+    scenarios = [
+        ('clean, mtu 1500', 0.0, 0.0, 1500),
+        ('clean, mtu 9000', 0.0, 0.0, 9000),
+        ('1% loss', 0.01, 0.0, 1500),
+        ('5% loss', 0.05, 0.0, 1500),
+        ('5% reorder', 0.0, 0.05, 1500),
+        ('2% loss, 5% reorder', 0.02, 0.05, 1500),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'payload.bin')
+        with open(path, 'wb') as payload:
+            payload.write(random.Random(0).randbytes(int(sizeMb * 1024 * 1024)))
+
+        print(f'{sizeMb:g} MB file, window {window} packets')
+        print(f'{"network":<24}{"MB/s":>10}{"packets":>10}{"resent":>10}{"intact":>8}')
+
+        for label, lossRate, reorderRate, mtu in scenarios:
+            elapsed, sender = runTransfer(path, directory, lossRate, reorderRate, window, mtu)
+            print(
+                f'{label:<24}{sizeMb / elapsed:>10.1f}{sender.packetsSent:>10,}{sender.retransmits:>10,}'
+                f'{"yes" if sender.ok else "NO":>8}'
+            )
+
+        elapsed, ok = runTcpTransfer(path, directory)
+        print(f'{"tcp, sendfile":<24}{sizeMb / elapsed:>10.1f}{"-":>10}{"-":>10}{"yes" if ok else "NO":>8}')
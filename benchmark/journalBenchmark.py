@@ -0,0 +1,86 @@
+'''
+Benchmark for the MSG write path.
+Concurrent posters post messages to a MessageStore in a temporary directory, once per journal durability mode,
+and the benchmark reports posts/sec. The baseline rows open, append to and close a log file under a global lock
+for every post, like the server did before the group commit writer, with and without an fsync per post.
+'''
+
+import sys
+import os
+import time
+import tempfile
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from messageStore import MessageStore
+from journalWriter import durabilityModes
+
+timestamp = '01 Jan 2024 00:00:00'
+
+'''
+Run posters threads that each call post postsPerPoster times. Returns the elapsed time in seconds
+'''
+def runPosters(post, posters, postsPerPoster):
+    def poster(username):
+        for index in range(postsPerPoster):
+            post(username, f'benchmark message {index}')
+
+    threads = [threading.Thread(target=poster, args=(f'user{index}',)) for index in range(posters)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start
+
+def benchmarkBaseline(directory, fsync, posters, postsPerPoster):
+    lock = threading.Lock()
+    path = os.path.join(directory, f'messagelog-{fsync}.txt')
+    nextMessageNumber = [1]
+
+    def post(username, message):
+        with lock:
+            with open(path, 'a') as messagelog:
+                messagelog.write(f'{nextMessageNumber[0]}; {timestamp}; {username}; {message}; no\n')
+                if fsync:
+                    messagelog.flush()
+                    os.fsync(messagelog.fileno())
+            nextMessageNumber[0] += 1
+
+    return runPosters(post, posters, postsPerPoster)
+
+def benchmarkStore(directory, durability, posters, postsPerPoster):
+    store = MessageStore(os.path.join(directory, f'journal-{durability}.txt'), threading.Lock(), durability, fsyncInterval=1.0)
+    store.load()
+
+    def post(username, message):
+        store.post(timestamp, username, message)
+
+    elapsed = runPosters(post, posters, postsPerPoster)
+    store.close()
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    posters = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    postsPerPoster = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    totalPosts = posters * postsPerPoster
+
+    print(f'{posters} posters x {postsPerPoster} posts')
+    print(f'{"write path":<40}{"posts/sec":>12}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for fsync in (True, False):
+            elapsed = benchmarkBaseline(directory, fsync, posters, postsPerPoster)
+            label = 'baseline, fsync per post' if fsync else 'baseline, buffered'
+            print(f'{label:<40}{totalPosts / elapsed:>12,.0f}')
+
+        for durability in durabilityModes:
+            elapsed = benchmarkStore(directory, durability, posters, postsPerPoster)
+            print(f'{"group commit, " + durability:<40}{totalPosts / elapsed:>12,.0f}')
@@ -0,0 +1,435 @@
+'''
+Load generator for the chat server.
+Starts a server on loopback and drives simulated clients through the real Protocol class. Each client logs in with
+its own account and sends a weighted mix of MSG, RDM, SYN, ATU, EDT and DLT commands at its share of the target
+rate, one command at a time. RDM reads the messages since the client's last RDM and SYN the changes since its last
+SYN. With --rooms, clients are spread over that many rooms, which they JOIN after logging in. Reports throughput and p50/p95/p99 latency per command along with the CPU use and RSS of the
+server processes, and can write the results as JSON and compare them with the JSON of an earlier run.
+
+Latency is measured from when a command was due to be sent, not from when it was sent, so a server that cannot keep
+up with the target rate shows up as higher latency rather than as a quietly lower rate. A client whose last command
+took longer than its interval skips the slots it missed rather than sending them in a burst, and the skipped slots
+are reported. The clock starts for every client at the same time, once they have all had a moment to connect and
+log in, and throughput is counted from then. Clients are spread over
+several processes so the load generator is not held back by a single GIL. Their CPU use is reported too, since a
+saturated generator makes the numbers meaningless.
+
+Examples, from the repository root:
+    python3 benchmark/loadBenchmark.py --mode async --clients 50 --rate 2000 --duration 20
+    python3 benchmark/loadBenchmark.py --mode workers --json after.json --compare before.json
+'''
+
+import sys
+import os
+import re
+import json
+import time
+import random
+import datetime
+import argparse
+import threading
+import subprocess
+import multiprocessing
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(currentDir)
+
+from benchServer import BenchServer, benchAccount, connect, processTree, cpuSeconds, rssBytes
+
+commands = ('MSG', 'RDM', 'SYN', 'ATU', 'EDT', 'DLT')
+defaultMix = 'MSG=40,RDM=30,ATU=20,EDT=5,DLT=5'
+
+# Responses to MSG, EDT and DLT that went through start with 'Message #<number> <posted|edited|deleted> at <timestamp>.'
+changeResponse = re.compile(r'Message #(\d+) \w+ at (.+)\.$')
+
+timestampFormat = '%d %b %Y %H:%M:%S'
+
+'''
+Parse a command mix such as 'MSG=40,RDM=30'. Returns the commands and their weights
+'''
+def parseMix(mix):
+    weights = {}
+
+    for part in mix.split(','):
+        command, _, weight = part.partition('=')
+        command = command.strip().upper()
+
+        if command not in commands:
+            raise argparse.ArgumentTypeError(f'Unknown command {command!r} in mix, expected one of {", ".join(commands)}')
+
+        weights[command] = float(weight or 1)
+
+    return list(weights), list(weights.values())
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+class SimulatedClient:
+    '''
+    Sends commands from the mix every interval seconds from startAt until deadline, both time.time() values, and
+    records how long each took to be answered
+    '''
+    def __init__(self, port, username, password, protocolVersion, interval, mixCommands, mixWeights, startAt, deadline, seed, room):
+        self.port = port
+        self.username = username
+        self.password = password
+        self.protocolVersion = protocolVersion
+        self.interval = interval
+        self.mixCommands = mixCommands
+        self.mixWeights = mixWeights
+        self.startAt = startAt
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        # Room to JOIN after logging in, or None to stay in the default room
+        self.room = room
+        # Latencies in seconds and failed command counts, keyed by command
+        self.latencies = {command: [] for command in commands}
+        self.errors = dict.fromkeys(commands, 0)
+        # Number of times a command was not sent because the previous one was answered too late
+        self.skipped = 0
+        # [message number, timestamp] of the messages this client posted and has not deleted, for EDT and DLT
+        self._ownMessages = []
+        self._lastRead = datetime.datetime.now().strftime(timestampFormat)
+        self._syncToken = ''
+
+    def run(self):
+        connection = connect(self.port, self.username, self.password, protocolVersion=self.protocolVersion)
+
+        if self.room:
+            connection.sendRequest('JOIN', (self.room,))
+            connection.recvFrame()
+
+        # Start at a random point in the first interval so clients do not send in lock-step
+        dueAt = self.startAt + self.random.random() * self.interval
+
+        while dueAt < self.deadline:
+            delay = dueAt - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            command, args = self._nextRequest()
+            connection.sendRequest(command, args)
+
+            headers, response = connection.recvFrame()
+            while 'More' in headers:
+                headers, response = connection.recvFrame()
+
+            self.latencies[command].append(time.time() - dueAt)
+            self._handleResponse(command, args, response)
+
+            dueAt += self.interval
+
+            # Slots that went by while waiting are skipped, and the latest one is sent straight away
+            missed = int((time.time() - dueAt) / self.interval)
+            if missed > 0:
+                self.skipped += missed
+                dueAt += missed * self.interval
+
+        connection.sendRequest('OUT', ())
+        connection.recvFrame()
+        connection.socket.close()
+
+    '''
+    Pick the next command from the mix. EDT and DLT need a message of this client's, so they become MSG until there is one
+    '''
+    def _nextRequest(self):
+        command = self.random.choices(self.mixCommands, self.mixWeights)[0]
+
+        if command in ('EDT', 'DLT') and not self._ownMessages:
+            command = 'MSG'
+
+        if command == 'MSG':
+            return command, (f'load test message from {self.username}',)
+
+        if command == 'RDM':
+            since, self._lastRead = self._lastRead, datetime.datetime.now().strftime(timestampFormat)
+            return command, (since,)
+
+        if command == 'SYN':
+            return command, (self._syncToken,) if self._syncToken else ()
+
+        if command == 'ATU':
+            return command, ()
+
+        messageNumber, timestamp = self._ownMessages[-1]
+
+        if command == 'EDT':
+            return command, (str(messageNumber), timestamp, f'edited load test message from {self.username}')
+
+        return command, (str(messageNumber), timestamp)
+
+    def _handleResponse(self, command, args, response):
+        if command in ('RDM', 'ATU'):
+            return
+
+        # A sync ends with the token to sync from next
+        if command == 'SYN':
+            lastLine = response.rstrip('\n').rpartition('\n')[2]
+            if lastLine.startswith('Sync: '):
+                self._syncToken = lastLine[len('Sync: '):]
+            else:
+                self.errors[command] += 1
+            return
+
+        match = changeResponse.match(response)
+
+        if command == 'DLT':
+            # Deleted, or no longer where this client thinks it is, since deletes by others renumber messages
+            self._ownMessages.pop()
+
+        if not match:
+            self.errors[command] += 1
+        elif command == 'MSG':
+            self._ownMessages.append([int(match[1]), match[2]])
+        elif command == 'EDT':
+            self._ownMessages[-1][1] = match[2]
+
+'''
+Run a share of the simulated clients on threads of this process. clientSpecs are the (username, password, seed, room)
+of each client. Returns the latencies, errors and skipped slots of all of them, and the CPU seconds this process used
+'''
+def runClientProcess(port, clientSpecs, protocolVersion, interval, mixCommands, mixWeights, startAt, deadline):
+    cpuStart = time.process_time()
+
+    clients = [
+        SimulatedClient(port, username, password, protocolVersion, interval, mixCommands, mixWeights, startAt, deadline, seed, room)
+        for username, password, seed, room in clientSpecs
+    ]
+    threads = [threading.Thread(target=client.run, name=f'Client-{client.username}') for client in clients]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = {command: [latency for client in clients for latency in client.latencies[command]] for command in commands}
+    errors = {command: sum(client.errors[command] for client in clients) for command in commands}
+
+    return latencies, errors, sum(client.skipped for client in clients), time.process_time() - cpuStart
+
+'''
+Sample the total RSS of a process tree every interval seconds until stopped. Keeps the peak and the last sample
+'''
+class RssSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='RssSampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.last = rssBytes(processTree(self.pid))
+            self.peak = max(self.peak, self.last)
+
+            if self._stopped.wait(self.interval):
+                return
+
+'''
+Commit of the working tree, so results can be told apart. None outside a git checkout
+'''
+def gitCommit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=parentDir, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmark(options):
+    mixCommands, mixWeights = options.mix
+    # Every client sends at the same rate, which adds up to the target rate
+    interval = options.clients / options.rate
+    processCount = min(options.processes, options.clients)
+
+    serverArgs = [options.mode]
+
+    with BenchServer(serverArgs, extraAccounts=options.clients) as server:
+        serverPids = processTree(server.process.pid)
+        rssSampler = RssSampler(server.process.pid)
+        rssSampler.start()
+
+        # Clients have a moment to connect and log in before the clock starts
+        startAt = time.time() + 1.0 + options.clients * 0.002
+        deadline = startAt + options.duration
+
+        clientSpecs = [
+            (*benchAccount(index), options.seed + index, f'bench{index % options.rooms}' if options.rooms > 1 else None)
+            for index in range(options.clients)
+        ]
+        shares = [clientSpecs[index::processCount] for index in range(processCount)]
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processCount) as pool:
+            pending = [
+                pool.apply_async(runClientProcess, (server.port, share, options.protocol, interval, mixCommands, mixWeights, startAt, deadline))
+                for share in shares
+            ]
+
+            # Sleep till the clock starts, then take the server's CPU time as the baseline
+            time.sleep(max(0, startAt - time.time()))
+            serverPids = processTree(server.process.pid)
+            serverCpuStart = cpuSeconds(serverPids)
+
+            results = [result.get() for result in pending]
+
+        elapsed = time.time() - startAt
+        serverCpu = cpuSeconds(serverPids) - serverCpuStart
+        rssSampler.stop()
+
+    latencies = {command: sorted(latency for result in results for latency in result[0][command]) for command in commands}
+    errors = {command: sum(result[1][command] for result in results) for command in commands}
+    skipped = sum(result[2] for result in results)
+    clientCpu = sum(result[3] for result in results)
+
+    commandResults = {}
+    for command in commands:
+        commandLatencies = latencies[command]
+        if not commandLatencies:
+            continue
+
+        commandResults[command] = {
+            'count': len(commandLatencies),
+            'errors': errors[command],
+            'throughput': len(commandLatencies) / elapsed,
+            'p50Ms': percentile(commandLatencies, 0.5) * 1000,
+            'p95Ms': percentile(commandLatencies, 0.95) * 1000,
+            'p99Ms': percentile(commandLatencies, 0.99) * 1000,
+            'maxMs': commandLatencies[-1] * 1000,
+        }
+
+    allLatencies = sorted(latency for command in commands for latency in latencies[command])
+
+    return {
+        'commit': gitCommit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'mode': options.mode,
+            'clients': options.clients,
+            'rooms': options.rooms,
+            'targetRate': options.rate,
+            'duration': options.duration,
+            'mix': dict(zip(mixCommands, mixWeights)),
+            'protocol': options.protocol,
+            'processes': processCount,
+        },
+        'elapsed': elapsed,
+        'throughput': len(allLatencies) / elapsed,
+        'p50Ms': percentile(allLatencies, 0.5) * 1000 if allLatencies else None,
+        'p95Ms': percentile(allLatencies, 0.95) * 1000 if allLatencies else None,
+        'p99Ms': percentile(allLatencies, 0.99) * 1000 if allLatencies else None,
+        'skipped': skipped,
+        'commands': commandResults,
+        'server': {
+            'cpuPercent': serverCpu / elapsed * 100,
+            'peakRssMb': rssSampler.peak / (1024 * 1024),
+            'endRssMb': rssSampler.last / (1024 * 1024),
+        },
+        'clientCpuPercent': clientCpu / elapsed * 100,
+    }
+
+def printResults(results):
+    config = results['config']
+    print(
+        f'{config["mode"]} server, {config["clients"]} clients in {config.get("rooms", 1)} rooms, target {config["targetRate"]:,.0f} cmds/sec for '
+        f'{config["duration"]:g}s, protocol v{config["protocol"]}, commit {results["commit"] or "unknown"}'
+    )
+    print(f'{"command":<10}{"count":>10}{"errors":>8}{"cmds/sec":>12}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+
+    for command, stats in results['commands'].items():
+        print(
+            f'{command:<10}{stats["count"]:>10,}{stats["errors"]:>8,}{stats["throughput"]:>12,.0f}'
+            f'{stats["p50Ms"]:>10.2f}{stats["p95Ms"]:>10.2f}{stats["p99Ms"]:>10.2f}{stats["maxMs"]:>10.2f}'
+        )
+
+    count = sum(stats['count'] for stats in results['commands'].values())
+    errors = sum(stats['errors'] for stats in results['commands'].values())
+    print(
+        f'{"all":<10}{count:>10,}{errors:>8,}{results["throughput"]:>12,.0f}'
+        f'{results["p50Ms"] or 0:>10.2f}{results["p95Ms"] or 0:>10.2f}{results["p99Ms"] or 0:>10.2f}'
+    )
+
+    if results['skipped']:
+        print(f'{results["skipped"]:,} slots skipped because the previous command was answered late')
+
+    server = results['server']
+    print(
+        f'server CPU {server["cpuPercent"]:.0f}%, peak RSS {server["peakRssMb"]:.1f} MB, end RSS {server["endRssMb"]:.1f} MB; '
+        f'load generator CPU {results["clientCpuPercent"]:.0f}%'
+    )
+
+'''
+Print how throughput and latency changed from an earlier run's results
+'''
+def printComparison(baseline, results):
+    def change(old, new):
+        if not old or new is None:
+            return '-'
+        return f'{(new - old) / old * 100:+.1f}%'
+
+    print(f'\ncompared with commit {baseline.get("commit") or "unknown"} ({baseline.get("date", "unknown date")})')
+
+    # Runs from before rooms were all in the default room
+    changedConfig = [key for key, value in results['config'].items() if baseline['config'].get(key, 1 if key == 'rooms' else None) != value]
+    if changedConfig:
+        print(f'warning: the runs were configured differently ({", ".join(changedConfig)})')
+    print(f'{"command":<10}{"cmds/sec":>12}{"p50":>10}{"p95":>10}{"p99":>10}')
+
+    rows = [(command, baseline['commands'].get(command), stats) for command, stats in results['commands'].items()]
+    rows.append(('all', baseline, results))
+
+    for label, old, new in rows:
+        if old is None:
+            continue
+
+        print(
+            f'{label:<10}{change(old.get("throughput"), new["throughput"]):>12}{change(old.get("p50Ms"), new["p50Ms"]):>10}'
+            f'{change(old.get("p95Ms"), new["p95Ms"]):>10}{change(old.get("p99Ms"), new["p99Ms"]):>10}'
+        )
+
+    oldServer, newServer = baseline['server'], results['server']
+    print(
+        f'server CPU {change(oldServer["cpuPercent"], newServer["cpuPercent"])}, '
+        f'peak RSS {change(oldServer["peakRssMb"], newServer["peakRssMb"])}'
+    )
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Drive the chat server with simulated clients and measure it.')
+    parser.add_argument('--mode', choices=('threaded', 'async', 'workers'), default='threaded', help='server mode')
+    parser.add_argument('--clients', type=int, default=20, help='number of simulated clients')
+    parser.add_argument('--rooms', type=int, default=1, help='rooms to spread the clients over, 1 for the default room only')
+    parser.add_argument('--rate', type=float, default=1000, help='target commands/sec over all clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send commands for')
+    parser.add_argument('--mix', type=parseMix, default=parseMix(defaultMix), help=f'weighted command mix, default {defaultMix}')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=2, help='request protocol version to offer')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='load generator processes')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the command mix')
+    parser.add_argument('--json', metavar='PATH', help='write the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='compare with the JSON results of an earlier run')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+
+    results = runBenchmark(options)
+    printResults(results)
+
+    if options.json:
+        with open(options.json, 'w') as resultsFile:
+            json.dump(results, resultsFile, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baselineFile:
+            printComparison(json.load(baselineFile), results)
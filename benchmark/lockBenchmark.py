@@ -0,0 +1,147 @@
+'''
+Contention benchmark for the message store lock.
+Threads share one MessageStore in a temporary directory, seeded with a journal of messages. Each operation is a
+read, an RDM page of the messages after a random time, or a write, a post, picked at random to give the reader share
+asked for. Every reader share is run with the store guarded by a plain exclusive lock, as before, and by the
+reader-writer lock the server uses, and the benchmark reports operations/sec, read and write latency percentiles and
+how often readers had to wait for the lock.
+
+Readers still take turns on the GIL, so the reader-writer lock does not add CPU. What it saves is the time reads
+spend queued behind other reads. Every thread here is busy, so with the reader-writer lock more threads compete for
+the GIL and the journal writer thread gets it later, which shows up as slower writes.
+
+Examples, from the repository root:
+    python3 benchmark/lockBenchmark.py
+    python3 benchmark/lockBenchmark.py --threads 64 --duration 5 --readers 100,99,90,50
+'''
+
+import sys
+import os
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from messageStore import MessageStore
+from metrics import InstrumentedLock, InstrumentedReadWriteLock
+from startupBenchmark import journalEvents, writeJournal
+
+lockKinds = {
+    'exclusive': InstrumentedLock,
+    'read-write': InstrumentedReadWriteLock,
+}
+
+timestamp = '01 Jan 2025 00:00:00'
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return None
+
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+def formatMs(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.2f}'
+
+'''
+Run threads against a store guarded by a lock of lockKind for duration seconds, reading with probability
+readFraction. Returns operations/sec, the sorted read and write latencies and the store's shared lock
+'''
+def runMix(journalPath, messageCount, lockKind, readFraction, threads, duration, pageSize, seed):
+    lock = lockKinds[lockKind]('messagelog')
+    store = MessageStore(journalPath, lock, 'buffered')
+    store.load()
+
+    firstPost = datetime.datetime(2024, 1, 1)
+    readLatencies = []
+    writeLatencies = []
+    stopAt = time.perf_counter() + duration
+
+    def worker(index):
+        generator = random.Random(seed + index)
+        reads = []
+        writes = []
+
+        while time.perf_counter() < stopAt:
+            if generator.random() < readFraction:
+                since = firstPost + datetime.timedelta(seconds=generator.randrange(messageCount))
+
+                start = time.perf_counter()
+                store.messagesSince(since, pageSize)
+                reads.append(time.perf_counter() - start)
+            else:
+                start = time.perf_counter()
+                store.post(timestamp, f'user{index}', 'lock benchmark message')
+                writes.append(time.perf_counter() - start)
+
+        readLatencies.extend(reads)
+        writeLatencies.extend(writes)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    store.close()
+    readLatencies.sort()
+    writeLatencies.sort()
+
+    return (len(readLatencies) + len(writeLatencies)) / elapsed, readLatencies, writeLatencies, getattr(lock, 'shared', lock)
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Compare an exclusive and a reader-writer message store lock.')
+    parser.add_argument('--threads', type=int, default=32, help='threads sharing the store')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds to run each mix for')
+    parser.add_argument('--readers', default='100,95,80,50', help='comma separated percentages of operations that read')
+    parser.add_argument('--messages', type=int, default=20000, help='messages in the store to start with')
+    parser.add_argument('--page-size', type=int, default=100, help='messages in each RDM page read')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+    readerPercentages = [float(percentage) for percentage in options.readers.split(',')]
+
+    print(f'{options.threads} threads, {options.messages} messages, RDM pages of {options.page_size}, {options.duration:g}s per mix')
+    print(
+        f'{"readers":>8}{"lock":>12}{"ops/sec":>10}{"read p50":>10}{"read p99":>10}'
+        f'{"write p50":>11}{"write p99":>11}{"reads waited":>14}'
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        seedPath = os.path.join(directory, 'seed.txt')
+        writeJournal(seedPath, journalEvents(options.messages))
+
+        with open(seedPath) as seedJournal:
+            seedEvents = seedJournal.read()
+
+        for readerPercentage in readerPercentages:
+            for lockKind in lockKinds:
+                # Every run starts from the same messages
+                journalPath = os.path.join(directory, 'messagejournal.txt')
+                with open(journalPath, 'w') as journal:
+                    journal.write(seedEvents)
+
+                opsPerSecond, reads, writes, readLock = runMix(
+                    journalPath, options.messages, lockKind, readerPercentage / 100, options.threads,
+                    options.duration, options.page_size, options.seed
+                )
+                waited = readLock.contended / readLock.acquisitions if readLock.acquisitions else 0
+
+                print(
+                    f'{readerPercentage:>7g}%{lockKind:>12}{opsPerSecond:>10,.0f}'
+                    f'{formatMs(percentile(reads, 0.5)):>10}{formatMs(percentile(reads, 0.99)):>10}'
+                    f'{formatMs(percentile(writes, 0.5)):>11}{formatMs(percentile(writes, 0.99)):>11}{waited:>13.0%}'
+                )
@@ -0,0 +1,91 @@
+'''
+Latency benchmark comparing lock-step and pipelined commands over loopback.
+Lock-step sends one command and waits for its response before sending the next. Pipelined keeps up to a window of
+commands in flight, each tagged with a Request-Id header, and matches responses by id.
+'''
+
+import sys
+import os
+import time
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(currentDir)
+
+from benchServer import BenchServer, connect
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+'''
+Send count commands one at a time. Returns the elapsed time and per-command latencies in seconds
+'''
+def runLockStep(connection, command, count):
+    latencies = []
+
+    start = time.perf_counter()
+    for _ in range(count):
+        sentAt = time.perf_counter()
+        connection.sendMessage(command)
+        connection.recvMessage()
+        latencies.append(time.perf_counter() - sentAt)
+
+    return time.perf_counter() - start, latencies
+
+'''
+Send count commands with up to window of them in flight. Returns the elapsed time and per-command latencies
+'''
+def runPipelined(connection, command, count, window):
+    sentAt = {}
+    latencies = []
+    slots = threading.Semaphore(window)
+
+    def receive():
+        for _ in range(count):
+            headers, _ = connection.recvFrame()
+            latencies.append(time.perf_counter() - sentAt.pop(headers['Request-Id']))
+            slots.release()
+
+    receiver = threading.Thread(target=receive, name='PipelineReceiver')
+
+    start = time.perf_counter()
+    receiver.start()
+
+    for requestId in range(count):
+        slots.acquire()
+        sentAt[str(requestId)] = time.perf_counter()
+        connection.sendMessage(command, {'Request-Id': requestId})
+
+    receiver.join()
+
+    return time.perf_counter() - start, latencies
+
+def report(label, count, elapsed, latencies):
+    latencies.sort()
+    print(
+        f'{label:<24}{count / elapsed:>12,.0f}'
+        f'{percentile(latencies, 0.5) * 1000:>10.3f}{percentile(latencies, 0.99) * 1000:>10.3f}'
+    )
+
+
+if __name__ == '__main__':
+    serverMode = sys.argv[1] if len(sys.argv) > 1 else 'async'
+    command = sys.argv[2] if len(sys.argv) > 2 else 'ATU'
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    windows = [1, 8, 32]
+
+    print(f'{serverMode} server, {count} x {command!r}')
+    print(f'{"mode":<24}{"cmds/sec":>12}{"p50 ms":>10}{"p99 ms":>10}')
+
+    with BenchServer([serverMode]) as server:
+        connection = connect(server.port)
+
+        elapsed, latencies = runLockStep(connection, command, count)
+        report('lock-step', count, elapsed, latencies)
+
+        for window in windows:
+            elapsed, latencies = runPipelined(connection, command, count, window)
+            report(f'pipelined, window {window}', count, elapsed, latencies)
+
+        connection.sendMessage('OUT')
+        connection.recvMessage()
@@ -0,0 +1,71 @@
+'''
+Micro-benchmark for the message framing in protocol.Protocol.
+Streams messages of several payload sizes over a local socket pair and reports messages/sec and MB/sec.
+'''
+
+import sys
+import os
+import time
+import socket
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(parentDir)
+
+from protocol.protocol import Protocol
+
+# (label, payload size in characters, number of messages)
+payloadCases = [
+    ('small (32 B)', 32, 200000),
+    ('medium (4 KB)', 4 * 1024, 50000),
+    ('large (1 MB)', 1024 * 1024, 200),
+    ('multibyte (4 KB of 3-byte chars)', 4 * 1024, 50000),
+]
+
+'''
+Send count copies of message from one end of a socket pair and receive them on the other.
+Returns the elapsed time in seconds
+'''
+def runCase(message, count):
+    senderSocket, receiverSocket = socket.socketpair()
+    sender = Protocol(senderSocket, 'sender', 0)
+    receiver = Protocol(receiverSocket, 'receiver', 0)
+
+    def sendAll():
+        for _ in range(count):
+            sender.sendMessage(message)
+
+    senderThread = threading.Thread(target=sendAll, name='BenchmarkSender')
+
+    start = time.perf_counter()
+    senderThread.start()
+
+    for _ in range(count):
+        received = receiver.recvMessage()
+
+    elapsed = time.perf_counter() - start
+    senderThread.join()
+
+    assert received == message, 'Received message does not match the sent message'
+
+    senderSocket.close()
+    receiverSocket.close()
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    # Optional scale factor for the number of messages per case, e.g. 0.1 for a quick run
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+
+    print(f'{"payload":<36}{"messages":>10}{"msgs/sec":>14}{"MB/sec":>10}')
+
+    for label, size, count in payloadCases:
+        count = max(1, int(count * scale))
+        message = '€' * size if label.startswith('multibyte') else 'x' * size
+
+        elapsed = runCase(message, count)
+
+        megabytes = len(message.encode('utf-8')) * count / (1024 * 1024)
+        print(f'{label:<36}{count:>10}{count / elapsed:>14,.0f}{megabytes / elapsed:>10.1f}')
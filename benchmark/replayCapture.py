@@ -0,0 +1,290 @@
+'''
+Replay captured client traffic against a fresh server and compare latencies with the original run.
+Capture traffic by setting captureFile in server/serverSettings.py, see server/trafficCapture.py. Every captured
+connection is replayed on its own connection with the exact frames it sent. The frames are sent at their original
+times, scaled by --speed, or as fast as the server answers with --speed 0. Each connection waits for the answer to a
+request before sending the next one, as the client does, so pipelined requests are replayed one at a time.
+
+The latency of each request is the time from sending it to its answer arriving. The original latency is the time
+from the server receiving the request to the server finishing it, taken from the capture, so on loopback the two are
+comparable. Start the server with the captured run's accounts (--credentials) and messages (--journal) for logins,
+EDT and DLT to behave as they did.
+
+Examples, from the repository root:
+    python3 benchmark/replayCapture.py server/capture.bin --speed 0
+    python3 benchmark/replayCapture.py server/capture.bin.* --mode workers --credentials server/credentials.txt --json replay.json
+'''
+
+import sys
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from benchServer import BenchServer
+from trafficCapture import readCapture
+from protocol.protocol import Protocol, parseHeader, decodeBody, headerTerminator, parseTextRequest, decodeBinaryRequest, requestLengthStruct
+from admissionControl import rejectedHeader
+
+'''
+Command of a captured request frame in the given request version
+'''
+def frameCommand(frame, protocolVersion):
+    if protocolVersion > 1:
+        return decodeBinaryRequest(frame[requestLengthStruct.size:])[0] or 'invalid'
+
+    headerEnd = frame.index(headerTerminator)
+    _, headers = parseHeader(frame[:headerEnd])
+
+    return parseTextRequest(decodeBody(frame[headerEnd + len(headerTerminator):], headers))[0] or 'invalid'
+
+class SessionReplay:
+    '''
+    Replays one captured connection. offset is the seconds from the start of the replayed capture to the start of the
+    capture file the connection is from. Frames are due at replayStart plus their time in the capture over speed, or
+    straight away if speed is 0
+    '''
+    def __init__(self, capturedConnection, offset, port, replayStart, speed, timeout):
+        self.capturedConnection = capturedConnection
+        self.offset = offset
+        self.port = port
+        self.replayStart = replayStart
+        self.speed = speed
+        self.timeout = timeout
+        # (command, original latency or None, replay latency) of each request
+        self.latencies = []
+        self.loggedIn = False
+        self.error = None
+
+    def run(self):
+        try:
+            self._replay()
+        except (OSError, ValueError) as error:
+            self.error = error
+
+    def _replay(self):
+        frames = self.capturedConnection.frames
+
+        self._waitUntilDue(self.capturedConnection.openedAt)
+        clientSocket = socket.create_connection(('localhost', self.port), timeout=self.timeout)
+        clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Protocol(clientSocket, 'localhost', self.port)
+
+        try:
+            frameNumber = 0
+            protocolVersion = 1
+
+            # Login attempts are a username frame and a password frame, answered once
+            while not self.loggedIn and frameNumber + 1 < len(frames):
+                self._send(clientSocket, frameNumber)
+                sentAt = self._send(clientSocket, frameNumber + 1)
+
+                headers, response = connection.recvFrame()
+                self._record('login', frameNumber + 1, time.perf_counter() - sentAt)
+                frameNumber += 2
+
+                if rejectedHeader in headers:
+                    return
+
+                if response.startswith('Welcome'):
+                    self.loggedIn = True
+                    protocolVersion = int(headers.get('Protocol', 1))
+
+            # The UDP port frame has no answer
+            if self.loggedIn and frameNumber < len(frames):
+                self._send(clientSocket, frameNumber)
+                frameNumber += 1
+
+            while self.loggedIn and frameNumber < len(frames):
+                command = frameCommand(frames[frameNumber][1], protocolVersion)
+                sentAt = self._send(clientSocket, frameNumber)
+
+                # Skip live events, and read every frame of a streamed answer
+                headers, _ = connection.recvFrame()
+                while 'Event' in headers or 'More' in headers:
+                    headers, _ = connection.recvFrame()
+
+                self._record(command, frameNumber, time.perf_counter() - sentAt)
+                frameNumber += 1
+
+                if command == 'OUT':
+                    return
+        finally:
+            clientSocket.close()
+
+    def _waitUntilDue(self, captureTime):
+        if not self.speed:
+            return
+
+        delay = self.replayStart + (self.offset + captureTime) / self.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    '''
+    Send a captured frame once it is due. Returns when it was sent
+    '''
+    def _send(self, clientSocket, frameNumber):
+        captureTime, frame = self.capturedConnection.frames[frameNumber]
+
+        self._waitUntilDue(captureTime)
+        sentAt = time.perf_counter()
+        clientSocket.sendall(frame)
+
+        return sentAt
+
+    def _record(self, command, frameNumber, latency):
+        repliedAt = self.capturedConnection.replies.get(frameNumber)
+        originalLatency = None if repliedAt is None else repliedAt - self.capturedConnection.frames[frameNumber][0]
+
+        self.latencies.append((command, originalLatency, latency))
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return None
+
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+def formatMs(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.2f}'
+
+def formatChange(old, new):
+    if not old or new is None:
+        return '-'
+
+    return f'{(new - old) / old * 100:+.0f}%'
+
+'''
+Read capture files into (offset, connection) pairs. Adding offset to a time in the connection's capture file gives
+the seconds since the first connection of any of the files opened
+'''
+def loadCaptures(paths):
+    sessions = []
+
+    for path in paths:
+        startedAt, connections = readCapture(path)
+        sessions.extend((startedAt, connection) for connection in connections)
+
+    if not sessions:
+        return []
+
+    firstOpened = min(startedAt + connection.openedAt for startedAt, connection in sessions)
+
+    return [(startedAt - firstOpened, connection) for startedAt, connection in sessions]
+
+def replay(options):
+    sessions = loadCaptures(options.captures)
+    if not sessions:
+        print('The capture has no connections.')
+        return None
+
+    seedFiles = {name: path for name, path in (('credentials.txt', options.credentials), ('messagejournal.txt', options.journal)) if path}
+    capturedDuration = max(offset + (connection.closedAt or (connection.frames[-1][0] if connection.frames else connection.openedAt)) for offset, connection in sessions)
+
+    with BenchServer([options.mode], seedFiles=seedFiles) as server:
+        # Give every thread a moment to start before the first frame is due
+        replayStart = time.perf_counter() + (0.5 if options.speed else 0)
+        replays = [
+            SessionReplay(connection, offset, server.port, replayStart, options.speed, options.timeout)
+            for offset, connection in sessions
+        ]
+        threads = [threading.Thread(target=sessionReplay.run, name='SessionReplay') for sessionReplay in replays]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        replayDuration = time.perf_counter() - replayStart
+
+    commands = {}
+    for sessionReplay in replays:
+        for command, originalLatency, latency in sessionReplay.latencies:
+            original, replayed = commands.setdefault(command, ([], []))
+            if originalLatency is not None:
+                original.append(originalLatency)
+            replayed.append(latency)
+
+    results = {
+        'captures': options.captures,
+        'mode': options.mode,
+        'speed': options.speed,
+        'sessions': len(replays),
+        'failedSessions': sum(1 for sessionReplay in replays if sessionReplay.error),
+        # Connections that tried to log in, i.e. sent a username and a password, but never did
+        'failedLogins': sum(
+            1 for sessionReplay in replays
+            if len(sessionReplay.capturedConnection.frames) >= 2 and not sessionReplay.loggedIn and not sessionReplay.error
+        ),
+        'capturedSeconds': capturedDuration,
+        'replaySeconds': replayDuration,
+        'commands': {},
+    }
+
+    for command, (original, replayed) in sorted(commands.items()):
+        original.sort()
+        replayed.sort()
+
+        results['commands'][command] = {
+            'count': len(replayed),
+            'originalP50Ms': None if not original else percentile(original, 0.5) * 1000,
+            'originalP99Ms': None if not original else percentile(original, 0.99) * 1000,
+            'replayP50Ms': percentile(replayed, 0.5) * 1000,
+            'replayP99Ms': percentile(replayed, 0.99) * 1000,
+        }
+
+    for sessionReplay in replays:
+        if sessionReplay.error:
+            print(f'Connection {sessionReplay.capturedConnection.address} failed to replay: {sessionReplay.error!r}')
+
+    return results
+
+def printResults(results):
+    print(
+        f'Replayed {results["sessions"]} connections against a {results["mode"]} server at speed {results["speed"]:g}: '
+        f'{results["capturedSeconds"]:.1f}s captured, {results["replaySeconds"]:.1f}s to replay, '
+        f'{results["failedSessions"]} failed, {results["failedLogins"]} never logged in'
+    )
+    print(f'{"command":<10}{"count":>8}{"orig p50":>11}{"replay p50":>12}{"change":>9}{"orig p99":>11}{"replay p99":>12}{"change":>9}')
+
+    for command, stats in results['commands'].items():
+        originalP50 = None if stats['originalP50Ms'] is None else stats['originalP50Ms'] / 1000
+        originalP99 = None if stats['originalP99Ms'] is None else stats['originalP99Ms'] / 1000
+        replayP50 = stats['replayP50Ms'] / 1000
+        replayP99 = stats['replayP99Ms'] / 1000
+
+        print(
+            f'{command:<10}{stats["count"]:>8}{formatMs(originalP50):>11}{formatMs(replayP50):>12}{formatChange(originalP50, replayP50):>9}'
+            f'{formatMs(originalP99):>11}{formatMs(replayP99):>12}{formatChange(originalP99, replayP99):>9}'
+        )
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Replay captured client traffic against a fresh server.')
+    parser.add_argument('captures', nargs='+', help='capture files, e.g. the files of every worker of one run')
+    parser.add_argument('--mode', choices=('threaded', 'async', 'workers'), default='threaded', help='server mode')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 1 for the original pace, 0 for as fast as possible')
+    parser.add_argument('--credentials', help='credentials.txt with the accounts of the captured run')
+    parser.add_argument('--journal', help='message journal to start the server with, e.g. a copy taken when the capture started')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for an answer before giving up on a connection')
+    parser.add_argument('--json', metavar='PATH', help='write the results to PATH as JSON')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+
+    results = replay(options)
+
+    if results:
+        printResults(results)
+
+        if options.json:
+            with open(options.json, 'w') as resultsFile:
+                json.dump(results, resultsFile, indent=2)
@@ -0,0 +1,98 @@
+'''
+Benchmark for the server side of receiving and dispatching client requests.
+Streams a mix of requests over a local socket pair and reports requests/sec for the version 1 text requests and the
+version 2 binary requests, with each request looked up in ServerConnection.dispatchTable and its arity checked. The
+requests are encoded before the clock starts, since that is the client's work. The first row checks arity with
+inspect.signature on every request, which is what the server did before the dispatch table, for comparison.
+'''
+
+import sys
+import os
+import time
+import socket
+import threading
+from inspect import signature
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(parentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from protocol.protocol import Protocol, encodeFrame, encodeTextRequest, encodeBinaryRequest
+from ServerConnection import ServerConnection
+
+# (command, args) of the requests sent, in turn
+requestMix = [
+    ('MSG', ('hello everyone, this is a chat message of a typical length',)),
+    ('RDM', ('18 Oct 2026 10:00:00',)),
+    ('EDT', ('12', '18 Oct 2026 10:00:00', 'an edited chat message')),
+    ('DLT', ('12', '18 Oct 2026 10:00:00')),
+    ('ATU', ()),
+]
+
+'''
+Check a request's arity the way the server did before the dispatch table
+'''
+def signatureArityCheck(command, args):
+    handler = ServerConnection.dispatchTable[command][0]
+    parameters = list(signature(handler).parameters.values())[1:]
+    minArgs = sum(1 for parameter in parameters if parameter.default is parameter.empty)
+
+    return minArgs <= len(args) <= len(parameters)
+
+def tableArityCheck(command, args):
+    _, minArgs, maxArgs = ServerConnection.dispatchTable[command]
+
+    return minArgs <= len(args) <= maxArgs
+
+'''
+Send count requests in the given version and receive and check them on the other end of a socket pair. Returns the
+elapsed time in seconds
+'''
+def runCase(protocolVersion, arityCheck, count):
+    senderSocket, receiverSocket = socket.socketpair()
+    receiver = Protocol(receiverSocket, 'receiver', 0)
+    receiver.protocolVersion = protocolVersion
+
+    if protocolVersion == 1:
+        encodedMix = [encodeFrame(encodeTextRequest(*request)) for request in requestMix]
+    else:
+        encodedMix = [encodeBinaryRequest(*request) for request in requestMix]
+
+    stream = b''.join(encodedMix) * (count // len(requestMix)) + b''.join(encodedMix[:count % len(requestMix)])
+
+    def sendAll():
+        senderSocket.sendall(stream)
+
+    senderThread = threading.Thread(target=sendAll, name='BenchmarkSender')
+
+    start = time.perf_counter()
+    senderThread.start()
+
+    for _ in range(count):
+        command, args, _ = receiver.recvRequest()
+        assert arityCheck(command, args), f'{command} failed its arity check'
+
+    elapsed = time.perf_counter() - start
+    senderThread.join()
+
+    senderSocket.close()
+    receiverSocket.close()
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    cases = [
+        ('v1 text, signature per request', 1, signatureArityCheck),
+        ('v1 text, dispatch table', 1, tableArityCheck),
+        ('v2 binary, dispatch table', 2, tableArityCheck),
+    ]
+
+    print(f'{"requests":<36}{"count":>10}{"requests/sec":>16}')
+
+    for label, protocolVersion, arityCheck in cases:
+        elapsed = runCase(protocolVersion, arityCheck, count)
+        print(f'{label:<36}{count:>10}{count / elapsed:>16,.0f}')
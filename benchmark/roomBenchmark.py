@@ -0,0 +1,112 @@
+'''
+Benchmark for writes spread over rooms.
+Concurrent posters post messages into rooms in a temporary directory, each room a MessageStore with its own journal
+and reader-writer lock, as the server opens them. The posters are spread evenly over the rooms, so the row with one
+room is every poster sharing one store, as before rooms. Reports posts/sec and post latency for each number of rooms
+and journal durability mode.
+
+Posts to one store already share fsyncs through group commit, see journalWriter.py. With more rooms there are more
+journals to fsync at once, and posters only contend on the lock of their own room.
+
+Examples, from the repository root:
+    python3 benchmark/roomBenchmark.py
+    python3 benchmark/roomBenchmark.py --posters 64 --rooms 1,4,16 --durability fsync
+'''
+
+import sys
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from messageStore import MessageStore
+from metrics import InstrumentedReadWriteLock
+from journalWriter import durabilityModes
+
+timestamp = '01 Jan 2024 00:00:00'
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+'''
+Run posters threads, poster i posting postsPerPoster messages to room i % roomCount. Returns posts/sec, the sorted
+post latencies and the fraction of lock acquisitions that had to wait
+'''
+def runRooms(directory, roomCount, durability, posters, postsPerPoster):
+    stores = []
+    locks = []
+
+    for room in range(roomCount):
+        roomDirectory = os.path.join(directory, f'{durability}-{roomCount}', f'room{room}')
+        os.makedirs(roomDirectory)
+
+        lock = InstrumentedReadWriteLock(f'messagelog.room{room}')
+        store = MessageStore(os.path.join(roomDirectory, 'messagejournal.txt'), lock, durability, fsyncInterval=1.0)
+        store.load()
+
+        stores.append(store)
+        locks.append(lock)
+
+    latencies = []
+
+    def poster(index):
+        store = stores[index % roomCount]
+        username = f'user{index}'
+        postLatencies = []
+
+        for messageIndex in range(postsPerPoster):
+            start = time.perf_counter()
+            store.post(timestamp, username, f'room benchmark message {messageIndex}')
+            postLatencies.append(time.perf_counter() - start)
+
+        latencies.extend(postLatencies)
+
+    threads = [threading.Thread(target=poster, args=(index,)) for index in range(posters)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for store in stores:
+        store.close()
+
+    latencies.sort()
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+
+    return len(latencies) / elapsed, latencies, contended / acquisitions if acquisitions else 0
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Compare post throughput with the posters in one room and spread over many.')
+    parser.add_argument('--posters', type=int, default=32, help='posting threads')
+    parser.add_argument('--posts', type=int, default=300, help='posts per poster')
+    parser.add_argument('--rooms', default='1,2,4,8', help='comma separated numbers of rooms to spread the posters over')
+    parser.add_argument('--durability', choices=durabilityModes, action='append', help='journal durability modes to run, default all')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+    roomCounts = [int(roomCount) for roomCount in options.rooms.split(',')]
+
+    print(f'{options.posters} posters x {options.posts} posts')
+    print(f'{"durability":<12}{"rooms":>6}{"posts/sec":>12}{"p50 ms":>10}{"p99 ms":>10}{"lock waited":>13}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for durability in options.durability or durabilityModes:
+            for roomCount in roomCounts:
+                postsPerSecond, latencies, waited = runRooms(directory, roomCount, durability, options.posters, options.posts)
+
+                print(
+                    f'{durability:<12}{roomCount:>6}{postsPerSecond:>12,.0f}'
+                    f'{percentile(latencies, 0.5) * 1000:>10.2f}{percentile(latencies, 0.99) * 1000:>10.2f}{waited:>12.0%}'
+                )
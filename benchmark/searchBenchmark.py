@@ -0,0 +1,213 @@
+'''
+Benchmark for SRH, message search through the inverted index.
+Writes a journal of the given number of messages into a temporary directory, with words drawn from a Zipf-like
+vocabulary so a few words are very common and most are rare, and every 50th message edited and every 50th deleted.
+Loads a MessageStore from it and times building its search index, which the server does in the background after
+loading, then times searches of each kind in queryKinds and reports p50/p99 latency and the average number of matches.
+The baseline row times what a search cost before: reading the whole history with RDM and matching every message.
+
+Examples, from the repository root:
+    python3 benchmark/searchBenchmark.py
+    python3 benchmark/searchBenchmark.py 100000 --queries 500
+'''
+
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import resource
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from messageStore import MessageStore, timestampFormat
+from searchIndex import splitWords
+
+vocabularySize = 50000
+userCount = 1000
+firstPost = datetime.datetime(2024, 1, 1)
+
+syllables = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'po', 'da', 'gu', 'be', 'fi', 'ho', 'ja')
+
+'''
+A distinct made up word for each rank of the vocabulary
+'''
+def vocabularyWord(rank):
+    word = ''
+
+    while True:
+        rank, syllable = divmod(rank, len(syllables))
+        word += syllables[syllable]
+
+        if not rank:
+            return word
+
+'''
+Random words with a Zipf-like distribution, the word of rank r being drawn about 1 / (r + 1) as often as the most
+common one
+'''
+class WordSource:
+    def __init__(self, generator):
+        self.generator = generator
+        self.vocabulary = [vocabularyWord(rank) for rank in range(vocabularySize)]
+        self.weights = [1 / (rank + 1) for rank in range(vocabularySize)]
+
+    def words(self, count):
+        return self.generator.choices(self.vocabulary, cum_weights=self._cumulativeWeights(), k=count)
+
+    def _cumulativeWeights(self):
+        if not hasattr(self, '_cumulative'):
+            total = 0
+            self._cumulative = []
+            for weight in self.weights:
+                total += weight
+                self._cumulative.append(total)
+
+        return self._cumulative
+
+def writeJournal(path, messageCount, wordSource, generator):
+    with open(path, 'w') as journal:
+        for messageId in range(1, messageCount + 1):
+            timestamp = (firstPost + datetime.timedelta(seconds=messageId)).strftime(timestampFormat)
+            username = f'user{generator.randrange(userCount)}'
+            message = ' '.join(wordSource.words(generator.randint(3, 15)))
+            events = [['MSG', messageId, timestamp, username, message]]
+
+            if messageId % 50 == 10:
+                events.append(['EDT', messageId, timestamp, ' '.join(wordSource.words(generator.randint(3, 15)))])
+            elif messageId % 50 == 30:
+                events.append(['DLT', messageId])
+
+            journal.write(''.join(json.dumps(event) + '\n' for event in events))
+
+'''
+The kinds of query timed, each a function of a random generator, the vocabulary and the message count that returns
+the search args (query, username, since, until)
+'''
+def recentRange(generator, messageCount, seconds):
+    until = firstPost + datetime.timedelta(seconds=messageCount)
+    return until - datetime.timedelta(seconds=seconds), until
+
+queryKinds = {
+    'common word': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(10)], None, None, None),
+    'mid word': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(100, 1000)], None, None, None),
+    'rare word': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(20000, vocabularySize)], None, None, None),
+    'two common words': lambda generator, vocabulary, messageCount: (
+        f'{vocabulary[generator.randrange(10)]} {vocabulary[generator.randrange(10, 100)]}', None, None, None),
+    'rare and common word': lambda generator, vocabulary, messageCount: (
+        f'{vocabulary[generator.randrange(10)]} {vocabulary[generator.randrange(20000, vocabularySize)]}', None, None, None),
+    'common word, user': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(10)], f'user{generator.randrange(userCount)}', None, None),
+    'common word, last day': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(10)], None, *recentRange(generator, messageCount, 86400)),
+    'mid word, first day': lambda generator, vocabulary, messageCount: (
+        vocabulary[generator.randrange(100, 1000)], None, firstPost, firstPost + datetime.timedelta(days=1)),
+    'no such word': lambda generator, vocabulary, messageCount: (
+        f'missing{generator.randrange(1000)}', None, None, None),
+}
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+def maxRssMb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+'''
+Search the way clients had to before SRH: read every message with RDM and keep those that match
+'''
+def scanSearch(store, query, username, since, until, limit):
+    words = splitWords(query)
+    messages, _ = store.messagesSince(datetime.datetime(1970, 1, 1))
+    matches = []
+
+    for message in messages:
+        _, timestamp, messageUsername, text, _ = message
+        if username is not None and messageUsername != username:
+            continue
+        if words <= splitWords(text):
+            matches.append(message)
+
+    return matches[-limit:]
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Time SRH searches through the inverted index.')
+    parser.add_argument('messages', type=int, nargs='?', default=1000000, help='messages in the store')
+    parser.add_argument('--queries', type=int, default=200, help='searches of each kind to time')
+    parser.add_argument('--limit', type=int, default=100, help='matches listed by each search')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+    generator = random.Random(options.seed)
+    wordSource = WordSource(generator)
+
+    with tempfile.TemporaryDirectory() as directory:
+        journalPath = os.path.join(directory, 'messagejournal.txt')
+
+        print(f'Writing {options.messages} messages...')
+        writeJournal(journalPath, options.messages, wordSource, generator)
+
+        store = MessageStore(journalPath, threading.Lock(), 'buffered')
+
+        loadStart = time.perf_counter()
+        store.load()
+        loadTime = time.perf_counter() - loadStart
+
+        rssBefore = maxRssMb()
+
+        buildStart = time.perf_counter()
+        store.buildSearchIndex()
+        buildTime = time.perf_counter() - buildStart
+
+        indexMb = maxRssMb() - rssBefore
+
+        print(
+            f'{store.count()} messages loaded from the journal in {loadTime:.1f}s. The search index of them builds in '
+            f'{buildTime:.1f}s and takes about {indexMb:.0f} MB'
+        )
+        print(f'{"query":<24}{"matches":>10}{"p50 ms":>10}{"p99 ms":>10}')
+
+        for kind, makeQuery in queryKinds.items():
+            latencies = []
+            matchCount = 0
+
+            for _ in range(options.queries):
+                query, username, since, until = makeQuery(generator, wordSource.vocabulary, options.messages)
+
+                start = time.perf_counter()
+                messages, _ = store.search(query, username, since, until, options.limit)
+                latencies.append(time.perf_counter() - start)
+
+                matchCount += len(messages)
+
+            latencies.sort()
+            print(
+                f'{kind:<24}{matchCount / options.queries:>10.1f}'
+                f'{percentile(latencies, 0.5) * 1000:>10.3f}{percentile(latencies, 0.99) * 1000:>10.3f}'
+            )
+
+        # A full scan takes seconds at a million messages, so it is timed a few times only
+        scanLatencies = []
+        for _ in range(3):
+            query, username, since, until = queryKinds['rare word'](generator, wordSource.vocabulary, options.messages)
+
+            start = time.perf_counter()
+            scanSearch(store, query, username, since, until, options.limit)
+            scanLatencies.append(time.perf_counter() - start)
+
+        scanLatencies.sort()
+        print(f'{"baseline: RDM and scan":<24}{"":>10}{percentile(scanLatencies, 0.5) * 1000:>10.1f}{scanLatencies[-1] * 1000:>10.1f}')
+
+        store.close()
@@ -0,0 +1,122 @@
+'''
+Benchmark for loading the message store at server startup.
+Writes a journal of the given number of posts, with some of them edited and deleted, into a temporary directory and
+times MessageStore.load from the whole journal, from a snapshot of the store and the last tailEvents events of the
+journal, and from a snapshot with nothing after it. Also times rendering the snapshot, which the server does in the
+background.
+'''
+
+import sys
+import os
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+
+currentDir = os.path.dirname(os.path.realpath(__file__))
+parentDir = os.path.dirname(currentDir)
+sys.path.append(os.path.join(parentDir, 'server'))
+
+from messageStore import MessageStore, timestampFormat
+
+# Events journaled after the snapshot, as after a crash between snapshots
+tailEvents = 1000
+
+'''
+Journal events of messageCount posts, one a second, with every 20th post edited and every 20th deleted. Message ids
+start at firstId
+'''
+def journalEvents(messageCount, firstId=1):
+    start = datetime.datetime(2024, 1, 1)
+    events = []
+
+    for index in range(messageCount):
+        messageId = firstId + index
+        timestamp = (start + datetime.timedelta(seconds=messageId)).strftime(timestampFormat)
+        events.append(['MSG', messageId, timestamp, f'user{index % 50}', f'startup benchmark message number {messageId}'])
+
+        if index % 20 == 5:
+            events.append(['EDT', messageId, timestamp, f'edited startup benchmark message number {messageId}'])
+        elif index % 20 == 15:
+            events.append(['DLT', messageId])
+
+    return events
+
+def writeJournal(path, events, mode='w'):
+    with open(path, mode) as journal:
+        journal.write(''.join(json.dumps(event) + '\n' for event in events))
+
+'''
+Load a store from the journal at journalPath, and the snapshot at snapshotPath if given. Returns the seconds it took,
+the number of events replayed and the store
+'''
+def timeLoad(journalPath, snapshotPath=None):
+    store = MessageStore(journalPath, threading.Lock(), 'buffered')
+
+    start = time.perf_counter()
+    replayed = store.load(snapshotPath=snapshotPath)
+    elapsed = time.perf_counter() - start
+
+    store.close()
+
+    return elapsed, replayed, store
+
+def benchmark(directory, messageCount):
+    journalPath = os.path.join(directory, 'messagejournal.txt')
+    snapshotPath = os.path.join(directory, 'messagesnapshot.bin')
+    tailPosts = tailEvents * 20 // 21
+
+    # Snapshot the store as it was before the tail was journaled
+    writeJournal(journalPath, journalEvents(messageCount - tailPosts))
+    _, _, store = timeLoad(journalPath)
+
+    renderStart = time.perf_counter()
+    snapshot = store.renderSnapshot()
+    renderTime = time.perf_counter() - renderStart
+
+    with open(snapshotPath, 'wb') as snapshotFile:
+        snapshotFile.write(snapshot)
+
+    writeJournal(journalPath, journalEvents(tailPosts, firstId=messageCount - tailPosts + 1), 'a')
+
+    fullTime, fullReplayed, fullStore = timeLoad(journalPath)
+    tailTime, tailReplayed, tailStore = timeLoad(journalPath, snapshotPath)
+    assert tailStore.exportMessagelog() == fullStore.exportMessagelog(), 'Snapshot and journal loads differ'
+
+    # A snapshot taken at shutdown covers the whole journal
+    with open(snapshotPath, 'wb') as snapshotFile:
+        snapshotFile.write(tailStore.renderSnapshot())
+
+    snapshotTime, snapshotReplayed, _ = timeLoad(journalPath, snapshotPath)
+
+    return {
+        'journalMb': os.path.getsize(journalPath) / (1024 * 1024),
+        'snapshotMb': os.path.getsize(snapshotPath) / (1024 * 1024),
+        'rows': [
+            ('whole journal', fullReplayed, fullTime),
+            ('snapshot + journal tail', tailReplayed, tailTime),
+            ('snapshot only', snapshotReplayed, snapshotTime),
+            ('render snapshot', 0, renderTime),
+        ],
+    }
+
+
+if __name__ == '__main__':
+    messageCounts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+
+    print(f'{"messages":>10}{"load":>26}{"events replayed":>18}{"seconds":>10}')
+
+    for messageCount in messageCounts:
+        directory = tempfile.mkdtemp(prefix='toom-startup-')
+
+        try:
+            results = benchmark(directory, messageCount)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        for label, replayed, elapsed in results['rows']:
+            print(f'{messageCount:>10}{label:>26}{replayed:>18}{elapsed:>10.3f}')
+
+        print(f'{"":>10}journal {results["journalMb"]:.1f} MB, snapshot {results["snapshotMb"]:.1f} MB')
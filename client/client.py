@@ -5,10 +5,12 @@ Client executable
 import sys
 import os
 import socket
+import bisect
 import threading
 import queue
 
 import clientSettings
+import fileTransfer
 
 currentDir = os.path.dirname(os.path.realpath(__file__))
 parentDir = os.path.dirname(currentDir)
@@ -34,18 +36,39 @@ def login():
     global clientUsername
     clientUsername = username
 
-    clientConnection.sendMessage(username)
+    # Offer the newest request version along with the username. Only servers that know request versions can parse
+    # the offer, so it is only made when a version above 1 is configured
+    clientConnection.sendMessage(username, {'Protocol': clientSettings.protocolVersion} if clientSettings.protocolVersion > 1 else None)
     clientConnection.sendMessage(password)
 
-    loginResult = clientConnection.recvMessage()
+    headers, loginResult = clientConnection.recvFrame()
 
     print(loginResult)
+
+    # The server closes the connection after a rejection, e.g. when it is full
+    if 'Rejected' in headers:
+        clientSocket.close()
+        sys.exit()
     
     if loginResult == 'Welcome to TOOM!':
+        clientConnection.protocolVersion = int(headers.get('Protocol', 1))
         return True
     else:
         return False
 
+'''
+Ask the server to compress large responses. Servers that do not support the encoding reply with an error and
+the connection stays uncompressed
+'''
+def negotiateEncoding():
+    if not clientSettings.contentEncoding:
+        return
+
+    clientConnection.sendRequest('ENC', (clientSettings.contentEncoding,))
+
+    if clientConnection.recvMessage().startswith('Encoding set to'):
+        clientConnection.contentEncoding = clientSettings.contentEncoding
+
 '''
 Extract address for username from active users (ATU) response from server
 '''
@@ -61,86 +84,192 @@ def getAtuAddr(username):
             return lineAddrName, int(lineAddrPort)
 
 '''
-Upload file via UDP packets to username
+Upload file to username, over the reliable UDP transfer or the TCP peer channel depending on transferChannel
 '''
 def upload(addr, filename):
-    udpSocket.sendto(f'{clientUsername}; {filename}'.encode('utf-8'), addr)
-    
-    with open(f'{filename}', 'rb') as file:
-        data = file.read(udpPacketSize)
-        while data:
-            udpSocket.sendto(data, addr)
-            data = file.read(udpPacketSize)
+    if not os.path.isfile(filename):
+        print(f'\n{filename} does not exist.\n{commandPrompt}', end='')
+        return
 
-    print(f'\n{filename} has been uploaded.\nEnter one of the following commands (MSG, DLT, EDT, RDM, ATU, OUT, UPD): ', end='')
+    if clientSettings.transferChannel == 'tcp':
+        ok = fileEndpoint.uploadTcp(addr, filename, f'{clientUsername}; {filename}')
+    else:
+        ok = fileEndpoint.upload(addr, filename, f'{clientUsername}; {filename}').ok
+
+    if ok:
+        print(f'\n{filename} has been uploaded.\n{commandPrompt}', end='')
+    else:
+        print(f'\nFailed to upload {filename}.\n{commandPrompt}', end='')
+
+'''
+Report a file received from another user
+'''
+def fileReceived(username, filename, ok):
+    if ok:
+        print(f'\nReceived {filename} from {username}.\n{commandPrompt}', end='')
+    else:
+        print(f'\nFailed to receive {filename} from {username}.\n{commandPrompt}', end='')
 
 '''
-Receive UDP packets and demultiplex based on address
+Receive frames from the server. Live events are printed as they arrive and command responses are handed to the
+main thread through responseQueue
 '''
-def fileRecv():
+def serverRecv():
     while True:
-        # Exit thread when client logs out
         try:
-            data, addr = udpSocket.recvfrom(udpPacketSize)
-        except socket.timeout:
-            if not loggedIn:
-                return
-            else:
-                continue
+            headers, message = clientConnection.recvFrame()
+        except OSError:
+            # Connection closed, e.g. after logging out
+            responseQueue.put(None)
+            return
+
+        if 'Event' in headers:
+            printEvent(headers, message)
+        else:
+            responseQueue.put((headers, message))
 
-        if addr not in recvBufferDict:
-            buffer = queue.Queue(0)
-            recvBufferDict[addr] = buffer
-
-            decodedDataPacket = data.decode('utf-8')
-            
-            if decodedDataPacket.isprintable():
-                split = decodedDataPacket.split('; ')
-                if len(split) == 2:
-                    username = split[0]
-                    filename = split[1]
-            else:
-                username = ''
-                filename = ''
-                recvBufferDict[addr].put(data)
-        
-            writeDataThread = threading.Thread(target=writeData, name='WriteData', args=(addr, username, filename), daemon=True)
-            writeDataThread.start()
+'''
+Wait for the response to a command. The frames of a streamed response are printed as they arrive, or added to
+pages if given, and the last one is returned. Returns None if the connection was lost
+'''
+def recvResponse(pages=None):
+    while True:
+        frame = responseQueue.get()
+
+        if frame is None:
+            return None
+
+        headers, response = frame
+
+        if 'More' not in headers:
+            return response
+
+        if pages is None:
+            print(response, end='')
         else:
-            recvBufferDict[addr].put(data)
+            pages.append(response)
 
 '''
-Read data from buffer and write into file
+Print a live event pushed by the server
 '''
-def writeData(addr, username, filename):
-    if username == '' or filename == '':
-        print('Failed to receive username or filename properly')
-        username = 'generic_username'
-        filename = 'generic_filename'
-    
-    fullFilename = username + '_' + filename
-
-    with open(f'{fullFilename}', 'wb') as file:
-        while True:
-            # Uses a timer to detect end of file, by default recvBufferTimeout = 4
-            try:
-                data = recvBufferDict[addr].get(block=True, timeout=recvBufferTimeout)
-            except queue.Empty:
-                recvBufferDict.pop(addr)
-                break
+def printEvent(headers, event):
+    kind, messageNumber, timestamp, username, message = event.split('; ', 4)
 
-            file.write(data)
-    
-    print(f'\nReceived {filename} from {username}.\nEnter one of the following commands (MSG, DLT, EDT, RDM, ATU, OUT, UPD): ', end='')
-    
+    if kind == 'DLT':
+        eventStr = f'#{messageNumber} {username}: "{message}" was deleted'
+    else:
+        editOrPost = 'edited' if kind == 'EDT' else 'posted'
+        eventStr = f'#{messageNumber} {username}: "{message}", {editOrPost} at {timestamp}'
+
+    if 'Room' in headers:
+        eventStr = f'[{headers["Room"]}] {eventStr}'
 
+    if 'Dropped' in headers:
+        eventStr = f'({headers["Dropped"]} live messages were dropped)\n{eventStr}'
+
+    print(f'\n{eventStr}\n{commandPrompt}', end='')
+
+'''
+Update the message cache from the frames of a SYN response and describe what changed, numbering messages as they
+are numbered now. A response without a sync token is an error and is returned as it is
+'''
+def applySync(frames):
+    global syncToken
+
+    lines = ''.join(frames).splitlines()
+    if not lines or not lines[-1].startswith('Sync: '):
+        return ''.join(frames)
+
+    # Last change of each message id in the response, and the messages it deleted
+    changed = {}
+    deleted = {}
+
+    for line in lines:
+        if line == 'Reset':
+            messageCache.clear()
+            cachedIds.clear()
+            changed.clear()
+            deleted.clear()
+            continue
+
+        if line.startswith('Sync: '):
+            syncToken = line[len('Sync: '):]
+            continue
+
+        kind, _, rest = line.partition('; ')
+
+        if kind == 'DLT':
+            messageId = int(rest)
+            record = messageCache.pop(messageId, None)
+
+            if record is not None:
+                del cachedIds[bisect.bisect_left(cachedIds, messageId)]
+                deleted[messageId] = record
+        else:
+            messageIdStr, timestamp, username, message = rest.split('; ', 3)
+            messageId = int(messageIdStr)
+
+            if messageId not in messageCache:
+                bisect.insort(cachedIds, messageId)
+
+            messageCache[messageId] = (timestamp, username, message, kind == 'EDT')
+
+        changed[messageId] = kind
+
+    descriptions = []
+
+    for messageId in changed:
+        if messageId in messageCache:
+            timestamp, username, message, edited = messageCache[messageId]
+            messageNumber = bisect.bisect_left(cachedIds, messageId) + 1
+            editOrPost = 'edited' if edited else 'posted'
+            descriptions.append(f'#{messageNumber} {username}: "{message}", {editOrPost} at {timestamp}')
+        elif messageId in deleted:
+            _, username, message, _ = deleted[messageId]
+            descriptions.append(f'{username}: "{message}" was deleted')
+
+    return '\n'.join(descriptions) if descriptions else 'no new change'
+
+'''
+Split a request typed by the user into its command and args
+'''
+def splitRequest(request):
+    command, separator, argStr = request.partition('; ')
+
+    if not separator:
+        return command, ()
+
+    # The free text arg is kept whole, with any '; ' in it
+    return command, tuple(argStr.split('; ', freeTextArgs.get(command, 0) - 1))
+
+'''
+Read the commands of a batch, one per line until an empty line. Returns the (command, args) pairs of the commands
+'''
+def readBatch():
+    print('Enter one command per line, then an empty line to send the batch:')
+
+    subRequests = []
+    while True:
+        subRequest = input('> ')
+        if subRequest == '':
+            break
+        subRequests.append(splitRequest(subRequest))
+
+    return subRequests
+
+# Number of args of commands whose last arg is free text. Only version 2 requests can carry '; ' in it
+freeTextArgs = {'MSG': 1, 'EDT': 3}
+
+commandPrompt = 'Enter one of the following commands (MSG, DLT, EDT, RDM, RDS, SYN, SRH, JOIN, LEAVE, ROOMS, ATU, SUB, BATCH, OUT, UPD): '
 atu = ''
+# Messages kept up to date by SYN, as (timestamp, username, message, edited) keyed by message id, the cached ids in
+# order, so a message's number is its position, and the token to sync from next
+messageCache = {}
+cachedIds = []
+syncToken = ''
 loggedIn = False
 clientUsername = ''
-recvBufferLock = threading.Lock()
-recvBufferDict = {}
-recvBufferTimeout = 4
-udpPacketSize = 1024
+responseQueue = queue.Queue()
 
 if __name__ == '__main__':
     if len(sys.argv) != 4:
@@ -166,15 +295,29 @@ if __name__ == '__main__':
     udpSocket.settimeout(2)
 
     # Start UDP file receiving thread
-    fileRecvThread = threading.Thread(name='FileRecv', target=fileRecv)
-    fileRecvThread.loggedIn = True
+    fileEndpoint = fileTransfer.FileTransferEndpoint(udpSocket, clientSettings.transferWindow, clientSettings.transferMtu,
+                                                     maxFileSize=clientSettings.maxReceiveFileSize)
+    fileEndpoint.onReceived = fileReceived
+    fileRecvThread = threading.Thread(name='FileRecv', target=fileEndpoint.serve)
     fileRecvThread.start()
 
+    # Start TCP file receiving thread, listening on the TCP port with the same number as the UDP port
+    tcpListenSocket = socket.create_server(('localhost', clientSettings.clientUDPPort))
+    tcpListenSocket.settimeout(2)
+    tcpFileRecvThread = threading.Thread(name='TcpFileRecv', target=fileEndpoint.serveTcp, args=(tcpListenSocket,), daemon=True)
+    tcpFileRecvThread.start()
+
     # Send listening UDP Port to server
     clientConnection.sendMessage(str(clientSettings.clientUDPPort))
 
+    negotiateEncoding()
+
+    # Start server receiving thread, which separates live events from command responses
+    serverRecvThread = threading.Thread(name='ServerRecv', target=serverRecv, daemon=True)
+    serverRecvThread.start()
+
     while True:
-        request = input('Enter one of the following commands (MSG, DLT, EDT, RDM, ATU, OUT, UPD): ')
+        request = input(commandPrompt)
         
         # Extract commnand and args from request
         requestPart = request.partition('; ')
@@ -201,9 +344,33 @@ if __name__ == '__main__':
             uploadThread = threading.Thread(target=upload, name='UploadThread', args=(addr, filename), daemon=True)
             uploadThread.start()
         else:
-            clientConnection.sendMessage(request)
-            
-            response = clientConnection.recvMessage()
+            if command == 'BATCH':
+                args = readBatch()
+            elif command == 'SYN':
+                args = (syncToken,) if syncToken else ()
+            else:
+                command, args = splitRequest(request)
+
+            clientConnection.sendRequest(command, args)
+
+            # The frames of a sync are applied to the message cache together
+            pages = [] if command == 'SYN' else None
+            response = recvResponse(pages)
+
+            if response is None:
+                print('Lost connection to the server.')
+
+                loggedIn = False
+
+                fileEndpoint.stop()
+                fileRecvThread.join()
+                udpSocket.close()
+                tcpListenSocket.close()
+                break
+
+            if command == 'SYN':
+                response = applySync(pages + [response])
+
             print(response)
 
             if command == 'OUT':
@@ -211,8 +378,10 @@ if __name__ == '__main__':
 
                 loggedIn = False
 
+                fileEndpoint.stop()
                 fileRecvThread.join()
                 udpSocket.close()
+                tcpListenSocket.close()
                 break
             elif command == 'ATU':
                 atu = response
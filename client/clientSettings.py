@@ -2,4 +2,24 @@
 
 serverName = 'localhost'
 serverPort = 12500
-clientUDPPort = 15000
\ No newline at end of file
+clientUDPPort = 15000
+# Newest request version to offer the server at login, see protocol.py. 1 sends requests as text and offers nothing.
+# Servers from before request versions cannot parse the header field the offer is made in and drop the connection,
+# so only set 2 for a server known to support it
+protocolVersion = 1
+
+# Compression to ask the server for after login, or None to keep every frame raw
+contentEncoding = 'zlib'
+
+# Maximum number of unacknowledged packets in flight during a file upload, and the path MTU that packets are
+# sized to fit
+transferWindow = 64
+transferMtu = 1500
+
+# Largest file accepted from another client, in bytes. The receiver allocates the whole file as soon as a transfer
+# starts, before the sender has proven anything, so this bounds the disk space a single peer can take
+maxReceiveFileSize = 1024 * 1024 * 1024
+
+# Channel used to upload files: 'udp' for the reliable UDP transfer, or 'tcp' to send the file over a TCP connection
+# to the peer with sendfile, which is much faster for large files on a reliable network
+transferChannel = 'udp'
@@ -0,0 +1,666 @@
+'''
+Reliable file transfer between clients over UDP.
+
+A transfer starts with a START packet carrying the file size, chunk size and name, which the receiver answers with
+an ACK. The file is then sent as sequence numbered DATA packets, with up to a window of them in flight. The receiver
+acknowledges with the next sequence number it is missing plus a bitmap of the packets it already has after that
+one (a selective ACK), so the sender only resends what was lost. A packet is resent when it has not been acked
+within the retransmission timeout, which tracks the measured round trip time, or straight away (once) when three later
+packets have been acked. Once every packet is acked, the sender sends a FIN with the SHA-256 of the whole file,
+and the receiver answers with a FINACK saying whether its copy matches.
+
+All packets start with a type byte and a random 32 bit transfer id, so several transfers can share one socket.
+
+The sender memory maps the file and sends slices of the mapping straight from the page cache, and the receiver
+preallocates the target file and writes each chunk at its offset as it arrives, straight out of the receive buffer.
+
+Files can also be sent over a TCP connection to the receiver's TCP port with the same number as its UDP port. The
+sender writes a header with the file size and name, then hands the file to the kernel with sendfile, and the
+receiver answers with a status byte once it has the whole file.
+'''
+
+import os
+import mmap
+import math
+import time
+import struct
+import random
+import shutil
+import socket
+import hashlib
+import threading
+
+# Packet types
+START = 1
+DATA = 2
+ACK = 3
+FIN = 4
+FINACK = 5
+
+# FINACK statuses
+TRANSFER_OK = 0
+CHECKSUM_MISMATCH = 1
+
+startHeader = struct.Struct('!BIQI') # type, transfer id, file size, chunk size, followed by '<username>; <filename>'
+dataHeader = struct.Struct('!BII') # type, transfer id, sequence number, followed by the chunk
+ackHeader = struct.Struct('!BII') # type, transfer id, next missing sequence number, followed by the SACK bitmap
+finHeader = struct.Struct('!BII') # type, transfer id, number of packets, followed by the SHA-256 of the file
+finAckHeader = struct.Struct('!BIB') # type, transfer id, status
+tcpHeader = struct.Struct('!QH') # file size, name length, followed by '<username>; <filename>'
+packetType = struct.Struct('!BI') # type and transfer id, common to every packet
+
+# Bytes taken by the IP and UDP headers, which count towards the MTU along with the packet
+ipUdpOverhead = 28
+
+# Largest possible UDP datagram
+maxDatagramSize = 65507
+
+# Bounds of the retransmission timeout in seconds
+initialRto = 0.5
+minRto = 0.02
+maxRto = 2.0
+
+# A transfer fails if one packet has to be sent this many times
+maxSendAttempts = 12
+
+# The receiver acks every ackEvery in order packets, and straight away for anything out of order
+ackEvery = 4
+
+# A packet is resent without waiting for its timeout once this many later packets have been acked
+fastRetransmitThreshold = 3
+
+# A transfer that has not received a packet for this many seconds is abandoned
+idleTimeout = 15.0
+
+# Size of the buffer a TCP transfer is received into
+tcpRecvBufferSize = 1024 * 1024
+
+# Default largest file accepted from a peer, and most packets an incoming UDP transfer may be split into, since the
+# receiver preallocates the file and keeps a flag per packet
+maxReceiveFileSize = 1024 * 1024 * 1024
+maxReceivePackets = 64 * 1024 * 1024
+
+# Disk space that must still be free in the receive directory after an incoming file is preallocated
+minFreeDiskSpace = 256 * 1024 * 1024
+
+'''
+Size of the chunk of file data in each DATA packet, so that the whole datagram fits in an MTU sized IP packet
+'''
+def chunkSizeForMtu(mtu):
+    return max(1, min(mtu, maxDatagramSize + ipUdpOverhead) - ipUdpOverhead - dataHeader.size)
+
+'''
+Create the file at path for writing at offsets, with space for size bytes allocated up front so the file system
+does not have to grow it chunk by chunk. Returns the file descriptor
+'''
+def openPreallocated(path, size):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+
+    try:
+        if size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    except OSError:
+        # Not every file system supports fallocate
+        os.ftruncate(fd, size)
+
+    return fd
+
+'''
+Write data to the file at offset, without moving the file position
+'''
+def writeAt(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+'''
+Receive exactly size bytes from a TCP socket. Raises ConnectionError if the connection closes first
+'''
+def recvExactly(tcpSocket, size):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = tcpSocket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed during file transfer')
+        data += chunk
+
+    return bytes(data)
+
+class Sender:
+    def __init__(self, udpSocket, addr, path, name, window, chunkSize):
+        self.addr = addr
+        self.transferId = random.getrandbits(32)
+        self.ok = False
+        self.packetsSent = 0
+        self.retransmits = 0
+        self._socket = udpSocket
+        self._path = path
+        self._name = name
+        self._window = window
+        self._chunkSize = chunkSize
+        self._condition = threading.Condition(threading.Lock())
+        self._started = False
+        self._finStatus = None
+        # Lowest unacked sequence number, and the next one that has never been sent
+        self._base = 0
+        self._nextSeq = 0
+        # Send time and number of sends of each unacked packet that has been sent
+        self._inFlight = {}
+        self._sendCounts = {}
+        self._highestSacked = -1
+        self._fastRetransmitted = set()
+        self._srtt = None
+        self._rttvar = None
+        self._rto = initialRto
+        self._hasher = hashlib.sha256()
+
+    '''
+    Send the file. Returns True once the receiver has confirmed that its copy matches
+    '''
+    def run(self):
+        with open(self._path, 'rb') as file:
+            fileSize = os.fstat(file.fileno()).st_size
+            self._total = math.ceil(fileSize / self._chunkSize)
+
+            # An empty file cannot be mapped, but has no chunks to send either
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if fileSize else b''
+            self._data = memoryview(mapping)
+
+            try:
+                start = startHeader.pack(START, self.transferId, fileSize, self._chunkSize) + self._name.encode('utf-8')
+                if not self._exchange(start, lambda: self._started):
+                    return False
+
+                if not self._sendData():
+                    return False
+            finally:
+                self._data.release()
+                if fileSize:
+                    mapping.close()
+
+        fin = finHeader.pack(FIN, self.transferId, self._total) + self._hasher.digest()
+        if not self._exchange(fin, lambda: self._finStatus is not None):
+            return False
+
+        return self._finStatus == TRANSFER_OK
+
+    '''
+    Handle an ACK or FINACK from the receiver. Called on the endpoint's receiving thread
+    '''
+    def onPacket(self, packet):
+        kind = packet[0]
+
+        with self._condition:
+            if kind == ACK:
+                self._onAck(packet)
+            elif kind == FINACK:
+                _, _, self._finStatus = finAckHeader.unpack_from(packet)
+
+            self._condition.notify()
+
+    def _onAck(self, packet):
+        _, _, nextMissing = ackHeader.unpack_from(packet)
+        now = time.monotonic()
+        self._started = True
+
+        if nextMissing > self._base:
+            # Take a round trip sample from the newest packet acked, unless it was resent and the sample is ambiguous
+            newest = nextMissing - 1
+            if newest in self._inFlight and self._sendCounts.get(newest) == 1:
+                self._updateRto(now - self._inFlight[newest])
+
+            for seq in range(self._base, nextMissing):
+                self._inFlight.pop(seq, None)
+                self._sendCounts.pop(seq, None)
+                self._fastRetransmitted.discard(seq)
+
+            self._base = nextMissing
+
+        bitmap = packet[ackHeader.size:]
+        for index in range(len(bitmap) * 8):
+            if bitmap[index >> 3] & (1 << (index & 7)):
+                seq = nextMissing + 1 + index
+                if seq in self._inFlight:
+                    del self._inFlight[seq]
+                    self._highestSacked = max(self._highestSacked, seq)
+
+    def _updateRto(self, sample):
+        if self._srtt is None:
+            self._srtt = sample
+            self._rttvar = sample / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - sample)
+            self._srtt = 0.875 * self._srtt + 0.125 * sample
+
+        self._rto = min(maxRto, max(minRto, self._srtt + 4 * self._rttvar))
+
+    '''
+    Send a control packet until done() is true, backing off after each timeout. Returns False if the receiver
+    never answers
+    '''
+    def _exchange(self, packet, done):
+        timeout = self._rto
+
+        with self._condition:
+            for _ in range(maxSendAttempts):
+                self._socket.sendto(packet, self.addr)
+                self.packetsSent += 1
+
+                deadline = time.monotonic() + timeout
+                while not done():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if done():
+                    return True
+
+                timeout = min(maxRto, timeout * 2)
+
+        return False
+
+    '''
+    Send every DATA packet, keeping up to a window of them in flight. Returns False if a packet could not be
+    delivered
+    '''
+    def _sendData(self):
+        with self._condition:
+            while self._base < self._total:
+                now = time.monotonic()
+
+                # Holes are resent early, once, when enough later packets have arrived
+                for seq in range(self._base, self._highestSacked - fastRetransmitThreshold + 1):
+                    if seq in self._inFlight and seq not in self._fastRetransmitted:
+                        self._fastRetransmitted.add(seq)
+                        if not self._sendChunk(seq, now):
+                            return False
+
+                expired = [seq for seq, sentAt in self._inFlight.items() if sentAt + self._rto <= now]
+                if expired:
+                    # Back off, since a timeout suggests the path is congested or the estimate is too low
+                    self._rto = min(maxRto, self._rto * 2)
+                    for seq in expired:
+                        if not self._sendChunk(seq, now):
+                            return False
+
+                while self._nextSeq < self._total and self._nextSeq < self._base + self._window:
+                    self._sendChunk(self._nextSeq, now)
+                    self._nextSeq += 1
+
+                if self._base < self._total:
+                    nextExpiry = min(self._inFlight.values(), default=now) + self._rto
+                    self._condition.wait(max(0, nextExpiry - time.monotonic()))
+
+        return True
+
+    '''
+    Send (or resend) the DATA packet for seq. Returns False once the packet has been sent too many times
+    '''
+    def _sendChunk(self, seq, now):
+        sendCount = self._sendCounts.get(seq, 0) + 1
+        if sendCount > maxSendAttempts:
+            return False
+
+        with self._data[seq * self._chunkSize:(seq + 1) * self._chunkSize] as chunk:
+            if sendCount == 1:
+                # Chunks are first sent in order, so the file is hashed as it is sent
+                self._hasher.update(chunk)
+            else:
+                self.retransmits += 1
+
+            header = dataHeader.pack(DATA, self.transferId, seq)
+
+            # Scatter-gather send, so the chunk goes from the mapping to the socket without being copied
+            if hasattr(self._socket, 'sendmsg'):
+                self._socket.sendmsg([header, chunk], (), 0, self.addr)
+            else:
+                self._socket.sendto(header + chunk, self.addr)
+
+        self.packetsSent += 1
+        self._inFlight[seq] = now
+        self._sendCounts[seq] = sendCount
+
+        return True
+
+'''
+Whether an incoming transfer of fileSize bytes in chunkSize byte packets, of at most maxFileSize bytes, can be received
+'''
+def isAcceptableStart(fileSize, chunkSize, maxFileSize=maxReceiveFileSize):
+    if not 1 <= chunkSize <= maxDatagramSize - dataHeader.size:
+        return False
+
+    return fileSize <= maxFileSize and math.ceil(fileSize / chunkSize) <= maxReceivePackets
+
+'''
+Whether directory has room for a file of size bytes while keeping minFreeDiskSpace free
+'''
+def hasFreeSpace(directory, size):
+    try:
+        return shutil.disk_usage(directory).free - size >= minFreeDiskSpace
+    except OSError:
+        return False
+
+class Receiver:
+    def __init__(self, udpSocket, addr, transferId, fileSize, chunkSize, username, filename, path):
+        self.addr = addr
+        self.transferId = transferId
+        self.username = username
+        self.filename = filename
+        self.path = path
+        self.lastActivity = time.monotonic()
+        self._socket = udpSocket
+        self._chunkSize = chunkSize
+        self._total = math.ceil(fileSize / chunkSize)
+        self._fd = openPreallocated(path, fileSize)
+        # One flag per packet, so memory stays small even for very large files
+        self._received = bytearray(self._total)
+        self._nextMissing = 0
+        self._highestReceived = -1
+        self._unacked = 0
+        # Out of order chunks held until the chunks before them arrive, so the file can be hashed in order
+        self._hashPending = {}
+        self._hasher = hashlib.sha256()
+
+    '''
+    Handle a DATA packet. packet is a view of the endpoint's receive buffer, so it is only valid during the call
+    '''
+    def onData(self, packet):
+        _, _, seq = dataHeader.unpack_from(packet)
+        self.lastActivity = time.monotonic()
+
+        if seq >= self._total:
+            return
+
+        inOrder = seq == self._nextMissing
+
+        if not self._received[seq]:
+            chunk = packet[dataHeader.size:]
+            writeAt(self._fd, chunk, seq * self._chunkSize)
+            self._received[seq] = 1
+            self._highestReceived = max(self._highestReceived, seq)
+
+            if inOrder:
+                self._hasher.update(chunk)
+                self._nextMissing += 1
+
+                while self._nextMissing < self._total and self._received[self._nextMissing]:
+                    self._hasher.update(self._hashPending.pop(self._nextMissing))
+                    self._nextMissing += 1
+            else:
+                # Copied, since the receive buffer is reused for the next packet
+                self._hashPending[seq] = bytes(chunk)
+        else:
+            inOrder = False
+
+        self._unacked += 1
+        # Ack straight away when something is out of order or missing, so the sender can react quickly
+        if not inOrder or self._highestReceived >= self._nextMissing or self._unacked >= ackEvery or self._nextMissing == self._total:
+            self.sendAck()
+
+    def sendAck(self):
+        self._unacked = 0
+
+        # Bit i of the bitmap is set if packet nextMissing + 1 + i has been received
+        span = max(0, self._highestReceived - self._nextMissing)
+        bitmap = bytearray((span + 7) // 8)
+        for index in range(span):
+            if self._received[self._nextMissing + 1 + index]:
+                bitmap[index >> 3] |= 1 << (index & 7)
+
+        self._socket.sendto(ackHeader.pack(ACK, self.transferId, self._nextMissing) + bitmap, self.addr)
+
+    '''
+    Handle the FIN. Returns the FINACK status, or None if packets are still missing and the FIN is ignored
+    '''
+    def onFin(self, packet):
+        _, _, total = finHeader.unpack_from(packet)
+        digest = bytes(packet[finHeader.size:])
+        self.lastActivity = time.monotonic()
+
+        if self._nextMissing < self._total:
+            self.sendAck()
+            return None
+
+        self.close()
+
+        return TRANSFER_OK if total == self._total and digest == self._hasher.digest() else CHECKSUM_MISMATCH
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class FileTransferEndpoint:
+    '''
+    Sends and receives files over udpSocket. Received files are written to receiveDir as '<username>_<filename>',
+    and files larger than maxFileSize bytes are refused.
+    onReceived(username, filename, ok) is called on the receiving thread when an incoming transfer ends
+    '''
+    def __init__(self, udpSocket, window=64, mtu=1500, receiveDir='.', maxFileSize=maxReceiveFileSize):
+        self.window = window
+        self.chunkSize = chunkSizeForMtu(mtu)
+        self.receiveDir = receiveDir
+        self.maxFileSize = maxFileSize
+        self.onReceived = None
+        self._socket = udpSocket
+        self._running = True
+        self._lock = threading.Lock()
+        # Keyed by (peer address, transfer id)
+        self._senders = {}
+        self._receivers = {}
+        # FINACK status and finish time of recently finished incoming transfers, to answer a resent FIN
+        self._finished = {}
+        # Datagrams are received into one reusable buffer
+        self._recvBuffer = bytearray(maxDatagramSize)
+
+    '''
+    Send the file at path to addr, as name '<username>; <filename>'. Blocks until the transfer ends and returns the
+    Sender, whose ok attribute says whether the receiver confirmed the file
+    '''
+    def upload(self, addr, path, name):
+        sender = Sender(self._socket, addr, path, name, self.window, self.chunkSize)
+        key = (addr, sender.transferId)
+
+        with self._lock:
+            self._senders[key] = sender
+
+        try:
+            sender.ok = sender.run()
+        finally:
+            with self._lock:
+                del self._senders[key]
+
+        return sender
+
+    def stop(self):
+        self._running = False
+
+    '''
+    Receive and dispatch packets until stopped. Needs a timeout on the socket so that stop() is noticed
+    '''
+    def serve(self):
+        lastReap = time.monotonic()
+
+        while self._running:
+            if time.monotonic() - lastReap >= 1.0:
+                self._reapIdle()
+                lastReap = time.monotonic()
+
+            try:
+                received, addr = self._socket.recvfrom_into(self._recvBuffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            packet = memoryview(self._recvBuffer)[:received]
+
+            if len(packet) < packetType.size:
+                continue
+
+            # A malformed packet, or one whose file cannot be written, is dropped rather than ending the loop
+            try:
+                self._dispatch(addr, packet)
+            except (struct.error, ValueError, OSError):
+                continue
+
+    '''
+    Hand a packet to the transfer it belongs to
+    '''
+    def _dispatch(self, addr, packet):
+        kind, transferId = packetType.unpack_from(packet)
+        key = (addr, transferId)
+
+        if kind in (ACK, FINACK):
+            with self._lock:
+                sender = self._senders.get(key)
+            if sender:
+                sender.onPacket(packet)
+        elif kind == START:
+            self._onStart(key, packet)
+        elif kind == DATA:
+            receiver = self._receivers.get(key)
+            if receiver:
+                receiver.onData(packet)
+        elif kind == FIN:
+            self._onFin(key, packet)
+
+    def _onStart(self, key, packet):
+        addr, transferId = key
+
+        if key not in self._receivers and key not in self._finished:
+            _, _, fileSize, chunkSize = startHeader.unpack_from(packet)
+            username, _, filename = str(packet[startHeader.size:], 'utf-8').partition('; ')
+
+            # Rejected by not answering, so the sender gives up once its START has been resent maxSendAttempts times
+            if not isAcceptableStart(fileSize, chunkSize, self.maxFileSize) or not hasFreeSpace(self.receiveDir, fileSize):
+                return
+
+            path = os.path.join(self.receiveDir, f'{username}_{filename}')
+
+            self._receivers[key] = Receiver(self._socket, addr, transferId, fileSize, chunkSize, username, filename, path)
+
+        # A resent START means the first ACK was lost
+        receiver = self._receivers.get(key)
+        if receiver:
+            receiver.sendAck()
+
+    def _onFin(self, key, packet):
+        addr, transferId = key
+
+        if key in self._finished:
+            status = self._finished[key][0]
+        else:
+            receiver = self._receivers.get(key)
+            if not receiver:
+                return
+
+            status = receiver.onFin(packet)
+            if status is None:
+                return
+
+            del self._receivers[key]
+            self._finished[key] = (status, time.monotonic())
+
+            if self.onReceived:
+                self.onReceived(receiver.username, receiver.filename, status == TRANSFER_OK)
+
+        self._socket.sendto(finAckHeader.pack(FINACK, transferId, status), addr)
+
+    '''
+    Abandon incoming transfers that have gone quiet and forget transfers that finished a while ago
+    '''
+    def _reapIdle(self):
+        now = time.monotonic()
+
+        for key, receiver in list(self._receivers.items()):
+            if now - receiver.lastActivity >= idleTimeout:
+                receiver.close()
+                del self._receivers[key]
+
+                if self.onReceived:
+                    self.onReceived(receiver.username, receiver.filename, False)
+
+        for key, (_, finishedAt) in list(self._finished.items()):
+            if now - finishedAt >= idleTimeout:
+                del self._finished[key]
+
+    '''
+    Send the file at path to the TCP port of addr, as name '<username>; <filename>'. Returns True once the receiver
+    has the whole file
+    '''
+    def uploadTcp(self, addr, path, name):
+        nameBytes = name.encode('utf-8')
+
+        try:
+            with socket.create_connection(addr) as tcpSocket, open(path, 'rb') as file:
+                fileSize = os.fstat(file.fileno()).st_size
+                tcpSocket.sendall(tcpHeader.pack(fileSize, len(nameBytes)) + nameBytes)
+
+                # Uses os.sendfile where available, so the file goes from the page cache to the socket in the kernel
+                tcpSocket.sendfile(file)
+
+                return tcpSocket.recv(1) == bytes([TRANSFER_OK])
+        except OSError:
+            return False
+
+    '''
+    Accept TCP transfers on listenSocket until it is closed, each received on its own thread
+    '''
+    def serveTcp(self, listenSocket):
+        while self._running:
+            try:
+                connection, _ = listenSocket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            threading.Thread(name='TcpFileRecv', target=self._receiveTcp, args=(connection,), daemon=True).start()
+
+    def _receiveTcp(self, connection):
+        username = filename = ''
+        ok = False
+
+        with connection:
+            try:
+                fileSize, nameLength = tcpHeader.unpack(recvExactly(connection, tcpHeader.size))
+                username, _, filename = recvExactly(connection, nameLength).decode('utf-8').partition('; ')
+
+                if fileSize > self.maxFileSize:
+                    raise ValueError(f'File of {fileSize} bytes is too large')
+                if not hasFreeSpace(self.receiveDir, fileSize):
+                    raise ValueError(f'Not enough disk space for a file of {fileSize} bytes')
+
+                fd = openPreallocated(os.path.join(self.receiveDir, f'{username}_{filename}'), fileSize)
+                view = memoryview(bytearray(min(fileSize, tcpRecvBufferSize) or 1))
+                offset = 0
+
+                try:
+                    while offset < fileSize:
+                        received = connection.recv_into(view, min(len(view), fileSize - offset))
+                        if not received:
+                            break
+
+                        writeAt(fd, view[:received], offset)
+                        offset += received
+                finally:
+                    os.close(fd)
+
+                ok = offset == fileSize
+                if ok:
+                    connection.sendall(bytes([TRANSFER_OK]))
+            except (OSError, ValueError):
+                ok = False
+
+        if self.onReceived and username:
+            self.onReceived(username, filename, ok)
@@ -3,73 +3,450 @@ Application layer protocol for sending and receiving messages via TCP.
 This is a simple protocol that sends messages with a header and a payload.
 It is meant to be simpler HTTP clone.
 Each message has the format 'Content-Length: {size of body in bytes}\r\nPAYLOAD DATA...'.
+Optional header fields may follow the content length on the same line, each as '; {name}: {value}', e.g.
+'Content-Length: 5; Event: MSG\r\nhello'. Peers that never ask for optional features never receive them.
+A body may be compressed, in which case the frame has a 'Content-Encoding' header naming the encoding and the
+content length is the size of the compressed body. A peer only compresses after the other side has agreed to it.
+
+Client requests come in two versions. The client offers its highest version in a 'Protocol' header field of the
+frame with its username, and the server names the version it picked in the same field of its welcome. Without the
+field both sides use version 1, where a request is a message 'COMMAND; arg1; arg2; ...'. A version 2 request is
+binary: a 4 byte length of the rest of the request, a 1 byte opcode, a 4 byte request id (0 for none), a 1 byte
+number of args, the 4 byte length of each arg, then the UTF-8 bytes of the args back to back, so args may contain
+anything. Numbers are big-endian. Responses are messages in both versions.
+'''
+
+import zlib
+import struct
+
+headerPrefix = b'Content-Length: '
+headerFieldSeparator = '; '
+headerTerminator = b'\r\n'
+
+# Initial size of the receive buffer, which is only allocated once something is received, so a connection that
+# never reads through it, e.g. one on asyncio streams, costs nothing. It doubles whenever it fills up, so it only grows
+# with the bytes that actually arrive, and is shrunk back once it is drained if it grew past recvBufferMaxRetainedSize
+recvBufferInitialSize = 64 * 1024
+recvBufferMaxRetainedSize = 1024 * 1024
+
+# Default limits on what a peer may send: the size of a frame's body or of a request, and the length of a header.
+# Frames over them are refused with FrameTooLarge as soon as their length is known, before the rest is read. Servers
+# lower maxFrameSize for connections that have not logged in
+maxFrameSize = 256 * 1024 * 1024
+maxHeaderSize = 64 * 1024
+
+# Content encodings a peer may agree to. Bodies smaller than compressionThreshold bytes are always sent raw,
+# since compressing them costs more CPU than it saves on the wire. Level 1 gets most of the size reduction of the
+# default zlib level for a fraction of the CPU, see benchmark/compressionBenchmark.py
+contentEncodings = ('zlib',)
+compressionThreshold = 1024
+compressionLevel = 1
+
+# Request versions, see above
+protocolVersions = (1, 2)
+
+# Opcodes of commands in version 2 requests. Commands without an opcode are sent as 0, which the server rejects
+opcodes = {'MSG': 1, 'DLT': 2, 'EDT': 3, 'RDM': 4, 'RDS': 5, 'ATU': 6, 'OUT': 7, 'SUB': 8, 'BATCH': 9, 'ENC': 10, 'STATS': 11, 'SYN': 12, 'SRH': 13, 'JOIN': 14, 'LEAVE': 15, 'ROOMS': 16}
+commandsByOpcode = {opcode: command for command, opcode in opcodes.items()}
+
+requestLengthStruct = struct.Struct('!I')
+requestHeaderStruct = struct.Struct('!BIB')
+# Structs of the arg lengths of requests, keyed by the number of args
+fieldLengthStructs = {}
+
+class FrameTooLarge(ConnectionError):
+    '''
+    Raised when a peer sends a frame over the receiver's limits. The connection cannot be read past it, so it has to be
+    dropped
+    '''
+
+class MalformedFrame(ValueError):
+    '''
+    Raised when a peer sends a header, body or request that cannot be parsed. Where the frame ends may not be known,
+    so the connection has to be dropped
+    '''
+
+'''
+Build the header for a message body of the given size in bytes, with optional header fields
+'''
+def encodeHeader(contentLength, headers=None):
+    if not headers:
+        return b'%s%d%s' % (headerPrefix, contentLength, headerTerminator)
+
+    fields = ''.join(f'{headerFieldSeparator}{name}: {value}' for name, value in headers.items())
+
+    return b'%s%d%s%s' % (headerPrefix, contentLength, fields.encode('utf-8'), headerTerminator)
+
+'''
+Encode a message body, compressing it with contentEncoding if it is at least compressionThreshold bytes.
+Returns the body and the header fields to send with it
+'''
+def encodeBody(message, headers=None, contentEncoding=None):
+    messageBytes = message.encode('utf-8')
+
+    if contentEncoding is None or len(messageBytes) < compressionThreshold:
+        return messageBytes, headers
+
+    if contentEncoding != 'zlib':
+        raise ValueError(f'Unsupported content encoding: {contentEncoding}')
+
+    headers = dict(headers) if headers else {}
+    headers['Content-Encoding'] = contentEncoding
+
+    return zlib.compress(messageBytes, compressionLevel), headers
+
+'''
+Decode a received message body according to its header fields
+'''
+def decodeBody(body, headers):
+    contentEncoding = headers.get('Content-Encoding')
+
+    if contentEncoding is None:
+        return decodeText(body)
+
+    if contentEncoding != 'zlib':
+        raise MalformedFrame(f'Unsupported content encoding: {contentEncoding}')
+
+    try:
+        return decodeText(zlib.decompress(body))
+    except zlib.error as error:
+        raise MalformedFrame(f'Malformed compressed body: {error}')
+
+'''
+Decode received UTF-8 bytes, raising MalformedFrame if they are not valid UTF-8
+'''
+def decodeText(data):
+    try:
+        return str(data, 'utf-8')
+    except UnicodeDecodeError as error:
+        raise MalformedFrame(f'Malformed text: {error}')
+
+'''
+Build a complete frame (header and body) for a message
+'''
+def encodeFrame(message, headers=None, contentEncoding=None):
+    messageBytes, headers = encodeBody(message, headers, contentEncoding)
+
+    return encodeHeader(len(messageBytes), headers) + messageBytes
+
+'''
+Parse a header line (without the terminator). Returns the content length in bytes and a dict of the
+optional header fields
+'''
+def parseHeader(header):
+    if not header.startswith(headerPrefix):
+        raise MalformedFrame(f'Malformed header: {bytes(header)!r}')
+
+    contentLength, *fields = decodeText(bytes(header[len(headerPrefix):])).split(headerFieldSeparator)
+
+    if not contentLength.isdigit():
+        raise MalformedFrame(f'Malformed header: {bytes(header)!r}')
+
+    headers = {}
+    for field in fields:
+        name, _, value = field.partition(': ')
+        headers[name] = value
+
+    return int(contentLength), headers
+
+'''
+Build a version 1 request. The args of a BATCH are the (command, args) pairs of its commands, sent one per line
+'''
+def encodeTextRequest(command, args):
+    if command == 'BATCH':
+        return '\n'.join(['BATCH', *(encodeTextRequest(*subRequest) for subRequest in args)])
+
+    return '; '.join((command, *args))
+
+'''
+Parse a version 1 request. Returns the command and its args, where the args of a BATCH are one list of the
+(command, args) pairs of its commands
+'''
+def parseTextRequest(request):
+    # A batch has format 'BATCH\n<request>\n<request>...'
+    firstLine, _, subRequests = request.partition('\n')
+    if firstLine == 'BATCH':
+        return 'BATCH', ([parseTextRequest(subRequest) for subRequest in subRequests.split('\n') if subRequest],)
+
+    requestSplit = request.split('; ')
+
+    # Args on the BATCH line itself are not a list of commands to run
+    if requestSplit[0] == 'BATCH':
+        return 'BATCH', ()
+
+    return requestSplit[0], tuple(requestSplit[1:])
+
+'''
+Build a version 2 request, length prefix included. The args of a BATCH are as for encodeTextRequest, and each is sent
+as a field holding a version 2 request without its length prefix
+'''
+def encodeBinaryRequest(command, args, requestId=None):
+    body = _encodeRequestBody(command, args, requestId)
+
+    return requestLengthStruct.pack(len(body)) + body
+
+def _encodeRequestBody(command, args, requestId):
+    if command == 'BATCH':
+        fields = [_encodeRequestBody(subCommand, subArgs, None) for subCommand, subArgs in args]
+    else:
+        fields = [arg.encode('utf-8') for arg in args]
+
+    header = requestHeaderStruct.pack(opcodes.get(command, 0), int(requestId or 0), len(fields))
+
+    return header + _fieldLengthStruct(len(fields)).pack(*map(len, fields)) + b''.join(fields)
+
+def _fieldLengthStruct(fieldCount):
+    lengthStruct = fieldLengthStructs.get(fieldCount)
+
+    if lengthStruct is None:
+        lengthStruct = fieldLengthStructs[fieldCount] = struct.Struct(f'!{fieldCount}I')
+
+    return lengthStruct
+
+'''
+Parse a version 2 request without its length prefix. Returns the command, its args as for parseTextRequest, and the
+request id as a string, or None if it has none. The command is '' for an unknown opcode
 '''
+def decodeBinaryRequest(body):
+    if len(body) < requestHeaderStruct.size:
+        raise MalformedFrame('Malformed request: shorter than a request header')
+
+    opcode, requestId, fieldCount = requestHeaderStruct.unpack_from(body)
+    lengthStruct = _fieldLengthStruct(fieldCount)
+
+    start = requestHeaderStruct.size + lengthStruct.size
+    if start > len(body):
+        raise MalformedFrame('Malformed request: too short for its arg lengths')
+
+    fieldLengths = lengthStruct.unpack_from(body, requestHeaderStruct.size)
+    if start + sum(fieldLengths) != len(body):
+        raise MalformedFrame('Malformed request: the args do not add up to the length of the request')
+
+    command = commandsByOpcode.get(opcode, '')
+    requestId = str(requestId) if requestId else None
+
+    fieldBytes = body[start:]
+    fields = []
+    offset = 0
+
+    if command == 'BATCH':
+        for fieldLength in fieldLengths:
+            subRequest = fieldBytes[offset:offset + fieldLength]
+
+            # Version 1 cannot put a batch inside a batch either, and refusing it keeps a request from nesting deeper
+            # than the stack
+            if len(subRequest) and subRequest[0] == opcodes['BATCH']:
+                raise MalformedFrame('Malformed request: a BATCH inside a BATCH')
+
+            fields.append(decodeBinaryRequest(subRequest)[:2])
+            offset += fieldLength
+
+        return command, (fields,), requestId
+
+    # Decode every arg at once. If they are all ASCII, byte offsets are character offsets and the args can be sliced
+    # out of the decoded text. Otherwise each arg is sliced out of the bytes and decoded on its own
+    text = decodeText(fieldBytes)
+    source = text if len(text) == len(fieldBytes) else fieldBytes
+
+    for fieldLength in fieldLengths:
+        fields.append(source[offset:offset + fieldLength])
+        offset += fieldLength
+
+    if source is not text:
+        fields = [decodeText(field) for field in fields]
+
+    return command, tuple(fields), requestId
 
 class Protocol:
     def __init__(self, socket, addrName, addrPort):
         self.socket = socket
         self.addrName = addrName
         self.addrPort = addrPort
-        self._recvCarryOverData = ''
-    
+        # Received bytes live in _recvBuffer[_recvStart:_recvEnd]
+        self._recvBuffer = bytearray()
+        self._recvStart = 0
+        self._recvEnd = 0
+        # How far the last _recvMore shifted buffered data towards the front
+        self._compactedBy = 0
+        # Largest frame body or request accepted from the peer
+        self.maxFrameSize = maxFrameSize
+        # Encoding for large outgoing bodies, set once the peer has agreed to it. None sends everything raw
+        self.contentEncoding = None
+        # Version of requests sent and received, set once the peer has agreed to it
+        self.protocolVersion = 1
+        # Bytes sent and received over the connection
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
     '''
     Send message via TCP
     '''
-    def sendMessage(self, message):
-        messageBytes = message.encode('utf-8')
+    def sendMessage(self, message, headers=None):
+        messageBytes, headers = encodeBody(message, headers, self.contentEncoding)
+
+        self._sendBuffers(encodeHeader(len(messageBytes), headers), messageBytes)
+
+    '''
+    Send the buffers back to back with as few syscalls as possible. Uses scatter-gather sendmsg where
+    available so the body is never copied just to be glued onto the header
+    '''
+    def _sendBuffers(self, *buffers):
+        self.bytesSent += sum(map(len, buffers))
+
+        if not hasattr(self.socket, 'sendmsg'):
+            self.socket.sendall(b''.join(buffers))
+            return
+
+        views = [memoryview(buffer) for buffer in buffers]
 
-        contentLength = len(messageBytes)
+        while views:
+            sent = self.socket.sendmsg(views)
 
-        header = f'Content-Length: {contentLength}\r\n'
+            # Drop whatever was fully sent and trim a partially sent buffer
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
 
-        headerBytes = header.encode('utf-8')
+            if views and sent:
+                views[0] = views[0][sent:]
 
-        self.socket.sendall(headerBytes)
-        self.socket.sendall(messageBytes)
+    '''
+    Send a request in the agreed version
+    '''
+    def sendRequest(self, command, args, requestId=None):
+        if self.protocolVersion == 1:
+            self.sendMessage(encodeTextRequest(command, args), None if requestId is None else {'Request-Id': requestId})
+        else:
+            self._sendBuffers(encodeBinaryRequest(command, args, requestId))
+
+    '''
+    Receive a request in the agreed version. Returns the command, its args and its request id, or None if it has none
+    '''
+    def recvRequest(self):
+        if self.protocolVersion == 1:
+            headers, request = self.recvFrame()
+            return (*parseTextRequest(request), headers.get('Request-Id'))
+
+        while self._recvEnd - self._recvStart < requestLengthStruct.size:
+            self._recvMore()
+
+        requestLength, = requestLengthStruct.unpack_from(self._recvBuffer, self._recvStart)
+        self._checkFrameSize(requestLength)
+        requestEnd = requestLengthStruct.size + requestLength
+
+        while self._recvEnd - self._recvStart < requestEnd:
+            self._recvMore()
+
+        view = memoryview(self._recvBuffer)[self._recvStart + requestLengthStruct.size:self._recvStart + requestEnd]
+        try:
+            request = decodeBinaryRequest(view)
+        finally:
+            view.release()
+
+        self._consume(requestEnd)
+
+        return request
 
     '''
     Receive message via TCP
     '''
-    def recvMessage(self):        
-        messageStart = []
+    def recvMessage(self):
+        return self.recvFrame()[1]
 
-        messageStart.append(self._recvCarryOverData)
+    '''
+    Receive message via TCP. Returns the header fields and the message
+    '''
+    def recvFrame(self):
+        buffer = self._recvBuffer
 
-        while '\r\n' not in ''.join(messageStart):
-            payload = self.socket.recv(1024).decode('utf-8')
-            messageStart.append(payload)
-        
-        headerSplit = ''.join(messageStart).partition('\r\n')
-        header = headerSplit[0]
-        afterHeader = headerSplit[2]
+        # Scan for the header terminator, only looking at bytes that have not been scanned yet
+        scanFrom = self._recvStart
+        headerEnd = buffer.find(headerTerminator, scanFrom, self._recvEnd)
 
-        contentLength = int(header.lstrip('Content-Length: '))
-        currentLengthOfContentReceived = len(afterHeader)
+        while headerEnd == -1:
+            if self._recvEnd - self._recvStart > min(maxHeaderSize, self.maxFrameSize):
+                raise FrameTooLarge(f'Header from {self.addrName}:{self.addrPort} is too long')
 
-        content = []
+            # The terminator may straddle the previous and the next chunk
+            scanFrom = max(self._recvStart, self._recvEnd - len(headerTerminator) + 1)
+            self._recvMore()
+            buffer = self._recvBuffer
+            headerEnd = buffer.find(headerTerminator, scanFrom - self._compactedBy, self._recvEnd)
 
-        # Chop excess afterHeader if it is longer than content length
-        if currentLengthOfContentReceived > contentLength:
-            carryOverAmount = currentLengthOfContentReceived - contentLength
-            
-            content.append(afterHeader[:-carryOverAmount])
-            self._recvCarryOverData = afterHeader[-carryOverAmount:]
-        else:
-            content.append(afterHeader)
-            self._recvCarryOverData = ''
-
-        while currentLengthOfContentReceived < contentLength:
-            payload = self.socket.recv(1024).decode('utf-8')
-            currentLengthOfContentReceived += len(payload)
-
-            # Chop excess payload if it is longer than content length
-            if currentLengthOfContentReceived > contentLength:
-                carryOverAmount = currentLengthOfContentReceived - contentLength
-                
-                content.append(payload[:-carryOverAmount])
-                self._recvCarryOverData = payload[-carryOverAmount:]
-            else:
-                content.append(payload)
-                self._recvCarryOverData = ''
-
-        return ''.join(content)
+        contentLength, headers = parseHeader(buffer[self._recvStart:headerEnd])
+        self._checkFrameSize(contentLength)
+
+        contentStart = headerEnd + len(headerTerminator) - self._recvStart
+        contentEnd = contentStart + contentLength
+
+        while self._recvEnd - self._recvStart < contentEnd:
+            self._recvMore()
+
+        # Decode the whole body once it has fully arrived so multibyte characters split
+        # across segments are handled correctly
+        view = memoryview(self._recvBuffer)[self._recvStart + contentStart:self._recvStart + contentEnd]
+        try:
+            message = decodeBody(view, headers)
+        finally:
+            view.release()
+
+        self._consume(contentEnd)
+
+        return headers, message
+
+    '''
+    Raise FrameTooLarge if the peer declares a frame body or request of size bytes, over maxFrameSize
+    '''
+    def _checkFrameSize(self, size):
+        if size > self.maxFrameSize:
+            raise FrameTooLarge(f'{self.addrName}:{self.addrPort} sent a frame of {size} bytes, over the limit of {self.maxFrameSize}')
+
+    '''
+    Receive more data straight into the free space at the end of the receive buffer
+    '''
+    def _recvMore(self):
+        self._compactedBy = 0
+
+        if self._recvEnd == len(self._recvBuffer):
+            self._makeRoom()
+
+        view = memoryview(self._recvBuffer)[self._recvEnd:]
+        try:
+            received = self.socket.recv_into(view)
+        finally:
+            view.release()
+
+        if received == 0:
+            raise ConnectionError(f'Connection closed by {self.addrName}:{self.addrPort}')
+
+        self._recvEnd += received
+        self.bytesReceived += received
+
+    '''
+    Make free space at the end of the receive buffer, by moving unread data to the front, or doubling the buffer if it
+    is all unread, or allocating it on the first receive. The buffer never grows past twice the bytes actually received, whatever size a frame claims to be
+    '''
+    def _makeRoom(self):
+        buffered = self._recvEnd - self._recvStart
+
+        if self._recvStart > 0:
+            self._recvBuffer[:buffered] = self._recvBuffer[self._recvStart:self._recvEnd]
+            self._compactedBy = self._recvStart
+            self._recvStart = 0
+            self._recvEnd = buffered
+
+        if self._recvEnd == len(self._recvBuffer):
+            self._recvBuffer.extend(bytes(len(self._recvBuffer) or recvBufferInitialSize))
+
+    '''
+    Mark size bytes from the front of the receive buffer as read
+    '''
+    def _consume(self, size):
+        self._recvStart += size
+
+        if self._recvStart == self._recvEnd:
+            self._recvStart = 0
+            self._recvEnd = 0
+
+            if len(self._recvBuffer) > recvBufferMaxRetainedSize:
+                self._recvBuffer = bytearray(recvBufferInitialSize)
@@ -0,0 +1,325 @@
+'''
+Event loop based server connection class. Used when the server is started in async mode.
+Each client connection is a coroutine over asyncio streams instead of a dedicated thread, so idle
+connections only cost a coroutine and a socket. Commands still touch the log files, so they are run
+on a bounded worker pool shared by every connection, at most asyncWorkerThreadsPerConnection of its threads at a time
+for one connection. Responses of several frames are sent from the event loop, and only the reads of their pages are
+run on the pool, so a slow client never holds a pool thread while its output drains.
+
+Requests that carry a Request-Id header are pipelined: they are handled concurrently, up to
+maxPipelinedRequests per connection, and their responses may be sent back out of order.
+'''
+
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+
+from ServerConnection import ServerConnection, currentRequestId
+from admissionControl import ConnectionRejected
+import serverSettings
+import database
+from protocol.protocol import encodeFrame, decodeBody, parseHeader, headerTerminator, maxHeaderSize, parseTextRequest, decodeBinaryRequest, requestLengthStruct, FrameTooLarge, MalformedFrame
+
+# Streams of frames that the request being handled has left for the event loop to send, see _sendStream
+currentStreams = contextvars.ContextVar('currentStreams', default=None)
+
+class AsyncServerConnection(ServerConnection):
+    def __init__(self, reader, writer, executor):
+        clientName, clientPort = writer.get_extra_info('peername')[:2]
+        self._reader = reader
+        self._writer = writer
+        super().__init__(writer.get_extra_info('socket'), clientName, clientPort)
+        self._executor = executor
+        self._loop = asyncio.get_running_loop()
+        self._loopThreadId = threading.get_ident()
+        self._pipelined = set()
+        self._pipelineSlots = asyncio.Semaphore(serverSettings.maxPipelinedRequests)
+        self._workerSlots = asyncio.Semaphore(serverSettings.asyncWorkerThreadsPerConnection)
+
+    async def main(self):
+        database.metrics.addConnection(self)
+        self._startCapture()
+
+        try:
+            self._startLoginDeadline()
+            await self._loginLoop()
+            await self._receiveClientUDPPort()
+            self._registerSession()
+            self._startIdleCheck()
+
+            while True:
+                command, args = await self._getRequest()
+
+                if currentRequestId.get() is not None and command != 'OUT':
+                    await self._pipelineSlots.acquire()
+
+                    task = self._loop.create_task(self._runPipelined(command, args, self._capturedFrames - 1))
+                    self._pipelined.add(task)
+                    task.add_done_callback(self._pipelined.discard)
+                    continue
+
+                # Requests without a Request-Id are answered in order, after any pipelined requests
+                if self._pipelined:
+                    await asyncio.wait(self._pipelined)
+
+                await self._runCommand(command, args)
+                self._captureReply()
+
+                if command == 'OUT':
+                    return
+        except ConnectionRejected:
+            pass
+        except (FrameTooLarge, MalformedFrame) as error:
+            print(f'{self.username or self.addrName} is disconnected. {error}.')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print(f'{self.username or self.addrName} disconnected.')
+        finally:
+            self._cancelDeadline()
+            self._unsubscribe()
+            self._unregisterSession()
+            self._releaseAdmission()
+            database.metrics.removeConnection(self)
+            self._endCapture()
+            # Closing sends whatever is still buffered, e.g. a rejection, before the connection goes
+            self._writer.close()
+
+    '''
+    Make senders wait once the stream's write buffer holds outputBufferSize bytes. Every sender waits with _drain,
+    which gives up after writeTimeout seconds
+    '''
+    def _limitOutput(self):
+        self._writer.transport.set_write_buffer_limits(high=serverSettings.outputBufferSize)
+
+    '''
+    Wait until the stream's write buffer is below its limit. Drops the connection if that takes more than writeTimeout
+    seconds
+    '''
+    async def _drain(self):
+        drainStart = time.perf_counter()
+
+        try:
+            await asyncio.wait_for(self._writer.drain(), serverSettings.writeTimeout or None)
+        except asyncio.TimeoutError:
+            print(f'{self.username or self.addrName} did not read its output for {serverSettings.writeTimeout:g} seconds and is disconnected.')
+            self._writer.transport.abort()
+            raise ConnectionAbortedError('Write timed out')
+
+        database.metrics.observeSend(time.perf_counter() - drainStart)
+
+    async def _loginLoop(self):
+        while True:
+            headers, username = await self.recvFrame()
+            password = await self.recvMessage()
+
+            self._agreeProtocolVersion(headers)
+
+            # Login data is kept in memory, so there is no need to leave the event loop
+            loggedIn = self._attemptLogin(username, password)
+            await self._drain()
+            self._captureReply()
+
+            if loggedIn:
+                return
+
+    async def _receiveClientUDPPort(self):
+        clientUDPPort = int(await self.recvMessage())
+        self.clientUDPPort = clientUDPPort
+
+    async def _getRequest(self):
+        command, args, requestId = await self.recvRequest()
+
+        self._lastActivity = time.monotonic()
+        currentRequestId.set(requestId)
+
+        return command, args
+
+    '''
+    Handle a request that carries a Request-Id concurrently with the connection's other requests
+    '''
+    async def _runPipelined(self, command, args, frameNumber):
+        try:
+            await self._runCommand(command, args)
+            self._captureReply(frameNumber)
+        except ConnectionError:
+            # The main loop notices the disconnect on its next read
+            pass
+        finally:
+            self._pipelineSlots.release()
+
+    '''
+    Handle a request on the worker pool, then send any responses it streams, and wait for its output to drain
+    '''
+    async def _runCommand(self, command, args):
+        streams = []
+        currentStreams.set(streams)
+
+        await self._runBlocking(self._doCommand, command, args)
+
+        for frames in streams:
+            await self._sendFrames(frames)
+
+        await self._drain()
+
+    '''
+    Send each frame a stream generates, reading the next on the worker pool only once the last has drained
+    '''
+    async def _sendFrames(self, frames):
+        while True:
+            frame = await self._runBlocking(next, frames, None)
+            if frame is None:
+                return
+
+            self.sendMessage(*frame)
+            await self._drain()
+
+    '''
+    Run a blocking function on the worker pool, in the current context so the request id carries over. Waits for
+    one of the connection's worker slots first
+    '''
+    async def _runBlocking(self, func, *args):
+        context = contextvars.copy_context()
+
+        async with self._workerSlots:
+            return await self._loop.run_in_executor(self._executor, functools.partial(context.run, func, *args))
+
+    '''
+    Send message via the stream writer. Safe to call from both the event loop and worker pool threads
+    '''
+    def sendMessage(self, message, headers=None):
+        if self._collectBatchResponse(message):
+            return
+
+        frame = encodeFrame(message, self._responseHeaders(headers), self.contentEncoding)
+        self.bytesSent += len(frame)
+
+        if threading.get_ident() == self._loopThreadId:
+            self._writer.write(frame)
+        else:
+            self._loop.call_soon_threadsafe(self._writer.write, frame)
+
+    '''
+    Leave a response of several frames for the event loop to send once the handler returns, see _runCommand
+    '''
+    def _sendStream(self, frames):
+        currentStreams.get().append(frames)
+
+    '''
+    Drop the connection, e.g. when it is too slow to keep up with live events
+    '''
+    def _disconnect(self):
+        self._loop.call_soon_threadsafe(self._writer.transport.abort)
+
+    def _createSubscriber(self):
+        return AsyncSubscriber(self, serverSettings.subscriberQueueSize, serverSettings.subscriberOverflowPolicy)
+
+    '''
+    Receive a request in the agreed version via the stream reader. Returns the command, its args and its request id
+    '''
+    async def recvRequest(self):
+        if self.protocolVersion == 1:
+            headers, request = await self.recvFrame()
+            return (*parseTextRequest(request), headers.get('Request-Id'))
+
+        lengthBytes = await self._reader.readexactly(requestLengthStruct.size)
+        requestLength, = requestLengthStruct.unpack(lengthBytes)
+        self._checkFrameSize(requestLength)
+        self.bytesReceived += requestLengthStruct.size + requestLength
+
+        request = await self._reader.readexactly(requestLength)
+
+        if self._captureId is not None:
+            self._captureFrame(lengthBytes + request)
+
+        return decodeBinaryRequest(request)
+
+    '''
+    Receive message via the stream reader
+    '''
+    async def recvMessage(self):
+        return (await self.recvFrame())[1]
+
+    '''
+    Receive message via the stream reader. Returns the header fields and the message
+    '''
+    async def recvFrame(self):
+        try:
+            header = await self._reader.readuntil(headerTerminator)
+        except asyncio.LimitOverrunError:
+            raise FrameTooLarge(f'Header from {self.addrName}:{self.addrPort} is too long')
+
+        if len(header) > min(maxHeaderSize, self.maxFrameSize):
+            raise FrameTooLarge(f'Header from {self.addrName}:{self.addrPort} is too long')
+
+        contentLength, headers = parseHeader(header[:-len(headerTerminator)])
+        self._checkFrameSize(contentLength)
+
+        content = await self._reader.readexactly(contentLength)
+        self.bytesReceived += len(header) + contentLength
+
+        if self._captureId is not None:
+            self._captureFrame(header + content)
+
+        return headers, decodeBody(content, headers)
+
+'''
+Live event subscriber for an async connection. Events are queued on the event loop and written by a delivery task
+that waits for the stream to drain, so a slow client fills its own bounded queue instead of the write buffer
+'''
+class AsyncSubscriber:
+    def __init__(self, connection, maxQueued, overflowPolicy):
+        self._connection = connection
+        self._loop = connection._loop
+        self._overflowPolicy = overflowPolicy
+        self._queue = asyncio.Queue(maxQueued)
+        self._dropped = 0
+        self._task = None
+
+    def start(self):
+        self._loop.call_soon_threadsafe(self._startTask)
+
+    '''
+    Offer an event. Called from the journal writer thread
+    '''
+    def offer(self, kind, payload, room):
+        self._loop.call_soon_threadsafe(self._offer, kind, payload, room)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._close)
+
+    def _startTask(self):
+        self._task = self._loop.create_task(self._run())
+
+    def _offer(self, kind, payload, room):
+        if self._task is None or self._task.done():
+            return
+
+        try:
+            self._queue.put_nowait((kind, payload, room))
+        except asyncio.QueueFull:
+            if self._overflowPolicy == 'drop':
+                self._dropped += 1
+            else:
+                self._task.cancel()
+                self._connection._writer.transport.abort()
+
+    def _close(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        # Live events are not responses to a request
+        currentRequestId.set(None)
+
+        while True:
+            kind, payload, room = await self._queue.get()
+
+            dropped = self._dropped
+            self._dropped = 0
+
+            try:
+                self._connection._deliverEvent(kind, payload, room, dropped)
+                await self._connection._drain()
+            except ConnectionError:
+                return
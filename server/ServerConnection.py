@@ -4,19 +4,55 @@ Server side connection class. Each new client connection is handled by an instan
 
 import os
 import sys
+import time
+import socket
 import datetime
 import threading
+import contextvars
 from inspect import signature
 
-import threadLock
 import database
+import messageStore
+import loginRegistry
+import roomRegistry
+import metrics
+from admissionControl import ConnectionRejected, rejectedHeader
+from sessionRegistry import Session
+from eventHub import Subscriber
+from searchIndex import splitWords
+from journalWriter import JournalFailed
 import serverSettings
 
 currentDir = os.path.dirname(os.path.realpath(__file__))
 parentDir = os.path.dirname(currentDir)
 sys.path.append(parentDir)
 
-from protocol.protocol import Protocol
+from protocol.protocol import Protocol, FrameTooLarge, MalformedFrame, contentEncodings, protocolVersions
+
+# Request-Id header field of the request being handled, if the client sent one. Responses to the request carry the
+# same Request-Id so pipelining clients can match them up
+currentRequestId = contextvars.ContextVar('currentRequestId', default=None)
+
+# While a BATCH sub-command is handled, its responses are collected here instead of being sent
+currentBatchResponses = contextvars.ContextVar('currentBatchResponses', default=None)
+
+# Commands that cannot be part of a BATCH
+unbatchableCommands = ('OUT', 'SUB', 'BATCH', 'ENC', 'RDS', 'SYN')
+
+'''
+Build a table of command handlers keyed by command name. Each entry is the handler and the minimum and maximum number
+of args it takes, read from its signature once rather than on every request. Args with a default are optional
+'''
+def buildDispatchTable(handlers):
+    dispatchTable = {}
+
+    for command, handler in handlers.items():
+        # Leave out self
+        parameters = list(signature(handler).parameters.values())[1:]
+        minArgs = sum(1 for parameter in parameters if parameter.default is parameter.empty)
+        dispatchTable[command] = (handler, minArgs, len(parameters))
+
+    return dispatchTable
 
 class ServerConnection(Protocol):
     def __init__(self, connectionSocket, clientName, clientPort):
@@ -24,148 +60,388 @@ class ServerConnection(Protocol):
         self.connectionSocket = connectionSocket
         self.username = ''
         self.clientUDPPort = 0
-        self._commands = {
-            'MSG': self._msg, # post message, MSG; <message>
-            'DLT': self._dlt, # delete message, DLT; <message number>; <timestamp>
-            'EDT': self._edt, # edit message, EDT; <message number>; <timestamp>; <new message>
-            'RDM': self._rdm, # read messages, RDM; <timestamp>
-            'ATU': self._atu, # list active users, ATU
-            'OUT': self._logout, # logout, OUT
-        }
+        # Room the connection is in, whose messages its commands act on
+        self.room = serverSettings.defaultRoom
+        self._session = None
+        self._subscriber = None
+        # Whether the connection counts towards its user's connection limit
+        self._userAdmitted = False
+        # Login deadline or idle check timer on database.timers
+        self._deadlineTimer = None
+        self._lastActivity = time.monotonic()
+        # Live events are sent from the subscriber's delivery thread, so sends are serialised
+        self._sendLock = threading.Lock()
+        # Id of the connection in database.capture, or None when not capturing, and the number of frames captured
+        self._captureId = None
+        self._capturedFrames = 0
+        # Only small frames until the connection has logged in, so an unauthenticated peer cannot make the server
+        # buffer much
+        self.maxFrameSize = serverSettings.maxLoginFrameSize
+        self._limitOutput()
 
     def main(self):
-        self._loginLoop()
-        self._receiveClientUDPPort()
-        self._userlogNewLogin()
+        database.metrics.addConnection(self)
+        self._startCapture()
 
-        while True:
-            command, args = self._getRequest()
-            self._doCommand(command, args)
+        try:
+            self._startLoginDeadline()
+            self._loginLoop()
+            self._receiveClientUDPPort()
+            self._registerSession()
+            self._startIdleCheck()
+
+            while True:
+                command, args = self._getRequest()
+                self._doCommand(command, args)
+                self._captureReply()
+
+                if command == 'OUT':
+                    return
+        except ConnectionRejected:
+            pass
+        except (FrameTooLarge, MalformedFrame) as error:
+            print(f'{self.username or self.addrName} is disconnected. {error}.')
+        except ConnectionError:
+            print(f'{self.username or self.addrName} disconnected.')
+        finally:
+            self._cancelDeadline()
+            self._unsubscribe()
+            self._unregisterSession()
+            self._releaseAdmission()
+            database.metrics.removeConnection(self)
+            self._endCapture()
+            self.connectionSocket.close()
 
-            if command == 'OUT':
-                self.connectionSocket.close()
-                return
+    '''
+    Bound the output the kernel holds for the connection. Sends wait once it is full, for up to writeTimeout seconds
+    '''
+    def _limitOutput(self):
+        self.connectionSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, serverSettings.outputBufferSize)
 
     def _loginLoop(self):
         while True:
-            username = self.recvMessage()
+            headers, username = self.recvFrame()
             password = self.recvMessage()
 
-            with threadLock.loginDataLock:
-                if not self._validateUsername(username):
-                    self.sendMessage('Invalid username! Please try again.')
-                elif self._attemptsRemaining(username) <= 0:
-                    self.sendMessage('Your account is blocked due to multiple login failures. Please try again later.')
-                elif not self._validatePassword(username, password):
-                    database.clientsLogin[username]['loginAttempts'] += 1
-                    
-                    attemptsRemaining = self._attemptsRemaining(username)
-                    
-                    if attemptsRemaining <= 0:
-                        self.sendMessage('Invalid Password! Your account has been timed out. Please try again later.')
-                        self._beginEndTimeoutTimer(username)
-                    else:
-                        self.sendMessage(f'Invalid password! Attempts remaining for this user before timeout: {attemptsRemaining}')
-                else:
-                    self.username = username
-                    
-                    self.sendMessage('Welcome to TOOM!')
-
-                    print(f'{username} has logged in.')
-                    return
+            self._agreeProtocolVersion(headers)
 
-    def _validateUsername(self, username):
-        if username in database.clientsLogin:
-            return True
+            loggedIn = self._attemptLogin(username, password)
+            self._captureReply()
+
+            if loggedIn:
+                return
+
+    '''
+    Use the highest request version supported by both sides, given the version the client offered with its username.
+    Clients that offer none use version 1
+    '''
+    def _agreeProtocolVersion(self, headers):
+        try:
+            offered = int(headers.get('Protocol', 1))
+        except ValueError:
+            offered = 1
+
+        self.protocolVersion = min(max(offered, protocolVersions[0]), protocolVersions[-1])
+
+    '''
+    Validate a single login attempt and reply to the client. Returns True if the client is now logged in. Raises
+    ConnectionRejected if the user already has as many connections as allowed
+    '''
+    def _attemptLogin(self, username, password):
+        result, attemptsRemaining = database.logins.attempt(username, password)
+
+        if result == loginRegistry.INVALID_USERNAME:
+            self.sendMessage('Invalid username! Please try again.')
+        elif result == loginRegistry.BLOCKED:
+            self.sendMessage('Your account is blocked due to multiple login failures. Please try again later.')
+        elif result == loginRegistry.LOCKED_OUT:
+            self.sendMessage('Invalid Password! Your account has been timed out. Please try again later.')
+        elif result == loginRegistry.INVALID_PASSWORD:
+            self.sendMessage(f'Invalid password! Attempts remaining for this user before timeout: {attemptsRemaining}')
         else:
-            return False
-    
-    def _validatePassword(self, username, password):
-        if database.clientsLogin[username]['password'] == password:
+            if not database.admission.admitUser(username):
+                self.sendMessage(f'{username} has too many connections. Please try again later.', {rejectedHeader: 'user'})
+                print(f'{username} has too many connections, login is rejected.')
+                raise ConnectionRejected(username)
+
+            self.username = username
+            self._userAdmitted = True
+            self.maxFrameSize = serverSettings.maxRequestSize
+
+            # Clients that offered a newer request version are told which one to use
+            self.sendMessage('Welcome to TOOM!', {'Protocol': self.protocolVersion} if self.protocolVersion > 1 else None)
+
+            print(f'{username} has logged in.')
             return True
+
+        return False
+
+    '''
+    Drop the connection if it has not logged in within loginTimeout seconds
+    '''
+    def _startLoginDeadline(self):
+        if serverSettings.loginTimeout:
+            self._deadlineTimer = database.timers.schedule(serverSettings.loginTimeout, self._loginTimedOut)
+
+    def _loginTimedOut(self):
+        print(f'{self.addrName}:{self.addrPort} did not log in within {serverSettings.loginTimeout:g} seconds.')
+        self._disconnect()
+
+    '''
+    Replace the login deadline with a check for the connection going idle
+    '''
+    def _startIdleCheck(self):
+        self._cancelDeadline()
+
+        if serverSettings.idleConnectionTimeout:
+            self._deadlineTimer = database.timers.schedule(serverSettings.idleConnectionTimeout, self._idleCheck)
+
+    '''
+    Drop the connection if it has been idle for idleConnectionTimeout seconds. Otherwise check again when it could
+    next be, so requests never have to touch the timer. A subscribed connection is waiting on the server rather than
+    idle, so it is never dropped, however long it goes without a request. If its client has gone, the write timeout
+    drops it once an event is pushed
+    '''
+    def _idleCheck(self):
+        if self._subscriber:
+            self._lastActivity = time.monotonic()
+
+        idle = time.monotonic() - self._lastActivity
+
+        if idle >= serverSettings.idleConnectionTimeout:
+            print(f'{self.username} has been idle for {serverSettings.idleConnectionTimeout:g} seconds and is disconnected.')
+            self._disconnect()
         else:
-            return False
+            self._deadlineTimer = database.timers.schedule(serverSettings.idleConnectionTimeout - idle, self._idleCheck)
+
+    def _cancelDeadline(self):
+        if self._deadlineTimer:
+            database.timers.cancel(self._deadlineTimer)
+            self._deadlineTimer = None
 
     '''
-    Login attempts remaining
+    Give back the connection's place under the connection limits. The connection was admitted by the server before it
+    was handed over
     '''
-    def _attemptsRemaining(self, username):
-        return serverSettings.allowedConsecutiveFailedPasswordAttempts - database.clientsLogin[username]['loginAttempts']
+    def _releaseAdmission(self):
+        if self._userAdmitted:
+            database.admission.releaseUser(self.username)
+            self._userAdmitted = False
+
+        database.admission.release()
 
     '''
-    Begin timer to run a function that ends the login timeout
+    Start capturing the frames of the connection, if the server is capturing traffic
     '''
-    def _beginEndTimeoutTimer(self, username):
-        threading.Timer(10.0, self._endTimeout, args=[username]).start()
+    def _startCapture(self):
+        if database.capture:
+            self._captureId = database.capture.openConnection(f'{self.addrName}:{self.addrPort}')
+
+    def _endCapture(self):
+        if self._captureId is not None:
+            database.capture.closeConnection(self._captureId)
+            self._captureId = None
 
     '''
-    End login timeout
+    Capture each frame as it is taken from the receive buffer, exactly as it arrived
     '''
-    def _endTimeout(self, username):
-        with threadLock.loginDataLock:
-            database.clientsLogin[username]['loginAttempts'] = 0
+    def _consume(self, size):
+        if self._captureId is not None:
+            self._captureFrame(memoryview(self._recvBuffer)[self._recvStart:self._recvStart + size])
+
+        super()._consume(size)
+
+    def _captureFrame(self, frame):
+        database.capture.recordFrame(self._captureId, frame)
+        self._capturedFrames += 1
+
+    '''
+    Record that the request or login in a frame has been handled, by default the last frame received
+    '''
+    def _captureReply(self, frameNumber=None):
+        if self._captureId is not None:
+            database.capture.recordReply(self._captureId, self._capturedFrames - 1 if frameNumber is None else frameNumber)
 
     def _receiveClientUDPPort(self):
         clientUDPPort = int(self.recvMessage())
         self.clientUDPPort = clientUDPPort
     
     '''
-    Update userlog with new login entry
+    Add the new login to the active users, and to the members of the room it starts in
+    '''
+    def _registerSession(self):
+        self._session = Session(self.username, self._getCurrTimestamp(), self.addrName, self.clientUDPPort)
+        database.sessions.login(self._session)
+        database.rooms.enter(self.room, self.username)
+
+    '''
+    Remove this connection's login from the active users and from the members of its room
     '''
-    def _userlogNewLogin(self):
-        with threadLock.userlogLock:
-            with open('userlog.txt', 'a') as userlog:
-                userlog.write(f'{database.nextUserlogNumber}; {self._getCurrTimestamp()}; {self.username}; {self.addrName}; {self.clientUDPPort}\n')
-            # Update nextUserlogNumber when there is a new login entry
-            database.nextUserlogNumber += 1
+    def _unregisterSession(self):
+        if self._session:
+            database.sessions.logout(self._session)
+            database.rooms.leave(self.room, self.username)
+            self._session = None
+
+    '''
+    Message store of the room the connection is in
+    '''
+    def _roomStore(self):
+        return database.rooms.store(self.room)
     
+    '''
+    Send message via TCP. Safe to call from the connection thread and the subscriber delivery thread
+    '''
+    def sendMessage(self, message, headers=None):
+        if self._collectBatchResponse(message):
+            return
+
+        headers = self._responseHeaders(headers)
+
+        with self._sendLock:
+            writeDeadline = self._startWriteDeadline()
+            sendStart = time.perf_counter()
+
+            try:
+                super().sendMessage(message, headers)
+            finally:
+                if writeDeadline:
+                    database.timers.cancel(writeDeadline)
+
+            database.metrics.observeSend(time.perf_counter() - sendStart)
+
+    '''
+    Drop the connection if a send takes longer than writeTimeout seconds, so a client that stops reading cannot hold
+    a thread in sendall for good. Dropping it makes the blocked send fail
+    '''
+    def _startWriteDeadline(self):
+        if serverSettings.writeTimeout:
+            return database.timers.schedule(serverSettings.writeTimeout, self._writeTimedOut)
+
+        return None
+
+    def _writeTimedOut(self):
+        print(f'{self.username or self.addrName} did not read its output for {serverSettings.writeTimeout:g} seconds and is disconnected.')
+        self._disconnect()
+
+    '''
+    Send a response that reports a failed command
+    '''
+    def _sendError(self, message):
+        batchResponses = currentBatchResponses.get()
+        if batchResponses is not None:
+            batchResponses.append((False, message))
+            return
+
+        self.sendMessage(message)
+
+    '''
+    Collect a response if a BATCH sub-command is being handled. Returns True if the response was collected
+    '''
+    def _collectBatchResponse(self, message):
+        batchResponses = currentBatchResponses.get()
+        if batchResponses is None:
+            return False
+
+        batchResponses.append((True, message))
+        return True
+
+    '''
+    Add the Request-Id of the request being handled to a response's header fields
+    '''
+    def _responseHeaders(self, headers):
+        requestId = currentRequestId.get()
+
+        if requestId is None:
+            return headers
+
+        return {**(headers or {}), 'Request-Id': requestId}
+
+    '''
+    Drop the connection, e.g. when it is too slow to keep up with live events
+    '''
+    def _disconnect(self):
+        try:
+            self.connectionSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    '''
+    Send a response made of several frames. frames generates (message, headers) pairs, reading each page from the
+    store as it is needed, so only one page is held at a time. Sends block until the frame is handed to the socket in
+    threaded mode, so the next page is only read once the client has taken the last one
+    '''
+    def _sendStream(self, frames):
+        for message, headers in frames:
+            self.sendMessage(message, headers)
+
+    def _createSubscriber(self):
+        return Subscriber(self._deliverEvent, self._disconnect, serverSettings.subscriberQueueSize, serverSettings.subscriberOverflowPolicy)
+
+    '''
+    Push a live event to the client. Events are marked with an Event header so clients can tell them apart from
+    command responses, and a Room header with the room they happened in
+    '''
+    def _deliverEvent(self, kind, payload, room, dropped):
+        headers = {'Event': kind, 'Room': room}
+        if dropped:
+            headers['Dropped'] = dropped
+
+        self.sendMessage(payload, headers)
+
+    def _unsubscribe(self):
+        if self._subscriber:
+            database.eventHub.unsubscribe(self._subscriber)
+            self._subscriber.close()
+            self._subscriber = None
+
     def _getRequest(self):
-        # Each request has format 'COMMAND; arg1; arg2; arg3; ...; arg(n)'
-        request = self.recvMessage()
+        command, args, requestId = self.recvRequest()
 
-        requestSplit = request.split('; ')
-        
-        command = requestSplit[0]
-        args = tuple(requestSplit[1:])
+        self._lastActivity = time.monotonic()
+        currentRequestId.set(requestId)
 
         return command, args
 
     def _doCommand(self, command, args):
-        if command not in self._commands:
+        entry = self.dispatchTable.get(command)
+
+        if entry is None:
             print(f'{self.username} issued an invalid command.')
-            self.sendMessage('Error. Invalid command!')
+            database.metrics.countInvalidCommand()
+            self._sendError('Error. Invalid command!')
             return
-        
-        commandFunc = self._commands[command]
-        # Get number of args from the function corresponding to command
-        numberOfArgs = len(signature(commandFunc).parameters)
 
-        if len(args) != numberOfArgs:
+        commandFunc, minArgs, maxArgs = entry
+
+        if not minArgs <= len(args) <= maxArgs:
             print(f'{self.username} issued an invalid command.')
-            self.sendMessage('Error. Invalid command!')
+            database.metrics.countInvalidCommand()
+            self._sendError('Error. Invalid command!')
             return
-        
-        if args:
-            self._commands[command](*args)
-        else:
-            self._commands[command]()
+
+        commandStart = time.perf_counter()
+        failed = True
+
+        try:
+            commandFunc(self, *args)
+            failed = False
+        except JournalFailed as error:
+            print(f'{self.username} issued {command}, which failed. {error}.')
+            self._sendError('Error. The server cannot save changes right now.')
+        finally:
+            # Failed commands are timed too, or an outage would look like a drop in latency
+            database.metrics.observeCommand(command, time.perf_counter() - commandStart, failed)
         
     def _msg(self, message):
         currTime = self._getCurrTimestamp()
 
         if message == '':
-            self.sendMessage('Invalid message was sent.')
+            self._sendError('Invalid message was sent.')
             print(f'{self.username} attempts to send a message, but has provided an invalid message.')
             return
         
-        with threadLock.messagelogLock:
-            messageNumber = database.nextMessageNumber
-            
-            with open('messagelog.txt', 'a') as messagelog:
-                messagelog.write(f'{messageNumber}; {currTime}; {self.username}; {message}; no\n')
-
-            # Update nextMessageNumber when new message is sent
-            database.nextMessageNumber += 1
+        messageNumber = self._roomStore().post(currTime, self.username, message)
 
         self.sendMessage(f'Message #{messageNumber} posted at {currTime}.')
 
@@ -177,59 +453,30 @@ class ServerConnection(Protocol):
         try:
             messageNumber = int(messageNumber)
         except:
-            self.sendMessage('Invalid message number.')
+            self._sendError('Invalid message number.')
             print(f'{self.username} attempts to delete MSG #{messageNumber} but has provided an invalid message number.')
             return
 
-        with threadLock.messagelogLock:
-            if messageNumber not in range(1, database.nextMessageNumber):
-                self.sendMessage('Invalid message number.')
-                print(f'{self.username} attempts to delete MSG #{messageNumber} but has provided an invalid message number.')
-                return
-            
-            with open('messagelog.txt', 'r') as messagelog:
-                lines = messagelog.readlines()
-            
-            line = lines[messageNumber - 1]
-            lineSplit = line.split('; ')
-
-            lineTimestamp = lineSplit[1]
-            lineUsername = lineSplit[2]
-            lineMessage = lineSplit[3]
-            
-            if timestamp != lineTimestamp:
-                self.sendMessage(f'Invalid timestamp for message #{messageNumber}.')
-                print(f'{self.username} attempts to delete MSG #{messageNumber} at {currTime} but has provided an invalid timestamp.')
-                return
-
-            if self.username != lineUsername:
-                self.sendMessage(f'Unauthorised to delete message #{messageNumber}.')
-                print(f'{self.username} attempts to delete MSG #{messageNumber} at {currTime}. Authorisation fails.')
-                return
+        result, record = self._roomStore().delete(messageNumber, timestamp, self.username)
 
-            del lines[messageNumber - 1]
-
-            newMessageNumber = 1
-
-            
-            for index, line in enumerate(lines):
-                lineSplit = line.split('; ')
-
-                lineSplit[0] = str(newMessageNumber)
-
-                lines[index] = '; '.join(lineSplit)
-
-                newMessageNumber += 1
+        if result == messageStore.INVALID_NUMBER:
+            self._sendError('Invalid message number.')
+            print(f'{self.username} attempts to delete MSG #{messageNumber} but has provided an invalid message number.')
+            return
 
-            # Rewrite messagelog file with updated changes
-            with open('messagelog.txt', 'w') as messagelog:
-                messagelog.write(''.join(lines))
+        if result == messageStore.INVALID_TIMESTAMP:
+            self._sendError(f'Invalid timestamp for message #{messageNumber}.')
+            print(f'{self.username} attempts to delete MSG #{messageNumber} at {currTime} but has provided an invalid timestamp.')
+            return
 
-            database.nextMessageNumber -= 1
+        if result == messageStore.UNAUTHORISED:
+            self._sendError(f'Unauthorised to delete message #{messageNumber}.')
+            print(f'{self.username} attempts to delete MSG #{messageNumber} at {currTime}. Authorisation fails.')
+            return
 
         self.sendMessage(f'Message #{messageNumber} deleted at {currTime}.')
 
-        print(f'{self.username} deleted MSG #{messageNumber} "{lineMessage}" at {currTime}.')
+        print(f'{self.username} deleted MSG #{messageNumber} "{record.message}" at {currTime}.')
 
     def _edt(self, messageNumber, timestamp, message):
         currTime = self._getCurrTimestamp()
@@ -237,151 +484,394 @@ class ServerConnection(Protocol):
         try:
             messageNumber = int(messageNumber)
         except:
-            self.sendMessage('Invalid message number.')
+            self._sendError('Invalid message number.')
             print(f'{self.username} attempts to edit MSG #{messageNumber} but has provided an invalid message number.')
             return
         
-        with threadLock.messagelogLock:
-            if messageNumber not in range(1, database.nextMessageNumber):
-                self.sendMessage('Invalid message number.')
-                print(f'{self.username} attempts to edit MSG #{messageNumber} but has provided an invalid message number.')
-                return
-            
-            with open('messagelog.txt', 'r') as messagelog:
-                lines = messagelog.readlines()
-            
-            line = lines[messageNumber - 1]
-            lineSplit = line.split('; ')
-
-            lineTimestamp = lineSplit[1]
-            lineUsername = lineSplit[2]
-            lineMessage = lineSplit[3]
-            
-            if timestamp != lineTimestamp:
-                self.sendMessage(f'Invalid timestamp for message #{messageNumber}.')
-                print(f'{self.username} attempts to edit MSG #{messageNumber} at {currTime} but has provided an invalid timestamp.')
-                return
-
-            if self.username != lineUsername:
-                self.sendMessage(f'Unauthorised to edit message #{messageNumber}.')
-                print(f'{self.username} attempts to edit MSG #{messageNumber} at {currTime}. Authorisation fails.')
-                return
+        result, record = self._roomStore().edit(messageNumber, timestamp, self.username, message, currTime)
 
-            newline = f'{messageNumber}; {currTime}; {self.username}; {message}; yes\n'
+        if result == messageStore.INVALID_NUMBER:
+            self._sendError('Invalid message number.')
+            print(f'{self.username} attempts to edit MSG #{messageNumber} but has provided an invalid message number.')
+            return
 
-            lines[messageNumber - 1] = newline
+        if result == messageStore.INVALID_TIMESTAMP:
+            self._sendError(f'Invalid timestamp for message #{messageNumber}.')
+            print(f'{self.username} attempts to edit MSG #{messageNumber} at {currTime} but has provided an invalid timestamp.')
+            return
 
-            with open('messagelog.txt', 'w') as messagelog:
-                messagelog.write(''.join(lines))
+        if result == messageStore.UNAUTHORISED:
+            self._sendError(f'Unauthorised to edit message #{messageNumber}.')
+            print(f'{self.username} attempts to edit MSG #{messageNumber} at {currTime}. Authorisation fails.')
+            return
                 
         self.sendMessage(f'Message #{messageNumber} edited at {currTime}.')
 
         print(f'{self.username} edited MSG #{messageNumber} "{message}" at {currTime}.')
 
-    def _rdm(self, timestamp):
+    def _rdm(self, timestamp, pageSize=None, cursor=None):
         try:
             dtTime = self._stripTime(timestamp)
         except ValueError:
-            self.sendMessage('Invalid timestamp.')
+            self._sendError('Invalid timestamp.')
             print(f'{self.username} issued RDM command but has provided an invalid timestamp.')
             return
-        
-        messages = []
-
-        with threadLock.messagelogLock:
-            with open('messagelog.txt', 'r') as messagelog:
-                for line in messagelog:
-                    lineSplit = line.split('; ')
-
-                    lineMessageNumber = lineSplit[0]
-                    lineTimestamp = lineSplit[1]
-                    lineUsername = lineSplit[2]
-                    lineMessage = lineSplit[3]
-                    lineEdited = lineSplit[4]
-                    
-                    lineDtTime = self._stripTime(lineTimestamp)
-
-                    if lineDtTime > dtTime:
-                        editOrPost = 'edited' if lineEdited == 'yes\n' else 'posted'
-                        messages.append(f'#{lineMessageNumber} {lineUsername}: "{lineMessage}", {editOrPost} at {lineTimestamp}\n')
-
-        if messages:
-            messagesStr = ''.join(messages)
-            self.sendMessage(messagesStr)
-        else:
-            self.sendMessage('no new message')
-        
-        print(f'{self.username} issued RDM command\nReturn messages:')
-        
-        if messages:
-            print(messagesStr)
-        else:
-            print('(no new message)')
 
-    def _atu(self):
-        activeUserList = []
+        if pageSize is not None:
+            try:
+                pageSize = int(pageSize)
+            except ValueError:
+                pageSize = 0
+
+            if not 1 <= pageSize <= serverSettings.maxRdmPageSize:
+                self._sendError(f'Invalid page size. A page must have between 1 and {serverSettings.maxRdmPageSize} messages.')
+                print(f'{self.username} issued RDM command but has provided an invalid page size.')
+                return
+
+        try:
+            messages, nextCursor = self._roomStore().messagesSince(dtTime, pageSize, cursor)
+        except ValueError:
+            self._sendError('Invalid cursor.')
+            print(f'{self.username} issued RDM command but has provided an invalid cursor.')
+            return
+
+        response = self._formatMessages(messages) if messages else 'no new message'
+
+        # The cursor is the last line of a page that has more messages after it
+        if nextCursor:
+            response += f'Cursor: {nextCursor}\n'
+
+        self.sendMessage(response)
+
+        print(f'{self.username} issued RDM command. Returned {len(messages)} messages.')
+
+    def _rds(self, timestamp):
+        try:
+            dtTime = self._stripTime(timestamp)
+        except ValueError:
+            self._sendError('Invalid timestamp.')
+            print(f'{self.username} issued RDS command but has provided an invalid timestamp.')
+            return
+
+        self._sendStream(self._rdsFrames(self._roomStore(), dtTime))
+
+    '''
+    Frames of an RDS response, a page of messages each
+    '''
+    def _rdsFrames(self, store, dtTime):
+        messageCount = 0
+
+        # Every frame but the last has a More header
+        for messages, more in store.iterMessagesSince(dtTime, serverSettings.rdsPageSize):
+            response = self._formatMessages(messages) if messages else 'no new message'
+
+            yield response, {'More': 'yes'} if more else None
+
+            messageCount += len(messages)
+
+        print(f'{self.username} issued RDS command. Returned {messageCount} messages.')
+
+    def _syn(self, token=''):
+        store = self._roomStore()
+
+        try:
+            changes, nextToken, more = store.changesSince(token, serverSettings.syncPageSize)
+        except ValueError:
+            self._sendError('Invalid sync token.')
+            print(f'{self.username} issued SYN command but has provided an invalid sync token.')
+            return
+
+        self._sendStream(self._synFrames(store, changes, nextToken, more))
+
+    '''
+    Frames of a SYN response, given the first page of changes since the token
+    '''
+    def _synFrames(self, store, changes, nextToken, more):
+        changeCount = 0
+
+        # Every frame but the last has a More header, like RDS, and the last ends with the token to sync from next
+        while changes is not None and more:
+            yield self._formatChanges(changes), {'More': 'yes'}
+
+            changeCount += len(changes)
+            changes, nextToken, more = store.changesSince(nextToken, serverSettings.syncPageSize)
+
+        if changes is not None:
+            yield self._formatChanges(changes) + f'Sync: {nextToken}\n', None
+            print(f'{self.username} issued SYN command. Returned {changeCount + len(changes)} changes.')
+            return
+
+        # The store cannot tell what changed since the token, so the client is told to start over and sent every
+        # message. Changes made while they are sent are listed by the next sync from the token
+        response = 'Reset\n'
+        messageCount = 0
+
+        for messages, more in store.iterLiveMessages(serverSettings.syncPageSize):
+            response += self._formatChanges(messages)
+            messageCount += len(messages)
+
+            if more:
+                yield response, {'More': 'yes'}
+                response = ''
+
+        yield response + f'Sync: {nextToken}\n', None
+
+        print(f'{self.username} issued SYN command. Reset with {messageCount} messages.')
+
+    def _srh(self, query, username='', since='', until=''):
+        try:
+            sinceTime = self._stripTime(since) if since else None
+            untilTime = self._stripTime(until) if until else None
+        except ValueError:
+            self._sendError('Invalid timestamp.')
+            print(f'{self.username} issued SRH command but has provided an invalid timestamp.')
+            return
+
+        if not splitWords(query):
+            self._sendError('Nothing to search for. A search needs at least one word.')
+            print(f'{self.username} issued SRH command but has provided no words to search for.')
+            return
+
+        messages, more = self._roomStore().search(
+            query, username or None, sinceTime, untilTime, serverSettings.maxSearchResults
+        )
+
+        if messages is None:
+            self._sendError('Search is not available yet, the server is still indexing messages. Try again shortly.')
+            print(f'{self.username} issued SRH command before the search index was built.')
+            return
+
+        response = self._formatMessages(messages) if messages else 'no matching message'
+
+        if more:
+            response += f'More than {len(messages)} messages match, only the latest are listed.\n'
+
+        self.sendMessage(response)
+
+        print(f'{self.username} issued SRH command for "{query}". Returned {len(messages)} messages.')
+
+    '''
+    Format (kind, message id, timestamp, username, message) change tuples as SYN response lines. A deleted message
+    is only identified by its id
+    '''
+    def _formatChanges(self, changes):
+        lines = []
+
+        for kind, messageId, timestamp, username, message in changes:
+            if kind == 'DLT':
+                lines.append(f'DLT; {messageId}\n')
+            else:
+                lines.append(f'{kind}; {messageId}; {timestamp}; {username}; {message}\n')
+
+        return ''.join(lines)
 
-        with threadLock.userlogLock:
-            with open('userlog.txt', 'r') as userlog:
-                for line in userlog:
-                    lineSplit = line.split('; ')
+    '''
+    Format (message number, timestamp, username, message, edited) tuples as RDM response lines
+    '''
+    def _formatMessages(self, messages):
+        lines = []
+
+        for messageNumber, timestamp, username, message, edited in messages:
+            editOrPost = 'edited' if edited else 'posted'
+            lines.append(f'#{messageNumber} {username}: "{message}", {editOrPost} at {timestamp}\n')
 
-                    lineTimestamp = lineSplit[1]
-                    lineUsername = lineSplit[2]
-                    lineAddrName = lineSplit[3]
-                    lineUDPPort = lineSplit[4].rstrip('\n')
+        return ''.join(lines)
 
-                    if lineUsername != self.username:
-                        activeUserList.append(f'{lineUsername}, {lineAddrName}, {lineUDPPort}, active since {lineTimestamp}\n')
+    def _atu(self):
+        activeUserStr = database.sessions.atuResponse(self.username)
         
-        if activeUserList:
-            activeUserStr = ''.join(activeUserList)
+        if activeUserStr:
             self.sendMessage(activeUserStr)
         else:
             self.sendMessage('no other active user')
 
         print(f'{self.username} issued ATU command\nReturn active user list:')
 
-        if activeUserList:
+        if activeUserStr:
             print(activeUserStr)
         else:
             print('(no other active user)')   
 
-    def _logout(self):
-        with threadLock.userlogLock:
-            with open('userlog.txt', 'r') as userlog:
-                lines = userlog.readlines()
-                
-            for index, line in enumerate(lines):
-                lineSplit = line.split('; ')
-                
-                lineUsername = lineSplit[2]
-                
-                if lineUsername == self.username:
-                    break
+    def _enc(self, encoding):
+        if encoding != 'none' and encoding not in contentEncodings:
+            self._sendError(f'Unsupported encoding. Supported encodings: {", ".join(contentEncodings)}.')
+            print(f'{self.username} issued ENC command with unsupported encoding {encoding}.')
+            return
 
-            del lines[index]
+        # The acknowledgement is sent with the old encoding, so the client can rely on everything after it
+        self.sendMessage(f'Encoding set to {encoding}.')
+        self._setContentEncoding(None if encoding == 'none' else encoding)
 
-            newUserlogNumber = 1
+        print(f'{self.username} issued ENC command. Encoding set to {encoding}.')
 
-            for index, line in enumerate(lines):
-                lineSplit = line.split('; ')
+    '''
+    Change the encoding of outgoing messages. Takes the send lock so a live event is never sent half way through
+    '''
+    def _setContentEncoding(self, contentEncoding):
+        with self._sendLock:
+            self.contentEncoding = contentEncoding
+
+    def _batch(self, requests):
+        if not requests or len(requests) > serverSettings.maxBatchSize:
+            self._sendError(f'Invalid batch. A batch must have between 1 and {serverSettings.maxBatchSize} commands.')
+            print(f'{self.username} issued an invalid BATCH command.')
+            return
 
-                lineSplit[0] = str(newUserlogNumber)
+        results = []
+        index = 0
 
-                lines[index] = '; '.join(lineSplit)
+        while index < len(requests):
+            command, args = requests[index]
 
-                newUserlogNumber += 1
+            if command == 'MSG' and len(args) == 1:
+                # Consecutive MSGs are posted together, under one store lock hold and one journal write
+                end = index
+                while end < len(requests) and requests[end][0] == 'MSG' and len(requests[end][1]) == 1:
+                    end += 1
 
-            # Rewrite userlog file with updated changes
-            with open('userlog.txt', 'w') as userlog:
-                userlog.write(''.join(lines))
+                results.extend(self._batchMsg([args[0] for _, args in requests[index:end]]))
+                index = end
+                continue
 
-            database.nextUserlogNumber -= 1
+            if command in unbatchableCommands:
+                results.append((False, f'{command} cannot be part of a batch.'))
+            else:
+                results.extend(self._collectResponses(self._doCommand, command, args))
 
-        self.sendMessage(f'Bye, {self.username}!')
+            index += 1
+
+        self.sendMessage('\n'.join(
+            f'[{itemNumber}] {"OK" if succeeded else "ERR"}: {response.rstrip()}'
+            for itemNumber, (succeeded, response) in enumerate(results, 1)
+        ))
+
+        print(f'{self.username} issued BATCH command with {len(requests)} commands.')
+
+    '''
+    Post the messages of a run of MSG commands in a batch. Returns a (succeeded, response) pair per message
+    '''
+    def _batchMsg(self, messages):
+        currTime = self._getCurrTimestamp()
+
+        validMessages = [message for message in messages if message != '']
+        messageNumbers = iter(self._roomStore().postMany(currTime, self.username, validMessages))
+
+        results = []
+
+        for message in messages:
+            if message == '':
+                results.append((False, 'Invalid message was sent.'))
+                print(f'{self.username} attempts to send a message, but has provided an invalid message.')
+                continue
+
+            messageNumber = next(messageNumbers)
+            results.append((True, f'Message #{messageNumber} posted at {currTime}.'))
+            print(f'{self.username} posted MSG #{messageNumber} "{message}" at {currTime}.')
+
+        return results
+
+    '''
+    Run a command handler and return the (succeeded, response) pairs it sent instead of sending them
+    '''
+    def _collectResponses(self, func, *args):
+        responses = []
+
+        token = currentBatchResponses.set(responses)
+        try:
+            func(*args)
+        finally:
+            currentBatchResponses.reset(token)
+
+        return responses
+
+    def _sub(self):
+        if self._subscriber:
+            self._sendError('Already subscribed to live messages.')
+            print(f'{self.username} issued SUB command but is already subscribed.')
+            return
+
+        self.sendMessage('Subscribed to live messages.')
 
-        self.socket.close()
+        self._subscriber = self._createSubscriber()
+        self._subscriber.start()
+        database.eventHub.subscribe(self._subscriber, self.room)
+
+        print(f'{self.username} subscribed to live messages.')
+
+    def _join(self, room):
+        if not roomRegistry.isValidRoomName(room):
+            self._sendError('Invalid room name. A room name is 1 to 32 letters, digits, - or _.')
+            print(f'{self.username} issued JOIN command but has provided an invalid room name.')
+            return
+
+        if room == self.room:
+            self._sendError(f'Already in room {room}.')
+            print(f'{self.username} issued JOIN command but is already in room {room}.')
+            return
+
+        result = database.rooms.join(room, self.username, self.room)
+
+        if result == roomRegistry.TOO_MANY_ROOMS:
+            self._sendError(f'Room {room} cannot be created, the server has as many rooms as it allows.')
+            print(f'{self.username} attempts to create room {room}, but there are too many rooms.')
+            return
+
+        self._moveToRoom(room)
+
+        self.sendMessage(f'Created and joined room {room}.' if result == roomRegistry.CREATED else f'Joined room {room}.')
+
+        print(f'{self.username} joined room {room}.')
+
+    def _leave(self):
+        if self.room == serverSettings.defaultRoom:
+            self._sendError(f'Not in a room to leave. Already in the default room {self.room}.')
+            print(f'{self.username} issued LEAVE command but is in the default room.')
+            return
+
+        room = self.room
+        database.rooms.join(serverSettings.defaultRoom, self.username, room)
+        self._moveToRoom(serverSettings.defaultRoom)
+
+        self.sendMessage(f'Left room {room}, back in room {self.room}.')
+
+        print(f'{self.username} left room {room}.')
+
+    '''
+    Make the connection's commands act on the messages of room, and send it the live events of room if it is
+    subscribed
+    '''
+    def _moveToRoom(self, room):
+        self.room = room
+
+        if self._subscriber:
+            database.eventHub.subscribe(self._subscriber, room)
+
+    def _rooms(self):
+        lines = []
+
+        for room, messageCount, userCount in database.rooms.summary():
+            here = ' (you are here)' if room == self.room else ''
+            lines.append(f'{room}: {messageCount} messages, {userCount} users{here}\n')
+
+        self.sendMessage(''.join(lines))
+
+        print(f'{self.username} issued ROOMS command.')
+
+    def _stats(self):
+        if self.username not in serverSettings.adminUsers:
+            self._sendError('Unauthorised to issue STATS.')
+            print(f'{self.username} issued STATS command but is not an admin.')
+            return
+
+        self.sendMessage(metrics.formatStats(database.metrics.combinedSnapshot()))
+
+        print(f'{self.username} issued STATS command.')
+
+    def _logout(self):
+        self._unsubscribe()
+        self._unregisterSession()
+
+        self.sendMessage(f'Bye, {self.username}!')
 
         print(f'{self.username} logout')
 
@@ -390,3 +880,22 @@ class ServerConnection(Protocol):
 
     def _stripTime(self, timeStr):
         return datetime.datetime.strptime(timeStr, '%d %b %Y %H:%M:%S')
+
+    dispatchTable = buildDispatchTable({
+        'MSG': _msg, # post message, MSG; <message>
+        'DLT': _dlt, # delete message, DLT; <message number>; <timestamp>
+        'EDT': _edt, # edit message, EDT; <message number>; <timestamp>; <new message>
+        'RDM': _rdm, # read messages, RDM; <timestamp>[; <page size>[; <cursor>]]
+        'RDS': _rds, # read messages as a stream of frames, RDS; <timestamp>
+        'ATU': _atu, # list active users, ATU
+        'OUT': _logout, # logout, OUT
+        'SUB': _sub, # subscribe to live messages, SUB
+        'BATCH': _batch, # run many commands in one request, BATCH\n<command>\n<command>...
+        'ENC': _enc, # compress large responses, ENC; <encoding> (or 'none' to turn compression off)
+        'STATS': _stats, # server metrics, admins only, STATS
+        'SYN': _syn, # changes since the last sync, SYN[; <sync token>]
+        'SRH': _srh, # search messages, SRH; <words>[; <username>[; <since>[; <until>]]]
+        'JOIN': _join, # move to a room, creating it if there is none of that name, JOIN; <room>
+        'LEAVE': _leave, # move back to the default room, LEAVE
+        'ROOMS': _rooms, # list the rooms, ROOMS
+    })
@@ -0,0 +1,65 @@
+'''
+Admission control for client connections.
+Counts the open connections, and the connections logged in as each user, so that the server can turn new
+connections away once maxConnections or maxConnectionsPerUser is reached rather than take on more than it can
+serve. A limit of 0 means no limit.
+'''
+
+# Header field marking a response that rejects the connection, with the limit that was reached ('server' or 'user')
+# as its value. The server closes the connection after sending it
+rejectedHeader = 'Rejected'
+
+'''
+Raised to end a connection that has been sent a rejection
+'''
+class ConnectionRejected(Exception):
+    pass
+
+class AdmissionControl:
+    '''
+    lock guards every read and write of the counts
+    '''
+    def __init__(self, lock, maxConnections, maxConnectionsPerUser):
+        self.lock = lock
+        self.maxConnections = maxConnections
+        self.maxConnectionsPerUser = maxConnectionsPerUser
+        self._connections = 0
+        # Number of connections logged in as each user, for users with at least one
+        self._userConnections = {}
+
+    '''
+    Admit a new connection. Returns False if the server is full, in which case the connection must be closed
+    '''
+    def admit(self):
+        with self.lock:
+            if self.maxConnections and self._connections >= self.maxConnections:
+                return False
+
+            self._connections += 1
+
+        return True
+
+    def release(self):
+        with self.lock:
+            self._connections -= 1
+
+    '''
+    Admit a connection logging in as username. Returns False if the user has as many connections as allowed
+    '''
+    def admitUser(self, username):
+        with self.lock:
+            userConnections = self._userConnections.get(username, 0)
+
+            if self.maxConnectionsPerUser and userConnections >= self.maxConnectionsPerUser:
+                return False
+
+            self._userConnections[username] = userConnections + 1
+
+        return True
+
+    def releaseUser(self, username):
+        with self.lock:
+            userConnections = self._userConnections.pop(username) - 1
+
+            if userConnections:
+                self._userConnections[username] = userConnections
@@ -2,6 +2,30 @@
 Database storing server information. Is initialised during server startup
 '''
 
-clientsLogin = {}
-nextUserlogNumber = 0
-nextMessageNumber = 0
+# metrics.Metrics recording command latencies, lock waits and traffic
+metrics = None
+
+# trafficCapture.CaptureWriter recording inbound frames, or None when not capturing
+capture = None
+
+# timerWheel.TimerWheel running lockout expiry and connection deadlines
+timers = None
+
+# admissionControl.AdmissionControl counting open connections against the connection limits
+admission = None
+
+# loginRegistry.LoginRegistry holding the accounts and their failed login attempts
+logins = None
+
+# sessionRegistry.SessionRegistry holding the logged in users
+sessions = None
+# snapshotWriter.SnapshotWriter keeping userlog.txt up to date with sessions
+userlogExport = None
+
+# roomRegistry.RoomRegistry holding the chat rooms, each with a messageStore.MessageStore of its messages and
+# snapshotWriter.SnapshotWriters keeping its messagelog.txt export and its snapshot, which startup loads before the
+# journal, up to date
+rooms = None
+
+# eventHub.EventHub delivering live changes to subscribed connections
+eventHub = None
@@ -0,0 +1,126 @@
+'''
+Live delivery of chatroom changes to subscribed connections.
+
+Each new, edited or deleted message is published once its journal write is durable, and offered to every
+subscriber in the room it was posted in, see roomRegistry.py. Subscribers buffer events in a bounded queue that is drained by their own delivery loop, so a slow
+subscriber never holds up the publisher. When a subscriber's queue is full, the overflow policy decides whether
+the event is dropped ('drop') or the subscriber is disconnected ('disconnect').
+'''
+
+import threading
+from collections import deque
+
+overflowPolicies = ('drop', 'disconnect')
+
+'''
+Format a change notice from the message store of room as a (kind, payload, room) event
+'''
+def formatEvent(notice, room):
+    kind, messageNumber, timestamp, username, message = notice
+
+    return kind, f'{kind}; {messageNumber}; {timestamp}; {username}; {message}', room
+
+class EventHub:
+    def __init__(self):
+        # The room each subscriber gets the events of, or None for every room
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    '''
+    Offer subscriber the events of room from now on, or of every room if room is None. Subscribing again moves the
+    subscriber to another room
+    '''
+    def subscribe(self, subscriber, room=None):
+        with self._lock:
+            self._subscribers[subscriber] = room
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    '''
+    Offer change notices from the message store of room to its subscribers. Never blocks on a subscriber
+    '''
+    def publish(self, notices, room):
+        with self._lock:
+            if not self._subscribers:
+                return
+
+        self.publishEvents([formatEvent(notice, room) for notice in notices])
+
+    '''
+    Offer already formatted (kind, payload, room) events to the subscribers of their rooms. Never blocks on a
+    subscriber
+    '''
+    def publishEvents(self, events):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+
+        for subscriber, subscribedRoom in subscribers:
+            for kind, payload, room in events:
+                if subscribedRoom is None or subscribedRoom == room:
+                    subscriber.offer(kind, payload, room)
+
+class Subscriber:
+    '''
+    deliver(kind, payload, room, dropped) sends an event to the client, where dropped is the number of events dropped
+    since the last delivery. disconnect() is called if the queue overflows under the 'disconnect' policy
+    '''
+    def __init__(self, deliver, disconnect, maxQueued, overflowPolicy):
+        self._deliver = deliver
+        self._disconnect = disconnect
+        self._maxQueued = maxQueued
+        self._overflowPolicy = overflowPolicy
+        self._queue = deque()
+        self._dropped = 0
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(name='SubscriberDelivery', target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, kind, payload, room):
+        with self._condition:
+            if self._closed:
+                return
+
+            if len(self._queue) >= self._maxQueued:
+                if self._overflowPolicy == 'drop':
+                    self._dropped += 1
+                    return
+
+                self._closed = True
+                self._condition.notify()
+                overflowed = True
+            else:
+                self._queue.append((kind, payload, room))
+                self._condition.notify()
+                overflowed = False
+
+        if overflowed:
+            self._disconnect()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+
+                if self._closed:
+                    return
+
+                kind, payload, room = self._queue.popleft()
+                dropped = self._dropped
+                self._dropped = 0
+
+            try:
+                self._deliver(kind, payload, room, dropped)
+            except OSError:
+                self.close()
+                return
@@ -0,0 +1,267 @@
+'''
+Group commit writer for the message journal.
+
+Changes are queued to a single writer thread, which takes everything waiting in the queue as one batch, writes it
+to the journal in one write and acknowledges every change in the batch once it is durable. How durable depends on
+the durability mode:
+- 'fsync': fsync after every batch, so an acknowledged change survives a power loss
+- 'periodic': fsync at most once every fsyncInterval seconds, so a crash loses at most that much
+- 'buffered': leave flushing to the OS, so only a process crash is survived
+
+If the journal cannot be written, every change in the failed batch fails with JournalFailed and is undone, and the
+journal is cut back to where the batch started, so neither the store nor the journal keeps a change that was
+reported as failed. The writer then stays failed, undoing and turning away every later change, so the store becomes
+read only rather than acknowledging changes it could not journal.
+'''
+
+import os
+import json
+import time
+import threading
+
+durabilityModes = ('fsync', 'periodic', 'buffered')
+
+class JournalFailed(Exception):
+    pass
+
+class JournalEntry:
+    __slots__ = ('apply', 'undo', 'applied', 'result', 'error', '_done')
+
+    def __init__(self, apply, undo=None, applied=False):
+        # Called on the writer thread with the batch lock held. Returns a list of journal events, a result for the
+        # waiter and a list of change notices passed to JournalWriter.onDurable
+        self.apply = apply
+        # Called with the batch lock held to take the change back out of the store if it cannot be journaled. Only
+        # called once the change has been applied, which changes queued with submitEvents already are
+        self.undo = undo
+        self.applied = applied
+        self.result = None
+        self.error = None
+        # Held until the entry is durable. A bare lock is much cheaper to signal than a threading.Event
+        self._done = threading.Lock()
+        self._done.acquire()
+
+    '''
+    Wait for the change to be durable and return its result
+    '''
+    def wait(self):
+        self._done.acquire()
+        self._done.release()
+
+        if self.error:
+            raise self.error
+
+        return self.result
+
+class JournalWriter:
+    '''
+    lock is held while a batch's entries are applied, so changes are applied in the order they are journaled
+    '''
+    def __init__(self, path, lock, durability='fsync', fsyncInterval=1.0):
+        if durability not in durabilityModes:
+            raise ValueError(f'Invalid journal durability mode: {durability}')
+
+        self.path = path
+        self.durability = durability
+        self._lock = lock
+        self._fsyncInterval = fsyncInterval
+        self._journal = open(path, 'a')
+        # Size of the journal once the last batch was written, which a failed write is cut back to
+        self._journalSize = os.fstat(self._journal.fileno()).st_size
+        self._lastFsync = time.monotonic()
+        self._unsynced = False
+        # Entries waiting for the writer thread, guarded by _pendingCondition. The writer takes the whole list
+        # as its next batch
+        self._pending = []
+        self._pendingCondition = threading.Condition(threading.Lock())
+        self._stopping = False
+        self._thread = threading.Thread(name='JournalWriter', target=self._run, daemon=True)
+        # Called on the writer thread with the change notices of each batch once it is durable
+        self.onDurable = None
+        # Called on the writer thread with the seconds each write to the journal took, syncing included
+        self.onWrite = None
+        # The JournalFailed every change is turned away with, once a write to the journal has failed
+        self.failure = None
+
+    def start(self):
+        self._thread.start()
+
+    '''
+    Write all queued changes and close the journal
+    '''
+    def stop(self):
+        if self._thread.is_alive():
+            with self._pendingCondition:
+                self._stopping = True
+                self._pendingCondition.notify()
+            self._thread.join()
+
+        if not self.failure:
+            self._sync()
+            self._journal.close()
+            return
+
+        # The file's buffer may still hold the write that failed. Closing the file under it first drops it, rather than
+        # flushing it after the journal was cut back
+        self._journal.buffer.raw.close()
+        self._journal.close()
+
+    '''
+    Raise JournalFailed if the journal can no longer be written. For changes applied before they are queued
+    '''
+    def checkWritable(self):
+        if self.failure:
+            raise self.failure
+
+    '''
+    Queue a change, and the undo for it, see JournalEntry. Returns a JournalEntry to wait on
+    '''
+    def submit(self, apply, undo=None, applied=False):
+        entry = JournalEntry(apply, undo, applied)
+
+        with self._pendingCondition:
+            self._pending.append(entry)
+            self._pendingCondition.notify()
+
+        return entry
+
+    '''
+    Queue events for changes that have already been applied to the store. Returns a JournalEntry to wait on
+    '''
+    def submitEvents(self, events, notices=(), undo=None):
+        return self.submit(lambda: (events, None, notices), undo, True)
+
+    '''
+    Returns a JournalEntry that is done once every change queued so far is durable, or fails if one of them failed
+    '''
+    def barrier(self):
+        entry = JournalEntry(lambda: ((), None, ()))
+
+        with self._pendingCondition:
+            # Once stopping, everything queued is written before the writer thread ends
+            if not self._stopping:
+                self._pending.append(entry)
+                self._pendingCondition.notify()
+                return entry
+
+        self._release([entry], self.failure)
+        return entry
+
+    '''
+    Write events straight away from the calling thread. Only for use before the writer thread is started
+    '''
+    def append(self, events):
+        self._write(events)
+
+    def _run(self):
+        while True:
+            with self._pendingCondition:
+                while not self._pending and not self._stopping:
+                    # Without new changes, unsynced data still gets synced once the interval is up
+                    if self._unsynced:
+                        if not self._pendingCondition.wait(self._fsyncInterval):
+                            break
+                    else:
+                        self._pendingCondition.wait()
+
+                batch = self._pending
+                self._pending = []
+                stopping = self._stopping
+
+            if batch:
+                self._commit(batch)
+            elif self._unsynced and not self.failure:
+                try:
+                    self._sync()
+                except OSError as error:
+                    self._fail(error)
+
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        events = []
+        notices = []
+
+        if self.failure:
+            self._undo(batch)
+            self._release(batch, self.failure)
+            return
+
+        with self._lock:
+            for entry in batch:
+                try:
+                    entryEvents, entry.result, entryNotices = entry.apply()
+                    entry.applied = True
+                    events.extend(entryEvents)
+                    notices.extend(entryNotices)
+                except Exception as error:
+                    entry.error = error
+
+        try:
+            self._write(events)
+        except OSError as error:
+            self._fail(error)
+            self._undo(batch)
+            self._release(batch, self.failure)
+            return
+
+        self._release(batch)
+
+        if self.onDurable and notices:
+            self.onDurable(notices)
+
+    def _write(self, events):
+        if not events:
+            return
+
+        writeStart = time.perf_counter()
+
+        try:
+            self._journal.write(''.join(json.dumps(event) + '\n' for event in events))
+            self._journal.flush()
+            self._unsynced = self.durability == 'periodic'
+
+            if self.durability == 'fsync':
+                self._sync()
+            elif self.durability == 'periodic' and time.monotonic() - self._lastFsync >= self._fsyncInterval:
+                self._sync()
+        except OSError:
+            # Cut off whatever part of the batch made it into the file, so a restart does not replay half of it
+            try:
+                os.ftruncate(self._journal.fileno(), self._journalSize)
+            except OSError:
+                pass
+            raise
+
+        self._journalSize = os.fstat(self._journal.fileno()).st_size
+
+        if self.onWrite:
+            self.onWrite(time.perf_counter() - writeStart)
+
+    '''
+    Take the applied changes of a batch that cannot be journaled back out of the store, newest first
+    '''
+    def _undo(self, batch):
+        with self._lock:
+            for entry in reversed(batch):
+                if entry.applied and entry.undo:
+                    entry.undo()
+
+    '''
+    Wake the waiters of a batch, failing every entry in it with error if given
+    '''
+    def _release(self, batch, error=None):
+        for entry in batch:
+            if error:
+                entry.error = error
+            entry._done.release()
+
+    def _fail(self, error):
+        self.failure = JournalFailed(f'Could not write to {self.path} ({error}), the message store is read only')
+        print(f'{self.failure}.')
+
+    def _sync(self):
+        os.fsync(self._journal.fileno())
+        self._lastFsync = time.monotonic()
+        self._unsynced = False
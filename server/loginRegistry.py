@@ -0,0 +1,72 @@
+'''
+Login state of the accounts in credentials.txt.
+Each account counts its consecutive failed password attempts. An account that runs out of attempts is locked out
+until lockoutDuration seconds have passed. Lockouts expire on a shared timer wheel rather than a thread each, so a
+burst of failed logins against many accounts costs one small timer per account.
+'''
+
+# Results of login attempts
+LOGGED_IN = 'logged in'
+INVALID_USERNAME = 'invalid username'
+BLOCKED = 'blocked'
+INVALID_PASSWORD = 'invalid password'
+LOCKED_OUT = 'locked out'
+
+class LoginRegistry:
+    '''
+    lock guards every read and write of the registry. allowedAttempts is the number of consecutive failed password
+    attempts before an account is locked out. timers is the timerWheel.TimerWheel that ends lockouts
+    '''
+    def __init__(self, lock, allowedAttempts, timers, lockoutDuration=10.0):
+        self.lock = lock
+        self.allowedAttempts = allowedAttempts
+        self.lockoutDuration = lockoutDuration
+        self._timers = timers
+        # Passwords and failed login attempts keyed by username
+        self._accounts = {}
+
+    def addAccount(self, username, password):
+        with self.lock:
+            self._accounts[username] = {
+                'password': password,
+                'loginAttempts': 0,
+            }
+
+    '''
+    Check a login attempt. Returns the result and the number of attempts remaining before a lockout
+    '''
+    def attempt(self, username, password):
+        with self.lock:
+            account = self._accounts.get(username)
+
+            if account is None:
+                return INVALID_USERNAME, 0
+
+            if self._attemptsRemaining(account) <= 0:
+                return BLOCKED, 0
+
+            if account['password'] != password:
+                account['loginAttempts'] += 1
+
+                attemptsRemaining = self._attemptsRemaining(account)
+
+                if attemptsRemaining <= 0:
+                    self._beginLockoutTimer(username)
+                    return LOCKED_OUT, 0
+
+                return INVALID_PASSWORD, attemptsRemaining
+
+            return LOGGED_IN, self._attemptsRemaining(account)
+
+    def _attemptsRemaining(self, account):
+        return self.allowedAttempts - account['loginAttempts']
+
+    '''
+    Begin timer to run a function that ends the lockout
+    '''
+    def _beginLockoutTimer(self, username):
+        self._timers.schedule(self.lockoutDuration, self._endLockout, username)
+
+    def _endLockout(self, username):
+        with self.lock:
+            self._accounts[username]['loginAttempts'] = 0
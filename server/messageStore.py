@@ -0,0 +1,840 @@
+'''
+In-memory message store backed by an append-only journal.
+
+Every message ever posted gets a permanent message id and a slot in an indexed table. Deleting a message only
+empties its slot, and the message numbers shown to clients are derived on demand by counting the live slots
+before it, so a delete never has to renumber the messages after it.
+
+Changes are appended to the journal file as MSG, EDT and DLT events, one JSON array per line. The store is also
+saved now and then as a snapshot, which records how much of the journal it covers. Startup loads the snapshot and
+replays only the journal after it, so restarting does not mean parsing every event ever journaled. Without a
+snapshot the whole journal is replayed. messagelog.txt is a materialized export of the store in the original log
+format.
+
+Next to the table the store keeps a sorted index of (epoch seconds, message id) keys for the time each message
+was posted or last edited, so reading the messages newer than a timestamp is a binary search plus the tail.
+
+Message text is also indexed word by word for search, see searchIndex.py. The index is not saved but built again
+after loading, in the background, so it does not hold up startup.
+
+For delta sync, every change is also numbered with a change sequence number and the most recent changes are kept in
+memory. A sync token names a point in that sequence, so a client can ask for the changes since its last sync. The
+sequence starts over each time the store is created, so tokens carry a random generation that changes with it.
+'''
+
+import os
+import gc
+import json
+import bisect
+import itertools
+import functools
+import threading
+import pickle
+import calendar
+import datetime
+
+from journalWriter import JournalWriter
+from searchIndex import SearchIndex, splitWords
+
+timestampFormat = '%d %b %Y %H:%M:%S'
+
+# Results of store operations
+OK = 'ok'
+INVALID_NUMBER = 'invalid message number'
+INVALID_TIMESTAMP = 'invalid timestamp'
+UNAUTHORISED = 'unauthorised'
+
+# Version of the snapshot format. Snapshots of other versions are ignored and the whole journal is replayed
+snapshotVersion = 1
+
+'''
+Convert a datetime to whole seconds since the epoch. Timestamps carry no timezone, so they are all read as UTC
+'''
+def toEpoch(dtTime):
+    return calendar.timegm(dtTime.timetuple())
+
+def parseTimestamp(timestamp):
+    return toEpoch(datetime.datetime.strptime(timestamp, timestampFormat))
+
+'''
+A cursor marks a position in the time index, as '<epoch>:<message id>'. Message ids never change, unlike message
+numbers, so a cursor stays valid when earlier messages are deleted
+'''
+def formatCursor(key):
+    return f'{key[0]}:{key[1]}'
+
+'''
+Parse a cursor into a time index key. Raises ValueError if the cursor is malformed
+'''
+def parseCursor(cursor):
+    epoch, separator, messageId = cursor.partition(':')
+    if not separator:
+        raise ValueError(f'Malformed cursor: {cursor}')
+
+    return int(epoch), int(messageId)
+
+'''
+A sync token is '<generation>.<change sequence number>', the point in a store's changes a client has synced up to
+'''
+def formatSyncToken(generation, changeSeq):
+    return f'{generation}.{changeSeq}'
+
+'''
+Parse a sync token into its generation and change sequence number. Raises ValueError if the token is malformed
+'''
+def parseSyncToken(token):
+    generation, separator, changeSeq = token.partition('.')
+    if not separator:
+        raise ValueError(f'Malformed sync token: {token}')
+
+    return generation, int(changeSeq)
+
+class Message:
+    __slots__ = ('messageId', 'timestamp', 'epoch', 'username', 'message', 'edited')
+
+    def __init__(self, messageId, timestamp, username, message, edited=False, epoch=None):
+        self.messageId = messageId
+        self.timestamp = timestamp
+        self.epoch = parseTimestamp(timestamp) if epoch is None else epoch
+        self.username = username
+        self.message = message
+        self.edited = edited
+
+'''
+Fenwick tree over message slots holding 1 for a live message and 0 for a deleted one.
+Gives the message number of a slot and the slot of a message number in O(log n)
+'''
+class LiveIndex:
+    def __init__(self):
+        # _tree[i] holds the number of live slots in (i - lowbit(i), i]. Index 0 is unused
+        self._tree = [0]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    '''
+    Add a new live slot at the end
+    '''
+    def append(self):
+        index = len(self._tree)
+        value = 1
+
+        child = index - 1
+        stop = index - (index & -index)
+        while child > stop:
+            value += self._tree[child]
+            child -= child & -child
+
+        self._tree.append(value)
+
+    '''
+    Add a slot at the end for each of liveSlots, live if true, in O(n) for n slots. Only for an empty index
+    '''
+    def build(self, liveSlots):
+        self._tree = [0, *(1 if live else 0 for live in liveSlots)]
+
+        for index in range(1, len(self._tree)):
+            parent = index + (index & -index)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[index]
+
+    def add(self, index, delta):
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    '''
+    Remove the last slot
+    '''
+    def pop(self):
+        self._tree.pop()
+
+    '''
+    Number of live slots in 1..index
+    '''
+    def prefix(self, index):
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    '''
+    Slot of the rank-th live slot
+    '''
+    def find(self, rank):
+        position = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+
+        while step:
+            nextPosition = position + step
+            if nextPosition < len(self._tree) and self._tree[nextPosition] < rank:
+                position = nextPosition
+                rank -= self._tree[nextPosition]
+            step >>= 1
+
+        return position + 1
+
+class MessageStore:
+    '''
+    lock guards every read and write of the store. If it is an InstrumentedReadWriteLock, reads only take its shared
+    side, so they run alongside each other and only wait for writes. durability and fsyncInterval configure the
+    JournalWriter. At least changeHistory of the latest changes are kept for delta sync
+    '''
+    def __init__(self, journalPath, lock, durability='fsync', fsyncInterval=1.0, changeHistory=10000):
+        self.journalPath = journalPath
+        self.lock = lock
+        self._readLock = getattr(lock, 'shared', lock)
+        self._durability = durability
+        self._fsyncInterval = fsyncInterval
+        # Message with id i is at _messages[i - 1], or None once deleted
+        self._messages = []
+        self._liveIndex = LiveIndex()
+        self._liveCount = 0
+        # Sorted (epoch, message id) keys of the live messages
+        self._timeIndex = []
+        self._searchIndex = SearchIndex()
+        # Messages with ids up to this are in the search index. Posts, edits and deletes of messages after it are left
+        # to buildSearchIndex
+        self._searchIndexedUpTo = 0
+        # (kind, message id, timestamp, username, message) of the latest changes, oldest first. _changeSeq is the
+        # sequence number of the last one
+        self._changes = []
+        self._changeSeq = 0
+        self._changeHistory = changeHistory
+        self._syncGeneration = os.urandom(4).hex()
+        self._journalWriter = None
+        # Called with no arguments after every change, e.g. to schedule a messagelog.txt export
+        self.onChange = None
+        # Called with a list of (kind, message number, timestamp, username, message) change notices once the
+        # changes are durable, in journal order
+        self.onCommit = None
+        # Called with the seconds each journal write took
+        self.onJournalWrite = None
+
+    '''
+    Number of messages currently in the chatroom
+    '''
+    def count(self):
+        return self._liveCount
+
+    '''
+    Load the store from the snapshot at snapshotPath and the journal after it, or from the whole journal if there is
+    no usable snapshot. Imports a legacy messagelog.txt if there is no journal yet. Opens the journal for appending.
+    Returns the number of journal events replayed
+    '''
+    def load(self, legacyMessagelogPath=None, snapshotPath=None):
+        if os.path.exists(self.journalPath):
+            replayed = 0
+
+            # Loading allocates an object or more per message and frees almost nothing, so the cyclic garbage
+            # collector would only keep rescanning the growing store
+            gcWasEnabled = gc.isenabled()
+            gc.disable()
+
+            try:
+                journalOffset = self._loadSnapshot(snapshotPath) if snapshotPath else 0
+
+                # Binary mode, so the journal can be read from the byte offset the snapshot covers
+                with open(self.journalPath, 'rb') as journal:
+                    journal.seek(journalOffset)
+
+                    for line in journal:
+                        self._applyEvent(json.loads(line))
+                        replayed += 1
+            finally:
+                if gcWasEnabled:
+                    gc.enable()
+
+            self._startJournalWriter()
+            return replayed
+
+        self._journalWriter = JournalWriter(self.journalPath, self.lock, self._durability, self._fsyncInterval)
+
+        if legacyMessagelogPath is not None and os.path.exists(legacyMessagelogPath):
+            events = []
+
+            with open(legacyMessagelogPath, 'r') as messagelog:
+                for line in messagelog:
+                    # Messages may contain '; ', so the message is whatever lies between the username and the edited flag
+                    _, lineTimestamp, lineUsername, rest = line.rstrip('\n').split('; ', 3)
+                    lineMessage, _, lineEdited = rest.rpartition('; ')
+
+                    message = self._insert(lineTimestamp, lineUsername, lineMessage)
+                    events.append(['MSG', message.messageId, lineTimestamp, lineUsername, lineMessage])
+
+                    if lineEdited == 'yes':
+                        self._update(message, lineTimestamp, lineMessage)
+                        events.append(['EDT', message.messageId, lineTimestamp, lineMessage])
+
+            self._journalWriter.append(events)
+
+        self._startJournalWriter()
+        return 0
+
+    '''
+    Write any queued changes and close the journal
+    '''
+    def close(self):
+        if self._journalWriter:
+            self._journalWriter.stop()
+            self._journalWriter = None
+
+    '''
+    Post a new message. Returns its message number once the post is in the journal
+    '''
+    def post(self, timestamp, username, message):
+        return self.postMany(timestamp, username, [message])[0]
+
+    '''
+    Post several messages from one user in one journal write. Returns their message numbers once the posts are
+    in the journal
+    '''
+    def postMany(self, timestamp, username, messages):
+        if not messages:
+            return []
+
+        records = []
+
+        # The messages are only added to the store on the journal writer thread, which numbers posts in the order
+        # they are journaled
+        def apply():
+            events = []
+            notices = []
+            messageNumbers = []
+
+            for message in messages:
+                record = self._insert(timestamp, username, message)
+                records.append(record)
+                self._recordChange('MSG', record)
+
+                if record.messageId == self._searchIndexedUpTo + 1:
+                    self._searchIndex.add(record.messageId, username, message)
+                    self._searchIndexedUpTo = record.messageId
+                messageNumber = self._liveCount
+
+                events.append(['MSG', record.messageId, timestamp, username, message])
+                notices.append(('MSG', messageNumber, timestamp, username, message))
+                messageNumbers.append(messageNumber)
+
+            return events, messageNumbers, notices
+
+        def undo():
+            for record in reversed(records):
+                self._unpost(record)
+            self._forgetChanges()
+
+        messageNumbers = self._journalWriter.submit(apply, undo).wait()
+
+        self._changed()
+
+        return messageNumbers
+
+    '''
+    Delete a message written by username. Returns a result and the deleted message
+    '''
+    def delete(self, messageNumber, timestamp, username):
+        # Most rejected changes are turned away by a reader, without holding up other readers
+        with self._readLock:
+            result, record = self._checkChange(messageNumber, timestamp, username)
+        if result != OK:
+            return result, record
+
+        # Checked again, as a change in between may have renumbered the messages
+        with self.lock:
+            result, record = self._checkChange(messageNumber, timestamp, username)
+            if result != OK:
+                return result, record
+
+            # Deleted and edited messages are changed in the store before they are journaled
+            self._journalWriter.checkWritable()
+
+            self._remove(record)
+            self._recordChange('DLT', record)
+
+            if record.messageId <= self._searchIndexedUpTo:
+                self._searchIndex.remove(record.messageId, record.username, record.message)
+            journalEntry = self._journalWriter.submitEvents(
+                [['DLT', record.messageId]],
+                [('DLT', messageNumber, record.timestamp, username, record.message)],
+                functools.partial(self._undelete, record)
+            )
+
+        journalEntry.wait()
+        self._changed()
+
+        return OK, record
+
+    '''
+    Replace the text of a message written by username. Returns a result and the edited message
+    '''
+    def edit(self, messageNumber, timestamp, username, message, editTimestamp):
+        # Most rejected changes are turned away by a reader, without holding up other readers
+        with self._readLock:
+            result, record = self._checkChange(messageNumber, timestamp, username)
+        if result != OK:
+            return result, record
+
+        # Checked again, as a change in between may have renumbered the messages
+        with self.lock:
+            result, record = self._checkChange(messageNumber, timestamp, username)
+            if result != OK:
+                return result, record
+
+            self._journalWriter.checkWritable()
+
+            oldMessage = record.message
+            oldTimestamp, oldEdited = record.timestamp, record.edited
+            self._update(record, editTimestamp, message)
+            self._recordChange('EDT', record)
+
+            if record.messageId <= self._searchIndexedUpTo:
+                self._searchIndex.update(record.messageId, oldMessage, message)
+            journalEntry = self._journalWriter.submitEvents(
+                [['EDT', record.messageId, editTimestamp, message]],
+                [('EDT', messageNumber, editTimestamp, username, message)],
+                functools.partial(self._unedit, record, oldTimestamp, oldMessage, oldEdited)
+            )
+
+        journalEntry.wait()
+        self._changed()
+
+        return OK, record
+
+    '''
+    List (message number, timestamp, username, message, edited) tuples of messages posted or edited after dtTime,
+    oldest first. With a pageSize, at most that many are listed, continuing after cursor if given. Returns the
+    messages and the cursor for the next page, or None if there are no more
+    '''
+    def messagesSince(self, dtTime, pageSize=None, cursor=None):
+        cutoffKey = (toEpoch(dtTime), float('inf'))
+        if cursor is not None:
+            cutoffKey = max(cutoffKey, parseCursor(cursor))
+
+        messages = []
+        nextCursor = None
+
+        with self._readLock:
+            start = bisect.bisect_right(self._timeIndex, cutoffKey)
+            end = len(self._timeIndex) if pageSize is None else min(start + pageSize, len(self._timeIndex))
+
+            for index in range(start, end):
+                _, messageId = self._timeIndex[index]
+                record = self._messages[messageId - 1]
+                messageNumber = self._liveIndex.prefix(messageId)
+
+                messages.append((messageNumber, record.timestamp, record.username, record.message, record.edited))
+
+            if end < len(self._timeIndex):
+                nextCursor = formatCursor(self._timeIndex[end - 1])
+
+        return messages, nextCursor
+
+    '''
+    Generate the messages posted or edited after dtTime as pages of at most pageSize messages, along with whether
+    more pages follow. The lock is only held while each page is read, so a slow reader never holds up writers
+    '''
+    def iterMessagesSince(self, dtTime, pageSize):
+        cursor = None
+
+        while True:
+            messages, cursor = self.messagesSince(dtTime, pageSize, cursor)
+            yield messages, cursor is not None
+
+            if cursor is None:
+                return
+
+    '''
+    Search for messages that contain every word of query, see searchIndex.py. If username is given, only messages
+    written by username match, and if since or until are, only messages posted or last edited from since to until,
+    datetimes, inclusive. Lists at most limit matches, newest first, as (message number, timestamp, username,
+    message, edited) tuples like messagesSince. Returns the matches and whether more messages matched, or None and
+    False while the search index is still being built
+    '''
+    def search(self, query, username=None, since=None, until=None, limit=100):
+        sinceEpoch = toEpoch(since) if since is not None else None
+        untilEpoch = toEpoch(until) if until is not None else None
+        messages = []
+
+        with self._readLock:
+            if self._searchIndexedUpTo < len(self._messages):
+                return None, False
+
+            for messageId in self._searchIndex.matches(query, username):
+                record = self._messages[messageId - 1]
+
+                if sinceEpoch is not None and record.epoch < sinceEpoch:
+                    continue
+                if untilEpoch is not None and record.epoch > untilEpoch:
+                    continue
+
+                if len(messages) == limit:
+                    return messages, True
+
+                messageNumber = self._liveIndex.prefix(messageId)
+                messages.append((messageNumber, record.timestamp, record.username, record.message, record.edited))
+
+        return messages, False
+
+    '''
+    Start building the search index in the background, see buildSearchIndex
+    '''
+    def startSearchIndex(self):
+        threading.Thread(name='SearchIndexBuild', target=self.buildSearchIndex, daemon=True).start()
+
+    '''
+    Add every message to the search index, chunkSize messages at a time. Words are split without the lock, and each
+    chunk is then added with the lock held, indexing the message as it is by then if it was edited in between. Once
+    the index has caught up, posts, edits and deletes keep it up to date
+    '''
+    def buildSearchIndex(self, chunkSize=1000):
+        while True:
+            with self._readLock:
+                start = self._searchIndexedUpTo
+                end = min(start + chunkSize, len(self._messages))
+                chunk = [(record, record.message) for record in self._messages[start:end] if record is not None]
+
+            chunkWords = [splitWords(message) for _, message in chunk]
+
+            with self.lock:
+                for (record, message), words in zip(chunk, chunkWords):
+                    # Deleted since the chunk was read
+                    if self._messages[record.messageId - 1] is not record:
+                        continue
+
+                    if record.message is not message:
+                        words = splitWords(record.message)
+
+                    self._searchIndex.addWords(record.messageId, record.username, words)
+
+                self._searchIndexedUpTo = end
+
+                if end == len(self._messages):
+                    return
+
+    '''
+    List the changes made since the sync token a client got from its last sync, oldest first, as (kind, message id,
+    timestamp, username, message) tuples where kind is 'MSG', 'EDT' or 'DLT'. At most limit are listed. Returns the
+    changes, the token to sync from next and whether more changes follow. If the store cannot tell what changed since
+    token, because it is '', from another generation or older than the changes kept, returns None for the changes
+    and the current token, to sync from once the client has every message, see liveMessages. Raises ValueError if
+    token is malformed
+    '''
+    def changesSince(self, token, limit):
+        generation, changeSeq = parseSyncToken(token) if token else (None, 0)
+
+        with self._readLock:
+            # Sequence number of the change before the first one kept
+            firstSeq = self._changeSeq - len(self._changes)
+
+            if generation != self._syncGeneration or not firstSeq <= changeSeq <= self._changeSeq:
+                return None, formatSyncToken(self._syncGeneration, self._changeSeq), False
+
+            start = changeSeq - firstSeq
+            changes = self._changes[start:start + limit]
+            changeSeq += len(changes)
+
+            return changes, formatSyncToken(self._syncGeneration, changeSeq), changeSeq < self._changeSeq
+
+    '''
+    List up to limit live messages with ids after afterId, in id order, as the changes that would post them: MSG
+    tuples like those of changesSince, or EDT tuples for edited messages. Returns the messages and whether more follow
+    '''
+    def liveMessages(self, afterId, limit):
+        messages = []
+
+        with self._readLock:
+            for record in itertools.islice(self._messages, afterId, None):
+                if record is None:
+                    continue
+
+                if len(messages) == limit:
+                    return messages, True
+
+                kind = 'EDT' if record.edited else 'MSG'
+                messages.append((kind, record.messageId, record.timestamp, record.username, record.message))
+
+        return messages, False
+
+    '''
+    Generate every live message as pages of at most pageSize, along with whether more pages follow. The lock is only
+    held while each page is read
+    '''
+    def iterLiveMessages(self, pageSize):
+        afterId = 0
+
+        while True:
+            messages, more = self.liveMessages(afterId, pageSize)
+            yield messages, more
+
+            if not more:
+                return
+
+            afterId = messages[-1][1]
+
+    '''
+    Render the store in the messagelog.txt format. As with renderSnapshot, the lock is only held to copy the table, so
+    writers are held up for a list copy rather than for rendering every message. A message edited while this runs may
+    be exported either way, and the next export picks up the edit
+    '''
+    def exportMessagelog(self):
+        with self._readLock:
+            slots = list(self._messages)
+
+        lines = []
+        messageNumber = 0
+
+        for record in slots:
+            if record is None:
+                continue
+
+            messageNumber += 1
+            edited = 'yes' if record.edited else 'no'
+            lines.append(f'{messageNumber}; {record.timestamp}; {record.username}; {record.message}; {edited}\n')
+
+        return ''.join(lines)
+
+    '''
+    Render a snapshot of the store for loadSnapshot. The lock is only held to copy the table, so writers are held up
+    for a list copy rather than for the whole snapshot, and readers are not held up at all.
+
+    The snapshot records the size the journal had before the table was copied, and every change in the journal up to
+    there was applied before it was written, so it is in the snapshot. Changes made while the snapshot is rendered
+    may or may not be, but they are all journaled after that offset, and replaying the journal from the offset
+    applies them again idempotently, see _applyEvent
+    '''
+    def renderSnapshot(self):
+        journalOffset = os.path.getsize(self.journalPath)
+
+        with self._readLock:
+            slots = list(self._messages)
+            # The table may hold changes that are not durable yet. The snapshot is only good once they are, since a
+            # change whose journal write fails is undone
+            durable = self._journalWriter.barrier() if self._journalWriter else None
+
+        live = [record for record in slots if record is not None]
+        epochs = [record.epoch for record in live]
+
+        # The indexes are saved too, so startup does not have to rebuild them. The time index is built from the epochs
+        # saved, so it agrees with them even if a message is edited while this runs. The edit is in the journal after
+        # journalOffset and is replayed over the snapshot
+        liveIndex = LiveIndex()
+        liveIndex.build(record is not None for record in slots)
+        timeOrder = sorted(range(len(live)), key=epochs.__getitem__)
+
+        # Raises JournalFailed if a change in the table could not be journaled
+        if durable:
+            durable.wait()
+
+        # Messages are saved as columns rather than a tuple each, which is quicker to write and to load
+        return pickle.dumps({
+            'version': snapshotVersion,
+            'journalOffset': journalOffset,
+            'slotCount': len(slots),
+            'messages': [
+                [record.messageId for record in live],
+                [record.timestamp for record in live],
+                [record.username for record in live],
+                [record.message for record in live],
+                [record.edited for record in live],
+                epochs,
+            ],
+            'liveTree': liveIndex._tree,
+            'timeIndex': [[epochs[index] for index in timeOrder], [live[index].messageId for index in timeOrder]],
+        }, pickle.HIGHEST_PROTOCOL)
+
+    '''
+    Load a snapshot written by renderSnapshot into the empty store. Returns the journal offset it covers, or 0 if
+    there is no usable snapshot
+    '''
+    def _loadSnapshot(self, snapshotPath):
+        try:
+            with open(snapshotPath, 'rb') as snapshotFile:
+                snapshot = pickle.load(snapshotFile)
+        except FileNotFoundError:
+            return 0
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError) as error:
+            print(f'{snapshotPath} could not be read ({error!r}), replaying the whole journal')
+            return 0
+
+        # A journal shorter than the snapshot says is not the journal the snapshot was taken of
+        if snapshot.get('version') != snapshotVersion or snapshot['journalOffset'] > os.path.getsize(self.journalPath):
+            print(f'{snapshotPath} does not match {self.journalPath}, replaying the whole journal')
+            return 0
+
+        records = list(map(Message, *snapshot['messages']))
+
+        if len(records) == snapshot['slotCount']:
+            self._messages = records
+        else:
+            self._messages = [None] * snapshot['slotCount']
+            for record in records:
+                self._messages[record.messageId - 1] = record
+
+        self._liveIndex._tree = snapshot['liveTree']
+        self._liveCount = len(records)
+        self._timeIndex = list(zip(*snapshot['timeIndex']))
+
+        return snapshot['journalOffset']
+
+    '''
+    Look up a message for a delete or edit and check the caller is allowed to change it
+    '''
+    def _checkChange(self, messageNumber, timestamp, username):
+        if messageNumber not in range(1, self._liveCount + 1):
+            return INVALID_NUMBER, None
+
+        record = self._messages[self._liveIndex.find(messageNumber) - 1]
+
+        if timestamp != record.timestamp:
+            return INVALID_TIMESTAMP, record
+
+        if username != record.username:
+            return UNAUTHORISED, record
+
+        return OK, record
+
+    def _insert(self, timestamp, username, message):
+        record = Message(len(self._messages) + 1, timestamp, username, message)
+
+        self._messages.append(record)
+        self._liveIndex.append()
+        self._liveCount += 1
+        self._indexTime(record)
+
+        return record
+
+    def _update(self, record, timestamp, message):
+        # An edit moves the message to its new time in the index
+        self._unindexTime(record)
+
+        record.timestamp = timestamp
+        record.epoch = parseTimestamp(timestamp)
+        record.message = message
+        record.edited = True
+
+        self._indexTime(record)
+
+    def _remove(self, record):
+        self._messages[record.messageId - 1] = None
+        self._liveIndex.add(record.messageId, -1)
+        self._liveCount -= 1
+        self._unindexTime(record)
+
+    '''
+    Undo a post that could not be journaled. It is always the newest message, as later posts are undone first
+    '''
+    def _unpost(self, record):
+        self._messages.pop()
+        self._liveIndex.pop()
+        self._liveCount -= 1
+        self._unindexTime(record)
+
+        if record.messageId <= self._searchIndexedUpTo:
+            self._searchIndex.remove(record.messageId, record.username, record.message)
+            self._searchIndexedUpTo = record.messageId - 1
+
+    '''
+    Undo a delete that could not be journaled
+    '''
+    def _undelete(self, record):
+        self._messages[record.messageId - 1] = record
+        self._liveIndex.add(record.messageId, 1)
+        self._liveCount += 1
+        self._indexTime(record)
+
+        if record.messageId <= self._searchIndexedUpTo:
+            self._searchIndex.add(record.messageId, record.username, record.message)
+
+        self._forgetChanges()
+
+    '''
+    Undo an edit that could not be journaled
+    '''
+    def _unedit(self, record, timestamp, message, edited):
+        editedMessage = record.message
+
+        self._update(record, timestamp, message)
+        record.edited = edited
+
+        if record.messageId <= self._searchIndexedUpTo:
+            self._searchIndex.update(record.messageId, editedMessage, message)
+
+        self._forgetChanges()
+
+    '''
+    Start a new sync generation after changes were undone, so clients that may have synced them start over
+    '''
+    def _forgetChanges(self):
+        self._changes = []
+        self._syncGeneration = os.urandom(4).hex()
+
+    '''
+    Keep a change for delta sync. Old changes are dropped changeHistory at a time, so keeping one is O(1) amortised
+    '''
+    def _recordChange(self, kind, record):
+        self._changes.append((kind, record.messageId, record.timestamp, record.username, record.message))
+        self._changeSeq += 1
+
+        if len(self._changes) >= 2 * self._changeHistory:
+            del self._changes[:len(self._changes) - self._changeHistory]
+
+    def _indexTime(self, record):
+        key = (record.epoch, record.messageId)
+
+        # New posts and edits are almost always the newest key
+        if not self._timeIndex or self._timeIndex[-1] < key:
+            self._timeIndex.append(key)
+        else:
+            bisect.insort(self._timeIndex, key)
+
+    def _unindexTime(self, record):
+        key = (record.epoch, record.messageId)
+
+        del self._timeIndex[bisect.bisect_left(self._timeIndex, key)]
+
+    '''
+    Apply a journal event while loading. Events already in a loaded snapshot may be replayed, so applying one twice
+    must end in the same state: posts the store already has are skipped, an edit sets the message outright, and
+    messages that are already deleted are left alone
+    '''
+    def _applyEvent(self, event):
+        kind = event[0]
+
+        if kind == 'MSG':
+            _, messageId, timestamp, username, message = event
+            if messageId <= len(self._messages):
+                return
+
+            record = self._insert(timestamp, username, message)
+            assert record.messageId == messageId, f'Journal is out of order at message id {messageId}'
+        elif kind == 'EDT':
+            _, messageId, timestamp, message = event
+            record = self._messages[messageId - 1]
+            if record is not None:
+                self._update(record, timestamp, message)
+        elif kind == 'DLT':
+            _, messageId = event
+            record = self._messages[messageId - 1]
+            if record is not None:
+                self._remove(record)
+
+    def _changed(self):
+        if self.onChange:
+            self.onChange()
+
+    def _startJournalWriter(self):
+        if self._journalWriter is None:
+            self._journalWriter = JournalWriter(self.journalPath, self.lock, self._durability, self._fsyncInterval)
+
+        self._journalWriter.onDurable = self._committed
+        self._journalWriter.onWrite = self._journalWritten
+        self._journalWriter.start()
+
+    def _committed(self, notices):
+        if self.onCommit:
+            self.onCommit(notices)
+
+    def _journalWritten(self, seconds):
+        if self.onJournalWrite:
+            self.onJournalWrite(seconds)
@@ -0,0 +1,634 @@
+'''
+Server metrics, cheap enough to leave on in production.
+
+Command handling, socket sends and journal writes are timed into fixed bucket latency histograms, so recording a
+time is a bisect and two additions. Each thread records into its own ThreadMetrics, so recording takes no lock
+and threads handling different connections never wait on each other; snapshots add them up. The locks in threadLock.py are InstrumentedLocks and a reader-writer
+InstrumentedReadWriteLock, which count acquisitions and time how long each is waited for and held. An uncontended
+InstrumentedLock acquisition only reads the clock once. Connections count the bytes they receive and send.
+
+Metrics are read as a snapshot of plain dicts and lists, which the admin-only STATS command formats as text and
+MetricsEndpoint serves in the Prometheus text format. In workers mode each worker reports its snapshot to the owner
+process, which adds up the snapshots of every process.
+'''
+
+import time
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds in seconds of the buckets of every latency histogram, from 10 microseconds to 10 seconds. Times over
+# the last bound go in one more bucket
+latencyBuckets = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Prefix of the Prometheus metric names
+metricPrefix = 'toom'
+
+class Histogram:
+    '''
+    Counts of times in each of latencyBuckets, and their sum. Callers serialise observations
+    '''
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(latencyBuckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(latencyBuckets, seconds)] += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+    def add(self, histogram):
+        self.counts = [count + otherCount for count, otherCount in zip(self.counts, histogram.counts)]
+        self.sum += histogram.sum
+
+class ThreadMetrics:
+    '''
+    The metrics recorded by one thread. Only that thread writes to them, so recording needs no lock. Snapshots read
+    them from other threads without one, so a count may be one behind
+    '''
+    __slots__ = ('commands', 'commandErrors', 'invalidCommands', 'sends', 'journalWrites')
+
+    def __init__(self):
+        # Histogram of the time to handle each command, and the number of those that failed, keyed by command
+        self.commands = {}
+        self.commandErrors = {}
+        self.invalidCommands = 0
+        self.sends = Histogram()
+        self.journalWrites = Histogram()
+
+    '''
+    Add the metrics of threadMetrics to these
+    '''
+    def add(self, threadMetrics):
+        for command, histogram in threadMetrics.commands.items():
+            self.commands.setdefault(command, Histogram()).add(histogram)
+
+        for command, errors in threadMetrics.commandErrors.items():
+            self.commandErrors[command] = self.commandErrors.get(command, 0) + errors
+
+        self.invalidCommands += threadMetrics.invalidCommands
+        self.sends.add(threadMetrics.sends)
+        self.journalWrites.add(threadMetrics.journalWrites)
+
+class InstrumentedLock:
+    '''
+    A threading.Lock that counts its acquisitions and times how long it is waited for and held. Acquisitions that
+    had to wait are counted as contended, and only those go in the wait histogram. The histograms are only updated
+    while the lock is held, so they need no lock of their own
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.waitTimes = Histogram()
+        self.holdTimes = Histogram()
+        self._lock = threading.Lock()
+        self._acquiredAt = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._acquiredAt = time.perf_counter()
+            self.acquisitions += 1
+            return True
+
+        if not blocking:
+            return False
+
+        waitStart = time.perf_counter()
+
+        if not self._lock.acquire(True, timeout):
+            return False
+
+        self._acquiredAt = time.perf_counter()
+        self.acquisitions += 1
+        self.contended += 1
+        self.waitTimes.observe(self._acquiredAt - waitStart)
+
+        return True
+
+    def release(self):
+        self.holdTimes.observe(time.perf_counter() - self._acquiredAt)
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def snapshot(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait': self.waitTimes.snapshot(),
+            'hold': self.holdTimes.snapshot(),
+        }
+
+class InstrumentedReadWriteLock:
+    '''
+    A reader-writer lock instrumented like InstrumentedLock. Used as a lock it is exclusive, for writers. Its shared
+    side, a SharedLock, lets any number of readers hold it at once. Writers are preferred: once a writer is waiting,
+    new readers wait behind it, so a steady stream of readers cannot keep writers out. Neither side is reentrant.
+    The exclusive side's stats are kept here and the shared side's on the SharedLock, named '<name>.read'
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.waitTimes = Histogram()
+        self.holdTimes = Histogram()
+        self.shared = SharedLock(self, f'{name}.read')
+        # Guards the fields below and the histograms of both sides
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waitingReaders = 0
+        self._waitingWriters = 0
+        self._acquiredAt = 0.0
+
+    def acquire(self):
+        with self._condition:
+            if self._writing or self._readers:
+                waitStart = time.perf_counter()
+                self._waitingWriters += 1
+
+                while self._writing or self._readers:
+                    self._condition.wait()
+
+                self._waitingWriters -= 1
+                self.contended += 1
+                self.waitTimes.observe(time.perf_counter() - waitStart)
+
+            self._writing = True
+            self.acquisitions += 1
+            self._acquiredAt = time.perf_counter()
+
+        return True
+
+    def release(self):
+        with self._condition:
+            self.holdTimes.observe(time.perf_counter() - self._acquiredAt)
+            self._writing = False
+
+            if self._waitingReaders or self._waitingWriters:
+                self._condition.notify_all()
+
+    def locked(self):
+        return self._writing or self._readers > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def snapshot(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait': self.waitTimes.snapshot(),
+            'hold': self.holdTimes.snapshot(),
+        }
+
+    def _acquireShared(self, shared):
+        with self._condition:
+            if self._writing or self._waitingWriters:
+                waitStart = time.perf_counter()
+                self._waitingReaders += 1
+
+                while self._writing or self._waitingWriters:
+                    self._condition.wait()
+
+                self._waitingReaders -= 1
+                shared.contended += 1
+                shared.waitTimes.observe(time.perf_counter() - waitStart)
+
+            self._readers += 1
+            shared.acquisitions += 1
+
+        shared._holders.acquiredAt = time.perf_counter()
+
+    def _releaseShared(self, shared):
+        heldFor = time.perf_counter() - shared._holders.acquiredAt
+
+        with self._condition:
+            shared.holdTimes.observe(heldFor)
+            self._readers -= 1
+
+            if not self._readers and self._waitingWriters:
+                self._condition.notify_all()
+
+class SharedLock:
+    '''
+    The shared side of an InstrumentedReadWriteLock, for readers
+    '''
+    def __init__(self, readWriteLock, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.waitTimes = Histogram()
+        self.holdTimes = Histogram()
+        self._readWriteLock = readWriteLock
+        # When each thread holding the lock acquired it
+        self._holders = threading.local()
+
+    def acquire(self):
+        self._readWriteLock._acquireShared(self)
+        return True
+
+    def release(self):
+        self._readWriteLock._releaseShared(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def snapshot(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait': self.waitTimes.snapshot(),
+            'hold': self.holdTimes.snapshot(),
+        }
+
+class Metrics:
+    '''
+    Metrics of one server process. locks are the InstrumentedLocks, InstrumentedReadWriteLocks and SharedLocks to
+    report on
+    '''
+    def __init__(self, locks=()):
+        self._locks = tuple(locks)
+        # Guards the fields below. Recording never takes it, except once in each thread to register its ThreadMetrics
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # ThreadMetrics of each thread that has recorded anything, keyed by thread, and the added up metrics of
+        # threads that have ended
+        self._threadMetrics = {}
+        self._endedThreadMetrics = ThreadMetrics()
+        # Open connections, and the bytes of connections that have closed
+        self._connections = set()
+        self._closedBytesReceived = 0
+        self._closedBytesSent = 0
+        # Latest snapshots reported by worker processes, keyed by worker
+        self._workerSnapshots = {}
+
+    '''
+    Report on more locks from now on, e.g. those of a new room
+    '''
+    def addLocks(self, *locks):
+        with self._lock:
+            # Replaced rather than extended, so a snapshot can go through the locks without the lock
+            self._locks = self._locks + locks
+
+    '''
+    Record the time to handle a command, and whether it failed
+    '''
+    def observeCommand(self, command, seconds, failed=False):
+        threadMetrics = self._threadLocal()
+
+        histogram = threadMetrics.commands.get(command)
+        if histogram is None:
+            histogram = threadMetrics.commands[command] = Histogram()
+
+        histogram.observe(seconds)
+
+        if failed:
+            threadMetrics.commandErrors[command] = threadMetrics.commandErrors.get(command, 0) + 1
+
+    def countInvalidCommand(self):
+        self._threadLocal().invalidCommands += 1
+
+    '''
+    Record the time a send waited for the socket
+    '''
+    def observeSend(self, seconds):
+        self._threadLocal().sends.observe(seconds)
+
+    def observeJournalWrite(self, seconds):
+        self._threadLocal().journalWrites.observe(seconds)
+
+    '''
+    The ThreadMetrics of the calling thread
+    '''
+    def _threadLocal(self):
+        try:
+            return self._local.metrics
+        except AttributeError:
+            threadMetrics = self._local.metrics = ThreadMetrics()
+
+            with self._lock:
+                self._threadMetrics[threading.current_thread()] = threadMetrics
+
+            return threadMetrics
+
+    '''
+    Count an open connection. connection is a protocol.Protocol, whose byte counts are read for snapshots
+    '''
+    def addConnection(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def removeConnection(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+            self._closedBytesReceived += connection.bytesReceived
+            self._closedBytesSent += connection.bytesSent
+
+    '''
+    Metrics of this process
+    '''
+    def snapshot(self):
+        # Lock stats are read without taking the locks, so a snapshot never waits on them. A count may be one behind
+        locks = {lock.name: lock.snapshot() for lock in self._locks}
+
+        with self._lock:
+            # The metrics of an ended thread can no longer change, so they are added up once and dropped
+            for thread in [thread for thread in self._threadMetrics if not thread.is_alive()]:
+                self._endedThreadMetrics.add(self._threadMetrics.pop(thread))
+
+            threadMetrics = [self._endedThreadMetrics, *self._threadMetrics.values()]
+
+            connections = [
+                {
+                    'name': f'{connection.username or "-"} {connection.addrName}:{connection.addrPort}',
+                    'bytesReceived': connection.bytesReceived,
+                    'bytesSent': connection.bytesSent,
+                }
+                for connection in self._connections
+            ]
+
+            commands = {}
+            commandErrors = {}
+
+            for metrics in threadMetrics:
+                # Copied first, as the thread may add a command while they are read
+                for command, histogram in dict(metrics.commands).items():
+                    commands.setdefault(command, []).append(histogram.snapshot())
+
+                for command, errors in dict(metrics.commandErrors).items():
+                    commandErrors[command] = commandErrors.get(command, 0) + errors
+
+            return {
+                'commands': {command: mergeHistograms(histograms) for command, histograms in sorted(commands.items())},
+                'commandErrors': commandErrors,
+                'invalidCommands': sum(metrics.invalidCommands for metrics in threadMetrics),
+                'sends': mergeHistograms(metrics.sends.snapshot() for metrics in threadMetrics),
+                'journalWrites': mergeHistograms(metrics.journalWrites.snapshot() for metrics in threadMetrics),
+                'locks': locks,
+                'bytesReceived': self._closedBytesReceived + sum(connection['bytesReceived'] for connection in connections),
+                'bytesSent': self._closedBytesSent + sum(connection['bytesSent'] for connection in connections),
+                'connectionCount': len(connections),
+                'connections': connections,
+                'threads': threading.active_count(),
+                'processes': 1,
+            }
+
+    '''
+    Keep the latest snapshot of a worker process, to add to this process's metrics
+    '''
+    def report(self, worker, snapshot):
+        with self._lock:
+            self._workerSnapshots[worker] = snapshot
+
+    def forgetWorker(self, worker):
+        with self._lock:
+            self._workerSnapshots.pop(worker, None)
+
+    '''
+    Metrics of this process and every worker process that reports to it
+    '''
+    def combinedSnapshot(self):
+        with self._lock:
+            workerSnapshots = list(self._workerSnapshots.values())
+
+        return mergeSnapshots([self.snapshot(), *workerSnapshots])
+
+def mergeHistograms(histograms):
+    histograms = list(histograms)
+
+    return {
+        'counts': [sum(counts) for counts in zip(*(histogram['counts'] for histogram in histograms))],
+        'sum': sum(histogram['sum'] for histogram in histograms),
+    }
+
+'''
+Add up the snapshots of several processes
+'''
+def mergeSnapshots(snapshots):
+    def mergeKeyed(key):
+        names = sorted({name for snapshot in snapshots for name in snapshot[key]})
+        return {name: [snapshot[key][name] for snapshot in snapshots if name in snapshot[key]] for name in names}
+
+    return {
+        'commands': {command: mergeHistograms(histograms) for command, histograms in mergeKeyed('commands').items()},
+        'commandErrors': {command: sum(errors) for command, errors in mergeKeyed('commandErrors').items()},
+        'invalidCommands': sum(snapshot['invalidCommands'] for snapshot in snapshots),
+        'sends': mergeHistograms(snapshot['sends'] for snapshot in snapshots),
+        'journalWrites': mergeHistograms(snapshot['journalWrites'] for snapshot in snapshots),
+        'locks': {
+            name: {
+                'acquisitions': sum(lock['acquisitions'] for lock in locks),
+                'contended': sum(lock['contended'] for lock in locks),
+                'wait': mergeHistograms(lock['wait'] for lock in locks),
+                'hold': mergeHistograms(lock['hold'] for lock in locks),
+            }
+            for name, locks in mergeKeyed('locks').items()
+        },
+        'bytesReceived': sum(snapshot['bytesReceived'] for snapshot in snapshots),
+        'bytesSent': sum(snapshot['bytesSent'] for snapshot in snapshots),
+        'connectionCount': sum(snapshot['connectionCount'] for snapshot in snapshots),
+        'connections': [connection for snapshot in snapshots for connection in snapshot['connections']],
+        'threads': sum(snapshot['threads'] for snapshot in snapshots),
+        'processes': sum(snapshot['processes'] for snapshot in snapshots),
+    }
+
+'''
+Estimate a percentile of a histogram as the upper bound of the bucket it falls in. Returns None for an empty
+histogram and infinity past the last bucket
+'''
+def histogramPercentile(histogram, fraction):
+    total = sum(histogram['counts'])
+    if not total:
+        return None
+
+    cumulative = 0
+    for bucketIndex, count in enumerate(histogram['counts']):
+        cumulative += count
+        if cumulative >= total * fraction:
+            break
+
+    return latencyBuckets[bucketIndex] if bucketIndex < len(latencyBuckets) else float('inf')
+
+def formatSeconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return f'>{latencyBuckets[-1]:g}s'
+    if seconds < 0.001:
+        return f'{seconds * 1000000:.0f}us'
+    if seconds < 1:
+        return f'{seconds * 1000:.3g}ms'
+
+    return f'{seconds:.3g}s'
+
+def formatHistogram(histogram):
+    count = sum(histogram['counts'])
+    mean = histogram['sum'] / count if count else None
+
+    return (
+        f'{count} in {formatSeconds(histogram["sum"])}, mean {formatSeconds(mean)}, '
+        f'p50 {formatSeconds(histogramPercentile(histogram, 0.5))}, p95 {formatSeconds(histogramPercentile(histogram, 0.95))}, '
+        f'p99 {formatSeconds(histogramPercentile(histogram, 0.99))}'
+    )
+
+'''
+Format a snapshot as the text of a STATS response. Percentiles are bucket upper bounds
+'''
+def formatStats(snapshot):
+    lines = [
+        f'Processes: {snapshot["processes"]}, threads: {snapshot["threads"]}, connections: {snapshot["connectionCount"]}',
+        f'Bytes received: {snapshot["bytesReceived"]}, bytes sent: {snapshot["bytesSent"]}',
+        'Commands:',
+    ]
+
+    for command, histogram in snapshot['commands'].items():
+        errors = snapshot['commandErrors'].get(command)
+        lines.append(f'  {command}: {formatHistogram(histogram)}' + (f', {errors} failed' if errors else ''))
+
+    lines.append(f'  invalid: {snapshot["invalidCommands"]}')
+    lines.append(f'Sends: {formatHistogram(snapshot["sends"])}')
+    lines.append(f'Journal writes: {formatHistogram(snapshot["journalWrites"])}')
+    lines.append('Locks:')
+
+    for name, lock in snapshot['locks'].items():
+        lines.append(
+            f'  {name}: {lock["acquisitions"]} acquisitions, {lock["contended"]} contended, '
+            f'waited {formatSeconds(lock["wait"]["sum"])}, held {formatSeconds(lock["hold"]["sum"])}, '
+            f'p99 wait {formatSeconds(histogramPercentile(lock["wait"], 0.99))}, p99 hold {formatSeconds(histogramPercentile(lock["hold"], 0.99))}'
+        )
+
+    lines.append('Connections:')
+
+    for connection in snapshot['connections']:
+        lines.append(f'  {connection["name"]}: received {connection["bytesReceived"]}, sent {connection["bytesSent"]}')
+
+    return '\n'.join(lines)
+
+def _prometheusHistogram(lines, name, labels, histogram):
+    labelPrefix = ''.join(f'{label}="{value}",' for label, value in labels.items())
+    cumulative = 0
+
+    for bound, count in zip((*latencyBuckets, '+Inf'), histogram['counts']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labelPrefix}le="{bound}"}} {cumulative}')
+
+    labelStr = f'{{{labelPrefix[:-1]}}}' if labels else ''
+    lines.append(f'{name}_sum{labelStr} {histogram["sum"]}')
+    lines.append(f'{name}_count{labelStr} {cumulative}')
+
+'''
+Format a snapshot in the Prometheus text exposition format
+'''
+def formatPrometheus(snapshot):
+    lines = []
+
+    def family(name, kind, description):
+        lines.append(f'# HELP {metricPrefix}_{name} {description}')
+        lines.append(f'# TYPE {metricPrefix}_{name} {kind}')
+        return f'{metricPrefix}_{name}'
+
+    name = family('command_seconds', 'histogram', 'Time to handle each command.')
+    for command, histogram in snapshot['commands'].items():
+        _prometheusHistogram(lines, name, {'command': command}, histogram)
+
+    name = family('command_errors_total', 'counter', 'Commands that failed, which are also in command_seconds.')
+    for command, errors in snapshot['commandErrors'].items():
+        lines.append(f'{name}{{command="{command}"}} {errors}')
+
+    name = family('invalid_commands_total', 'counter', 'Requests with an unknown command or the wrong number of args.')
+    lines.append(f'{name} {snapshot["invalidCommands"]}')
+
+    name = family('send_wait_seconds', 'histogram', 'Time sends waited for the socket.')
+    _prometheusHistogram(lines, name, {}, snapshot['sends'])
+
+    name = family('journal_write_seconds', 'histogram', 'Time to write and sync each batch of journal events.')
+    _prometheusHistogram(lines, name, {}, snapshot['journalWrites'])
+
+    name = family('lock_acquisitions_total', 'counter', 'Acquisitions of each lock.')
+    for lockName, lock in snapshot['locks'].items():
+        lines.append(f'{name}{{lock="{lockName}"}} {lock["acquisitions"]}')
+
+    name = family('lock_contended_total', 'counter', 'Acquisitions of each lock that had to wait.')
+    for lockName, lock in snapshot['locks'].items():
+        lines.append(f'{name}{{lock="{lockName}"}} {lock["contended"]}')
+
+    name = family('lock_wait_seconds', 'histogram', 'Time contended acquisitions of each lock waited.')
+    for lockName, lock in snapshot['locks'].items():
+        _prometheusHistogram(lines, name, {'lock': lockName}, lock['wait'])
+
+    name = family('lock_hold_seconds', 'histogram', 'Time each lock was held.')
+    for lockName, lock in snapshot['locks'].items():
+        _prometheusHistogram(lines, name, {'lock': lockName}, lock['hold'])
+
+    name = family('received_bytes_total', 'counter', 'Bytes received from clients.')
+    lines.append(f'{name} {snapshot["bytesReceived"]}')
+
+    name = family('sent_bytes_total', 'counter', 'Bytes sent to clients.')
+    lines.append(f'{name} {snapshot["bytesSent"]}')
+
+    name = family('connections', 'gauge', 'Open client connections.')
+    lines.append(f'{name} {snapshot["connectionCount"]}')
+
+    name = family('threads', 'gauge', 'Threads of every server process.')
+    lines.append(f'{name} {snapshot["threads"]}')
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsEndpoint:
+    '''
+    Serves GET /metrics in the Prometheus text format on localhost:port, from metrics.combinedSnapshot()
+    '''
+    def __init__(self, metrics, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = formatPrometheus(metrics.combinedSnapshot()).encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a line of server output each
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('localhost', port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(name='MetricsEndpoint', target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,542 @@
+'''
+Shared state for the multi-process server.
+
+In workers mode the server process owns the rooms and their message stores, the active users and the login state,
+and starts worker processes that accept connections on the server port with SO_REUSEPORT. Workers reach the owner's
+state through proxies that make calls over a local multiprocessing connection, one per worker, so message numbers,
+the journals, ATU lists, login lockouts and connection limits are exactly those of a single process server. Changes committed by the owner are
+streamed back to every worker, which publishes them to its own subscribed connections. Workers report their metrics to
+the owner, which adds them to its own.
+
+Each message on a connection is a pickled tuple:
+- worker to owner: ('CALL', call id, object name, method name, args)
+- owner to worker: ('RESULT', call id, result, error) or ('EVENT', kind, payload, room, dropped)
+'''
+
+import os
+import itertools
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+import roomRegistry
+from messageStore import MessageStore
+from eventHub import Subscriber
+from metrics import Metrics
+
+# Methods workers may call, by object name
+exportedMethods = {
+    # Message store methods take the name of the room whose store to call first
+    'messageStore': ('post', 'postMany', 'delete', 'edit', 'messagesSince', 'changesSince', 'liveMessages', 'search', 'count'),
+    'rooms': ('enter', 'leave', 'join', 'summary'),
+    'sessions': ('login', 'logout', 'atuResponse'),
+    'logins': ('attempt',),
+    'admission': ('admit', 'release', 'admitUser', 'releaseUser'),
+    'metrics': ('report', 'combinedSnapshot'),
+}
+
+class OwnerService:
+    '''
+    Serves the shared state to worker processes. callThreads bounds the number of calls handled at once, and
+    eventQueueSize the number of live events queued for a worker that falls behind
+    '''
+    def __init__(self, rooms, sessions, logins, admission, metrics, eventHub, callThreads, eventQueueSize):
+        self.authkey = os.urandom(32)
+        self._listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        self.address = self._listener.address
+        self._rooms = rooms
+        self._sessions = sessions
+        self._logins = logins
+        self._admission = admission
+        self._metrics = metrics
+        self._eventHub = eventHub
+        self._eventQueueSize = eventQueueSize
+        # Calls can wait on a journal write, so they run on a pool where concurrent posts are committed together
+        self._executor = ThreadPoolExecutor(max_workers=callThreads, thread_name_prefix='OwnerCall')
+        self._closed = False
+        self._thread = threading.Thread(name='OwnerService', target=self._acceptLoop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._closed = True
+        self._listener.close()
+        self._executor.shutdown(wait=True)
+
+    def _acceptLoop(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError):
+                continue
+
+            threading.Thread(name='OwnerWorkerConnection', target=self._serveWorker, args=(connection,), daemon=True).start()
+
+    def _serveWorker(self, connection):
+        sendLock = threading.Lock()
+
+        def send(message):
+            with sendLock:
+                connection.send(message)
+
+        objects = {
+            'messageStore': WorkerMessageStores(self._rooms),
+            'rooms': WorkerRooms(self._rooms),
+            'sessions': WorkerSessions(self._sessions),
+            'logins': self._logins,
+            'admission': WorkerAdmission(self._admission),
+            'metrics': WorkerMetrics(self._metrics),
+        }
+
+        subscriber = Subscriber(
+            lambda kind, payload, room, dropped: send(('EVENT', kind, payload, room, dropped)),
+            lambda: None,
+            self._eventQueueSize,
+            'drop',
+        )
+        subscriber.start()
+        self._eventHub.subscribe(subscriber)
+
+        try:
+            while True:
+                _, callId, objectName, methodName, args = connection.recv()
+                self._executor.submit(self._call, send, objects, callId, objectName, methodName, args)
+        except (EOFError, OSError, RuntimeError):
+            # The worker has exited, or the executor was shut down
+            pass
+        finally:
+            self._eventHub.unsubscribe(subscriber)
+            subscriber.close()
+            # A worker that exits takes its connections with it
+            objects['sessions'].logoutAll()
+            objects['rooms'].leaveAll()
+            objects['admission'].releaseAll()
+            objects['metrics'].forget()
+            connection.close()
+
+    def _call(self, send, objects, callId, objectName, methodName, args):
+        result = error = None
+
+        try:
+            if methodName not in exportedMethods.get(objectName, ()):
+                raise AttributeError(f'{objectName}.{methodName} cannot be called by workers')
+
+            result = getattr(objects[objectName], methodName)(*args)
+        except Exception as callError:
+            error = callError
+
+        try:
+            send(('RESULT', callId, result, error))
+        except OSError:
+            pass
+
+'''
+The sessions logged in through one worker. A session is a copy once it reaches the owner, so workers refer to
+their sessions by id
+'''
+class WorkerSessions:
+    def __init__(self, sessions):
+        self._sessions = sessions
+        self._byId = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def login(self, session):
+        with self._lock:
+            sessionId = next(self._ids)
+            self._byId[sessionId] = session
+
+        self._sessions.login(session)
+
+        return sessionId
+
+    def logout(self, sessionId):
+        with self._lock:
+            session = self._byId.pop(sessionId, None)
+
+        if session:
+            self._sessions.logout(session)
+
+    def atuResponse(self, username):
+        return self._sessions.atuResponse(username)
+
+    def logoutAll(self):
+        with self._lock:
+            sessions = list(self._byId.values())
+            self._byId.clear()
+
+        for session in sessions:
+            self._sessions.logout(session)
+
+'''
+The message stores of every room. Workers name the room first in every call
+'''
+class WorkerMessageStores:
+    def __init__(self, rooms):
+        self._rooms = rooms
+
+    def __getattr__(self, methodName):
+        def call(room, *args):
+            return getattr(self._rooms.store(room), methodName)(*args)
+
+        return call
+
+'''
+The room members of the connections of one worker, so they can be taken out of their rooms if the worker exits
+without leaving them
+'''
+class WorkerRooms:
+    def __init__(self, rooms):
+        self._rooms = rooms
+        # Number of the worker's connections in each room, by (room, username)
+        self._members = Counter()
+        self._lock = threading.Lock()
+
+    def enter(self, name, username):
+        self._rooms.enter(name, username)
+
+        with self._lock:
+            self._members[name, username] += 1
+
+    def leave(self, name, username):
+        with self._lock:
+            self._members[name, username] -= 1
+
+        self._rooms.leave(name, username)
+
+    def join(self, name, username, currentName):
+        result = self._rooms.join(name, username, currentName)
+
+        if result != roomRegistry.TOO_MANY_ROOMS:
+            with self._lock:
+                self._members[currentName, username] -= 1
+                self._members[name, username] += 1
+
+        return result
+
+    def summary(self):
+        return self._rooms.summary()
+
+    def leaveAll(self):
+        with self._lock:
+            members, self._members = self._members, Counter()
+
+        for (name, username), count in members.items():
+            for _ in range(count):
+                self._rooms.leave(name, username)
+
+'''
+The connections admitted through one worker, so they can be given back if the worker exits without releasing them
+'''
+class WorkerAdmission:
+    def __init__(self, admission):
+        self._admission = admission
+        self._connections = 0
+        self._usernames = []
+        self._lock = threading.Lock()
+
+    def admit(self):
+        admitted = self._admission.admit()
+
+        if admitted:
+            with self._lock:
+                self._connections += 1
+
+        return admitted
+
+    def release(self):
+        with self._lock:
+            self._connections -= 1
+
+        self._admission.release()
+
+    def admitUser(self, username):
+        admitted = self._admission.admitUser(username)
+
+        if admitted:
+            with self._lock:
+                self._usernames.append(username)
+
+        return admitted
+
+    def releaseUser(self, username):
+        with self._lock:
+            self._usernames.remove(username)
+
+        self._admission.releaseUser(username)
+
+    def releaseAll(self):
+        with self._lock:
+            connections, self._connections = self._connections, 0
+            usernames, self._usernames = self._usernames, []
+
+        for username in usernames:
+            self._admission.releaseUser(username)
+        for _ in range(connections):
+            self._admission.release()
+
+'''
+The metrics reported by one worker
+'''
+class WorkerMetrics:
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def report(self, snapshot):
+        self._metrics.report(self, snapshot)
+
+    '''
+    Take the worker's latest snapshot and return the metrics of every process
+    '''
+    def combinedSnapshot(self, snapshot):
+        self.report(snapshot)
+
+        return self._metrics.combinedSnapshot()
+
+    def forget(self):
+        self._metrics.forgetWorker(self)
+
+class PendingCall:
+    __slots__ = ('result', 'error', '_done')
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        # Held until the result arrives, like journalWriter.JournalEntry
+        self._done = threading.Lock()
+        self._done.acquire()
+
+    def wait(self):
+        self._done.acquire()
+        self._done.release()
+
+        if self.error:
+            raise self.error
+
+        return self.result
+
+    def complete(self, result, error):
+        self.result = result
+        self.error = error
+        self._done.release()
+
+class OwnerClient:
+    '''
+    A worker's connection to the owner. Live events from the owner are published to eventHub. onClosed is called
+    with no arguments if the owner goes away
+    '''
+    def __init__(self, address, authkey, eventHub):
+        self._connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self._eventHub = eventHub
+        self._sendLock = threading.Lock()
+        self._calls = {}
+        self._callIds = itertools.count()
+        self._closed = False
+        self._lost = False
+        self._thread = threading.Thread(name='OwnerClient', target=self._run, daemon=True)
+        self.onClosed = None
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._connection.close()
+
+    '''
+    Call a method of one of the owner's objects and wait for its result. Raises ConnectionError if the owner has
+    gone away
+    '''
+    def call(self, objectName, methodName, *args):
+        pendingCall = PendingCall()
+        callId = next(self._callIds)
+        self._calls[callId] = pendingCall
+
+        try:
+            if self._lost:
+                raise OSError
+
+            with self._sendLock:
+                self._connection.send(('CALL', callId, objectName, methodName, args))
+        except OSError:
+            self._calls.pop(callId, None)
+            raise ConnectionError('Lost connection to the owner process')
+
+        return pendingCall.wait()
+
+    def _run(self):
+        try:
+            while True:
+                message = self._connection.recv()
+
+                if message[0] == 'RESULT':
+                    _, callId, result, error = message
+                    self._calls.pop(callId).complete(result, error)
+                else:
+                    _, kind, payload, room, dropped = message
+                    if dropped:
+                        print(f'{dropped} live events were dropped on the way from the owner process.')
+                    self._eventHub.publishEvents([(kind, payload, room)])
+        except (EOFError, OSError, TypeError):
+            # TypeError is raised when close() takes the connection's handle away while recv is waiting on it
+            pass
+
+        # Fail every call still waiting for a result. Calls made from now on fail straight away
+        self._lost = True
+        for callId in list(self._calls):
+            self._calls.pop(callId, PendingCall()).complete(None, ConnectionError('Lost connection to the owner process'))
+
+        if not self._closed and self.onClosed:
+            self.onClosed()
+
+'''
+Define a method that calls methodName of the owner's objectName
+'''
+def remoteMethod(objectName, methodName):
+    def call(self, *args):
+        return self._client.call(objectName, methodName, *args)
+
+    call.__name__ = methodName
+
+    return call
+
+'''
+Define a method that calls methodName of the message store of the owner's room named by the proxy's room
+'''
+def remoteStoreMethod(methodName):
+    def call(self, *args):
+        return self._client.call('messageStore', methodName, self.room, *args)
+
+    call.__name__ = methodName
+
+    return call
+
+class RemoteMessageStore:
+    def __init__(self, client, room):
+        self._client = client
+        self.room = room
+
+    post = remoteStoreMethod('post')
+    postMany = remoteStoreMethod('postMany')
+    delete = remoteStoreMethod('delete')
+    edit = remoteStoreMethod('edit')
+    messagesSince = remoteStoreMethod('messagesSince')
+    changesSince = remoteStoreMethod('changesSince')
+    liveMessages = remoteStoreMethod('liveMessages')
+    search = remoteStoreMethod('search')
+    count = remoteStoreMethod('count')
+    # Pages are read with one call each, so streaming never holds the owner's lock between pages
+    iterMessagesSince = MessageStore.iterMessagesSince
+    iterLiveMessages = MessageStore.iterLiveMessages
+
+class RemoteRoomRegistry:
+    def __init__(self, client):
+        self._client = client
+        # Message store proxies keyed by room name
+        self._stores = {}
+
+    '''
+    A proxy for the message store of a room. Calls raise KeyError if there is no such room
+    '''
+    def store(self, name):
+        store = self._stores.get(name)
+
+        if store is None:
+            store = self._stores[name] = RemoteMessageStore(self._client, name)
+
+        return store
+
+    enter = remoteMethod('rooms', 'enter')
+    join = remoteMethod('rooms', 'join')
+    summary = remoteMethod('rooms', 'summary')
+
+    def leave(self, name, username):
+        try:
+            self._client.call('rooms', 'leave', name, username)
+        except ConnectionError:
+            # The owner has gone, and its rooms with it
+            pass
+
+class RemoteSessionRegistry:
+    def __init__(self, client):
+        self._client = client
+        # Owner session ids keyed by the worker's session objects
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def login(self, session):
+        sessionId = self._client.call('sessions', 'login', session)
+
+        with self._lock:
+            self._ids[session] = sessionId
+
+    def logout(self, session):
+        with self._lock:
+            sessionId = self._ids.pop(session, None)
+
+        if sessionId is None:
+            return
+
+        try:
+            self._client.call('sessions', 'logout', sessionId)
+        except ConnectionError:
+            # The owner has gone, and its sessions with it
+            pass
+
+    atuResponse = remoteMethod('sessions', 'atuResponse')
+
+class RemoteLoginRegistry:
+    def __init__(self, client):
+        self._client = client
+
+    attempt = remoteMethod('logins', 'attempt')
+
+class RemoteAdmissionControl:
+    def __init__(self, client):
+        self._client = client
+
+    admit = remoteMethod('admission', 'admit')
+    admitUser = remoteMethod('admission', 'admitUser')
+
+    def release(self):
+        try:
+            self._client.call('admission', 'release')
+        except ConnectionError:
+            # The owner has gone, and its counts with it
+            pass
+
+    def releaseUser(self, username):
+        try:
+            self._client.call('admission', 'releaseUser', username)
+        except ConnectionError:
+            pass
+
+class RemoteMetrics(Metrics):
+    '''
+    Metrics of a worker process. They are reported to the owner every reportInterval seconds, and read back from the
+    owner added up with those of every other process
+    '''
+    def __init__(self, client, locks, reportInterval):
+        super().__init__(locks)
+        self._client = client
+        self._reportInterval = reportInterval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(name='MetricsReporter', target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def combinedSnapshot(self):
+        return self._client.call('metrics', 'combinedSnapshot', self.snapshot())
+
+    def _run(self):
+        while not self._stopped.wait(self._reportInterval):
+            try:
+                self._client.call('metrics', 'report', self.snapshot())
+            except ConnectionError:
+                return
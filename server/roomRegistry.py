@@ -0,0 +1,141 @@
+'''
+Chat rooms.
+
+Every connection is in one room at a time, the default room until it JOINs another, and MSG, DLT, EDT, RDM, RDS,
+SYN, SRH and BATCH act on the messages of that room. Live events are only pushed to subscribers in the room they
+happened in.
+
+Each room has a message store of its own, with its own journal, snapshot, messagelog.txt export, message numbering,
+lock and search index, so posts to different rooms never wait on each other's lock or journal writes. The default
+room keeps the files the server has always used, in the server directory. Every other room keeps them in a
+directory named after it under roomsDirectory, and rooms found there are opened again at startup.
+'''
+
+import re
+import threading
+from collections import Counter
+
+# Results of joining a room
+JOINED = 'joined'
+CREATED = 'created'
+TOO_MANY_ROOMS = 'too many rooms'
+
+# Letters, digits, '-' and '_', so a room name is always a safe directory name
+roomNamePattern = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+def isValidRoomName(name):
+    return roomNamePattern.fullmatch(name) is not None
+
+class Room:
+    '''
+    A room's message store, and the SnapshotWriters keeping its messagelog.txt export and snapshot up to date
+    '''
+    def __init__(self, name, store, messagelogExport, messageSnapshot):
+        self.name = name
+        self.store = store
+        self.messagelogExport = messagelogExport
+        self.messageSnapshot = messageSnapshot
+        # Number of connections in the room, by username
+        self.members = Counter()
+
+    '''
+    Schedule rewrites of the files kept in sync with the room's messages
+    '''
+    def markChanged(self):
+        self.messagelogExport.markDirty()
+        self.messageSnapshot.markDirty()
+
+    def close(self):
+        self.messagelogExport.stop()
+        self.store.close()
+        # Snapshot the whole journal, so the next startup has nothing to replay
+        self.messageSnapshot.stop()
+
+class RoomRegistry:
+    '''
+    openRoom is called with a room name and must return its Room, loaded and ready. It is called with the
+    registry's lock held, so a room is only ever opened once. At most maxRooms rooms are open, counting the default
+    room, since every room has a journal writer and snapshot threads of its own
+    '''
+    def __init__(self, defaultRoom, openRoom, maxRooms):
+        self.defaultRoom = defaultRoom
+        self._openRoom = openRoom
+        self._maxRooms = maxRooms
+        # Rooms keyed by name. Rooms are only ever added, so lookups need no lock
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    '''
+    Open a room that already has messages, at startup
+    '''
+    def open(self, name):
+        with self._lock:
+            if name not in self._rooms:
+                self._rooms[name] = self._openRoom(name)
+
+            return self._rooms[name]
+
+    '''
+    The message store of a room. Raises KeyError if there is no such room
+    '''
+    def store(self, name):
+        return self._rooms[name].store
+
+    def rooms(self):
+        return list(self._rooms.values())
+
+    '''
+    Count a new connection of username as a member of the room it starts in
+    '''
+    def enter(self, name, username):
+        with self._lock:
+            self._rooms[name].members[username] += 1
+
+    '''
+    Stop counting a closed connection of username as a member of the room it was in
+    '''
+    def leave(self, name, username):
+        with self._lock:
+            self._removeMember(self._rooms[name], username)
+
+    '''
+    Move a connection of username from the room currentName to the room name, opening a new room if there is no
+    room of that name yet. Returns JOINED, CREATED, or TOO_MANY_ROOMS if a new room would be one too many
+    '''
+    def join(self, name, username, currentName):
+        with self._lock:
+            room = self._rooms.get(name)
+            result = JOINED
+
+            if room is None:
+                if len(self._rooms) >= self._maxRooms:
+                    return TOO_MANY_ROOMS
+
+                room = self._rooms[name] = self._openRoom(name)
+                result = CREATED
+
+            self._removeMember(self._rooms[currentName], username)
+            room.members[username] += 1
+
+        return result
+
+    '''
+    (room name, number of messages, number of users in it) of every room, the default room first and then by name
+    '''
+    def summary(self):
+        with self._lock:
+            users = {room.name: len(room.members) for room in self._rooms.values()}
+
+        names = sorted(users, key=lambda name: (name != self.defaultRoom, name))
+
+        return [(name, self._rooms[name].store.count(), users[name]) for name in names]
+
+    def closeAll(self):
+        for room in self.rooms():
+            room.close()
+
+    def _removeMember(self, room, username):
+        room.members[username] -= 1
+
+        if room.members[username] <= 0:
+            del room.members[username]
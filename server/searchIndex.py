@@ -0,0 +1,114 @@
+'''
+Inverted index of message text for the SRH command.
+
+Message text is split into words, lowercased runs of letters, digits and underscores, and each word maps to a
+posting list: the sorted ids of the messages that contain it, as an array of 4 byte ints. Each username maps to a
+posting list of its messages too, so filtering by user is one more list to intersect. Message ids never change, so
+posting lists stay valid when messages are deleted or renumbered. They only change for the messages being posted,
+edited or deleted.
+
+Posts get the newest id, so adding one appends to the end of each of its lists. A search intersects the lists of
+its words, walking the shortest newest first and looking each id up in the others with a binary search, so it costs
+about the length of the rarest word's list times log n, however common the other words are.
+
+The index is not thread safe. The message store updates and reads it under its own lock.
+'''
+
+import re
+import bisect
+from array import array
+
+wordPattern = re.compile(r'\w+')
+
+'''
+The distinct words of text, lowercased
+'''
+def splitWords(text):
+    return set(wordPattern.findall(text.lower()))
+
+def addPosting(postings, key, messageId):
+    posting = postings.get(key)
+
+    if posting is None:
+        postings[key] = array('I', (messageId,))
+    elif posting[-1] < messageId:
+        posting.append(messageId)
+    else:
+        bisect.insort(posting, messageId)
+
+def removePosting(postings, key, messageId):
+    posting = postings.get(key)
+    if posting is None:
+        return
+
+    index = bisect.bisect_left(posting, messageId)
+    if index < len(posting) and posting[index] == messageId:
+        del posting[index]
+
+    # Drop empty lists, so words that are no longer in any message do not pile up
+    if not posting:
+        del postings[key]
+
+def contains(posting, messageId):
+    index = bisect.bisect_left(posting, messageId)
+    return index < len(posting) and posting[index] == messageId
+
+class SearchIndex:
+    def __init__(self):
+        # Posting lists keyed by word and by username
+        self._words = {}
+        self._users = {}
+
+    def add(self, messageId, username, text):
+        self.addWords(messageId, username, splitWords(text))
+
+    '''
+    Add a message already split into words by splitWords
+    '''
+    def addWords(self, messageId, username, words):
+        for word in words:
+            addPosting(self._words, word, messageId)
+
+        addPosting(self._users, username, messageId)
+
+    def remove(self, messageId, username, text):
+        for word in splitWords(text):
+            removePosting(self._words, word, messageId)
+
+        removePosting(self._users, username, messageId)
+
+    '''
+    Move a message from the words of its old text to those of its new text
+    '''
+    def update(self, messageId, oldText, newText):
+        oldWords = splitWords(oldText)
+        newWords = splitWords(newText)
+
+        for word in oldWords - newWords:
+            removePosting(self._words, word, messageId)
+
+        for word in newWords - oldWords:
+            addPosting(self._words, word, messageId)
+
+    '''
+    Generate the ids of the messages that contain every word of query and, if username is given, were written by
+    username, newest first. Yields nothing if query has no words
+    '''
+    def matches(self, query, username=None):
+        words = splitWords(query)
+        if not words:
+            return
+
+        postings = [self._words.get(word) for word in words]
+        if username is not None:
+            postings.append(self._users.get(username))
+
+        if not all(postings):
+            return
+
+        postings.sort(key=len)
+        shortest, others = postings[0], postings[1:]
+
+        for messageId in reversed(shortest):
+            if all(contains(posting, messageId) for posting in others):
+                yield messageId
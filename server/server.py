@@ -2,19 +2,46 @@
 Server executable.
 '''
 
+import os
 import sys
+import signal
 import socket
+import _thread
 import threading
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from ServerConnection import ServerConnection
+from AsyncServerConnection import AsyncServerConnection
 import serverSettings
 import database
+import threadLock
+from messageStore import MessageStore
+from snapshotWriter import SnapshotWriter
+from roomRegistry import Room, RoomRegistry, isValidRoomName
+from sessionRegistry import SessionRegistry
+from loginRegistry import LoginRegistry
+from admissionControl import AdmissionControl, rejectedHeader
+from timerWheel import TimerWheel
+from eventHub import EventHub
+from metrics import Metrics, MetricsEndpoint
+from trafficCapture import CaptureWriter
+from ownerService import OwnerService, OwnerClient, RemoteRoomRegistry, RemoteSessionRegistry, RemoteLoginRegistry, RemoteAdmissionControl, RemoteMetrics
+from protocol.protocol import encodeFrame
 
 '''
 Initialise server settings from program args
 '''
-def initialiseServerSettings(port, allowedConsecutiveFailedPasswordAttempts):
+def initialiseServerSettings(port, allowedConsecutiveFailedPasswordAttempts, serverMode='threaded', metricsPort=0):
     serverSettings.serverPort = int(port)
 
+    if serverMode not in serverSettings.serverModes:
+        print(f'Invalid server mode: {serverMode}. Valid values are {", ".join(serverSettings.serverModes)}')
+        sys.exit()
+
+    serverSettings.serverMode = serverMode
+
     try:
         allowedConsecutiveFailedPasswordAttempts = int(allowedConsecutiveFailedPasswordAttempts)
     except:
@@ -27,10 +54,28 @@ def initialiseServerSettings(port, allowedConsecutiveFailedPasswordAttempts):
     
     serverSettings.allowedConsecutiveFailedPasswordAttempts = allowedConsecutiveFailedPasswordAttempts
 
+    try:
+        serverSettings.metricsPort = int(metricsPort)
+    except ValueError:
+        print(f'Invalid metrics port: {metricsPort}. Valid value is a port number, or 0 for no metrics endpoint')
+        sys.exit()
+
 '''
 Initialise server database
 '''
 def initialiseDatabase():
+    database.metrics = Metrics(threadLock.locks)
+
+    database.timers = TimerWheel(serverSettings.timerTickInterval)
+    database.timers.start()
+
+    database.admission = AdmissionControl(threadLock.admissionLock, serverSettings.maxConnections, serverSettings.maxConnectionsPerUser)
+
+    database.logins = LoginRegistry(
+        threadLock.loginDataLock, serverSettings.allowedConsecutiveFailedPasswordAttempts,
+        database.timers, serverSettings.loginLockoutDuration,
+    )
+
     # Extract username and password pairs and initialise login attempts to database 
     try: 
         with open('credentials.txt', 'r') as credentials:
@@ -40,77 +85,397 @@ def initialiseDatabase():
                 username = lineSplit[0]
                 password = lineSplit[1].rstrip('\n')
 
-                database.clientsLogin[username] = {
-                    'password': password,
-                    'loginAttempts': 0,
-                }
+                database.logins.addAccount(username, password)
     except:
         print('credentials.txt does not exist or is not formatted correctly, no logins will succeed')
         sys.exit()
 
-    # Truncate userlog.txt file
-    open('userlog.txt', 'w').close()
-    
-    database.nextUserlogNumber = 1
-
-    # Initialise nextMessageNumber from messagelog.txt   
+    # Admins are listed one username per line, and lines starting with '#' are comments. Without admins.txt nobody can
+    # use admin commands
     try:
-        with open('messagelog.txt', 'r') as messagelog:
-            lines = messagelog.readlines()
-            lastLine = lines[-1]
-            lastLineSplit = lastLine.split('; ')
-            database.nextMessageNumber = int(lastLineSplit[0]) + 1
-    except:
-        database.nextMessageNumber = 1
-        open('messagelog.txt', 'w').close()
+        with open('admins.txt', 'r') as admins:
+            serverSettings.adminUsers = tuple(name for name in map(str.strip, admins) if name and not name.startswith('#'))
+    except FileNotFoundError:
+        serverSettings.adminUsers = ()
 
-# List to keep track of client threads for graceful shutdown
-clientThreads = []
-clientConnectionSockets = []
+    # Active users are kept in memory. userlog.txt is an export of them, rewritten in the background
+    database.sessions = SessionRegistry(threadLock.userlogLock)
+    database.userlogExport = SnapshotWriter('userlog.txt', database.sessions.exportUserlog, serverSettings.userlogExportInterval)
+    database.sessions.onChange = database.userlogExport.markDirty
+    database.userlogExport.writeNow()
+    database.userlogExport.start()
 
+    # Push durable changes to subscribed connections
+    database.eventHub = EventHub()
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: python server.py <server_port> <allowed_consecutive_failed_password_attempts>')
+    # Open the default room, and every other room that has a directory of messages
+    database.rooms = RoomRegistry(serverSettings.defaultRoom, openRoom, serverSettings.maxRooms)
+    database.rooms.open(serverSettings.defaultRoom)
+
+    if os.path.isdir(serverSettings.roomsDirectory):
+        for name in sorted(os.listdir(serverSettings.roomsDirectory)):
+            if name != serverSettings.defaultRoom and isValidRoomName(name) and os.path.isdir(roomDirectory(name)):
+                database.rooms.open(name)
+
+    # Workers capture into files of their own
+    if serverSettings.captureFile and serverSettings.serverMode != 'workers':
+        database.capture = CaptureWriter(serverSettings.captureFile)
+        print(f'Capturing client traffic to {serverSettings.captureFile}')
+
+'''
+Serve the metrics of every server process on the metrics port, if there is one
+'''
+def startMetricsEndpoint():
+    if not serverSettings.metricsPort:
+        return
+
+    try:
+        endpoint = MetricsEndpoint(database.metrics, serverSettings.metricsPort)
+    except OSError:
+        print(f'Metrics port {serverSettings.metricsPort} is already in use')
         sys.exit()
 
-    initialiseServerSettings(sys.argv[1], sys.argv[2])
-    initialiseDatabase()
+    endpoint.start()
+
+    print(f'Serving metrics at http://localhost:{serverSettings.metricsPort}/metrics')
+
+'''
+Directory a room keeps its message files in. The default room keeps them in the server directory, as before rooms
+'''
+def roomDirectory(name):
+    if name == serverSettings.defaultRoom:
+        return ''
+
+    return os.path.join(serverSettings.roomsDirectory, name)
+
+'''
+Open a room, loading its messages from its last snapshot and the journal after it. The default room imports an
+existing messagelog.txt on first start. Called by database.rooms
+'''
+def openRoom(name):
+    directory = roomDirectory(name)
+
+    if name == serverSettings.defaultRoom:
+        lock = threadLock.messagelogLock
+        legacyMessagelogPath = 'messagelog.txt'
+    else:
+        os.makedirs(directory, exist_ok=True)
+        lock = threadLock.roomMessagelogLock(name)
+        legacyMessagelogPath = None
+        database.metrics.addLocks(lock, lock.shared)
+
+    store = MessageStore(
+        os.path.join(directory, 'messagejournal.txt'), lock, serverSettings.journalDurability,
+        serverSettings.journalFsyncInterval, serverSettings.syncHistory
+    )
+    replayed = store.load(legacyMessagelogPath=legacyMessagelogPath, snapshotPath=os.path.join(directory, 'messagesnapshot.bin'))
+    store.onJournalWrite = database.metrics.observeJournalWrite
+
+    print(f'Loaded {store.count()} messages in room {name}, replayed {replayed} journal events.')
+
+    # The SRH search index is rebuilt from the loaded messages in the background, so a long history does not hold up
+    # startup. Searches are turned away until it has caught up
+    store.startSearchIndex()
+
+    # messagelog.txt is kept as an export of the message store, and messagesnapshot.bin as a snapshot for the next
+    # startup, both rewritten in the background. Neither is written before the server starts, which would make
+    # startup as slow as the history is long
+    room = Room(
+        name, store,
+        SnapshotWriter(os.path.join(directory, 'messagelog.txt'), store.exportMessagelog, serverSettings.messagelogExportInterval),
+        SnapshotWriter(os.path.join(directory, 'messagesnapshot.bin'), store.renderSnapshot, serverSettings.messageSnapshotInterval),
+    )
+    store.onChange = room.markChanged
+    store.onCommit = functools.partial(database.eventHub.publish, room=name)
+
+    room.messagelogExport.markDirty()
+    room.messagelogExport.start()
+
+    if replayed:
+        room.messageSnapshot.markDirty()
+    room.messageSnapshot.start()
 
-    # Open server TCP socket
+    return room
+
+'''
+Flush in-memory state to disk on shutdown
+'''
+def shutdownDatabase():
+    database.timers.stop()
+    database.userlogExport.stop()
+    database.rooms.closeAll()
+
+    if database.capture:
+        database.capture.close()
+
+'''
+Open the server TCP socket. With reusePort, other processes can listen on the same port and the kernel spreads new
+connections between them
+'''
+def openServerSocket(reusePort=False):
     serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    if reusePort:
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
     try:
         serverSocket.bind(('localhost', serverSettings.serverPort))
     except:
         print(f'Port {serverSettings.serverPort} is already in use')
         sys.exit()
 
-    serverSocket.listen()
+    serverSocket.listen(serverSettings.listenBacklog)
+
+    return serverSocket
+
+'''
+Accept connections and handle each on its own thread, until interrupted
+'''
+def acceptConnections(serverSocket):
+    while True:
+        clientConnectionSocket, clientAddr = serverSocket.accept()
+
+        if not database.admission.admit():
+            rejectConnection(clientConnectionSocket, clientAddr)
+            continue
+
+        # Forget connections whose threads have finished
+        pruneClientThreads()
+
+        # Start a new thread for each client connection.
+        clientConnection = ServerConnection(clientConnectionSocket, clientAddr[0], clientAddr[1])
+
+        clientThread = threading.Thread(
+            name='ClientConnectionThread',
+            target=clientConnection.main
+        )
+        clientThreads.append(clientThread)
+        clientConnectionSockets.append(clientConnectionSocket)
+        clientThread.start()
+
+'''
+Frame telling a connection that the server is full
+'''
+def serverFullFrame():
+    return encodeFrame('The server is full. Please try again later.', {rejectedHeader: 'server'})
+
+'''
+Tell a connection past the connection limit that the server is full, and close it. The frame fits in the empty send
+buffer of the new socket, so sending it never holds up accepting. The socket is only closed for writing at first:
+closing it outright would make the kernel answer the client's login with a reset, which can reach the client before
+it has read the rejection
+'''
+def rejectConnection(clientConnectionSocket, clientAddr):
+    clientConnectionSocket.setblocking(False)
+
+    try:
+        clientConnectionSocket.send(serverFullFrame())
+        clientConnectionSocket.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+    database.timers.schedule(serverSettings.rejectionLinger, clientConnectionSocket.close)
+
+    print(f'{clientAddr[0]}:{clientAddr[1]} was rejected, the server is at its limit of {serverSettings.maxConnections} connections.')
+
+'''
+Close the server socket and shut down every client connection socket
+'''
+def closeConnections(serverSocket):
+    for clientConnectionSocket in clientConnectionSockets:
+        # Shutting down wakes up threads blocked sending to a client that stopped reading, which close alone does not.
+        # Each thread then closes its own socket, so none is left using a closed one
+        try:
+            clientConnectionSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    serverSocket.close()
+
+'''
+Run the thread-per-connection server
+'''
+def runThreadedServer():
+    serverSocket = openServerSocket()
 
     print(f'Server started. Now listening on port {serverSettings.serverPort}...')
 
     try:
-        while True:
-            clientConnectionSocket, clientAddr = serverSocket.accept()
-
-            # Start a new thread for each client connection.
-            clientConnection = ServerConnection(clientConnectionSocket, clientAddr[0], clientAddr[1])
-            clientConnectionSockets.append(clientConnectionSocket)
-
-            clientThread = threading.Thread(
-                name='ClientConnectionThread',
-                target=clientConnection.main
-            )
-            clientThreads.append(clientThread)
-            clientThread.start()
+        acceptConnections(serverSocket)
     except KeyboardInterrupt:
         # Handle graceful shutdown on Ctrl+C or other termination signals
         print("Server is shutting down gracefully...")
-        # Close all client connection sockets
-        for clientConnectionSocket in clientConnectionSockets:
-            clientConnectionSocket.close()
-        serverSocket.close()
+        closeConnections(serverSocket)
+        shutdownDatabase()
         print("Server has shut down.")
 
+'''
+Drop finished client threads and their sockets from the shutdown lists
+'''
+def pruneClientThreads():
+    global clientThreads, clientConnectionSockets
+
+    alive = [(thread, sock) for thread, sock in zip(clientThreads, clientConnectionSockets) if thread.is_alive()]
+
+    clientThreads = [thread for thread, _ in alive]
+    clientConnectionSockets = [sock for _, sock in alive]
+
+'''
+Run the asyncio event loop server. Every connection is a coroutine and blocking file I/O is handed to a
+bounded worker pool
+'''
+async def runAsyncServer():
+    executor = ThreadPoolExecutor(max_workers=serverSettings.asyncWorkerThreads, thread_name_prefix='FileIOWorker')
+
+    async def handleClient(reader, writer):
+        if not database.admission.admit():
+            clientAddr = writer.get_extra_info('peername')
+            writer.write(serverFullFrame())
+            writer.write_eof()
+
+            # Read until the client closes, so its login does not arrive at a closed socket, see rejectConnection
+            try:
+                await asyncio.wait_for(reader.read(), serverSettings.rejectionLinger)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+
+            writer.close()
+            print(f'{clientAddr[0]}:{clientAddr[1]} was rejected, the server is at its limit of {serverSettings.maxConnections} connections.')
+            return
+
+        try:
+            await AsyncServerConnection(reader, writer, executor).main()
+        except asyncio.CancelledError:
+            # The server is shutting down and the connection has cleaned up after itself. Ending the task normally
+            # keeps asyncio from logging the cancellation as an error
+            pass
+
+    try:
+        server = await asyncio.start_server(handleClient, 'localhost', serverSettings.serverPort, backlog=serverSettings.listenBacklog)
+    except OSError:
+        print(f'Port {serverSettings.serverPort} is already in use')
+        sys.exit()
+
+    print(f'Server started in async mode. Now listening on port {serverSettings.serverPort}...')
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+'''
+Run the multi-process server. This process owns the shared state and serves it to worker processes, which accept
+connections on the server port with SO_REUSEPORT and handle them like the threaded server
+'''
+def runWorkersServer():
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print('workers mode needs SO_REUSEPORT, which is not supported on this platform')
+        shutdownDatabase()
+        sys.exit()
+
+    service = OwnerService(
+        database.rooms, database.sessions, database.logins, database.admission, database.metrics, database.eventHub,
+        serverSettings.ownerCallThreads, serverSettings.workerEventQueueSize,
+    )
+    service.start()
 
+    # Workers are spawned rather than forked, since this process already runs threads
+    settings = {name: value for name, value in vars(serverSettings).items() if isinstance(value, (int, float, str, tuple))}
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(name=f'Worker-{index}', target=runWorker, args=(service.address, service.authkey, settings))
+        for index in range(serverSettings.workerProcesses)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    print(f'Server started with {len(workers)} worker processes. Now listening on port {serverSettings.serverPort}...')
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("Server is shutting down gracefully...")
+
+        # Workers started from a terminal get Ctrl+C too, but not when only this process is signalled
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+        for worker in workers:
+            worker.join()
+
+    service.stop()
+    shutdownDatabase()
+    print("Server has shut down.")
+
+'''
+Run a worker process of the multi-process server, using the owner's state through an OwnerClient
+'''
+def runWorker(ownerAddress, authkey, settings):
+    for name, value in settings.items():
+        setattr(serverSettings, name, value)
+
+    # Live events from the owner are published to this worker's subscribers
+    database.eventHub = EventHub()
+
+    # Connection deadlines run on this worker's own timer wheel. Lockouts run on the owner's
+    database.timers = TimerWheel(serverSettings.timerTickInterval)
+    database.timers.start()
+
+    ownerClient = OwnerClient(ownerAddress, authkey, database.eventHub)
+    ownerClient.onClosed = _thread.interrupt_main
+    ownerClient.start()
+
+    database.rooms = RemoteRoomRegistry(ownerClient)
+    database.sessions = RemoteSessionRegistry(ownerClient)
+    database.logins = RemoteLoginRegistry(ownerClient)
+    database.admission = RemoteAdmissionControl(ownerClient)
+
+    # Commands are timed in this worker and reported to the owner, which serves the metrics of every process. The
+    # shared locks are only taken in the owner, so the worker has none to report
+    database.metrics = RemoteMetrics(ownerClient, (), serverSettings.metricsReportInterval)
+    database.metrics.start()
+
+    if serverSettings.captureFile:
+        database.capture = CaptureWriter(f'{serverSettings.captureFile}.{os.getpid()}')
+
+    serverSocket = openServerSocket(reusePort=True)
+
+    try:
+        acceptConnections(serverSocket)
+    except KeyboardInterrupt:
+        # Shut down once, even if Ctrl+C reaches this process both from the terminal and from the owner
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        closeConnections(serverSocket)
+        database.timers.stop()
+        database.metrics.stop()
+        ownerClient.close()
+
+        if database.capture:
+            database.capture.close()
+
+# List to keep track of client threads for graceful shutdown
+clientThreads = []
+clientConnectionSockets = []
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4, 5):
+        print('Usage: python server.py <server_port> <allowed_consecutive_failed_password_attempts> [threaded|async|workers] [metrics_port]')
+        sys.exit()
+
+    initialiseServerSettings(*sys.argv[1:])
+    initialiseDatabase()
+    startMetricsEndpoint()
 
+    if serverSettings.serverMode == 'async':
+        try:
+            asyncio.run(runAsyncServer())
+        except KeyboardInterrupt:
+            shutdownDatabase()
+            print("Server has shut down.")
+    elif serverSettings.serverMode == 'workers':
+        runWorkersServer()
+    else:
+        runThreadedServer()
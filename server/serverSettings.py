@@ -3,3 +3,107 @@
 serverPort = 0
 allowedConsecutiveFailedPasswordAttempts = 0
 
+
+# 'threaded' spawns a thread per connection, 'async' runs every connection on one event loop, 'workers' runs
+# threaded worker processes that share the port and the state of this process
+serverModes = ('threaded', 'async', 'workers')
+serverMode = 'threaded'
+
+# Number of worker processes in workers mode, the number of calls from workers the owner process handles at once,
+# and the number of live events queued for a worker that falls behind
+workerProcesses = 4
+ownerCallThreads = 64
+workerEventQueueSize = 4096
+
+# Size of the worker pool used for blocking file I/O in async mode, and the most of its threads one connection's
+# requests may use at once, so pipelined requests from one client cannot take the whole pool
+asyncWorkerThreads = 8
+asyncWorkerThreadsPerConnection = 2
+
+# Maximum number of pipelined requests (requests with a Request-Id) handled at once per connection in async mode
+maxPipelinedRequests = 32
+
+# Minimum number of seconds between rewrites of the messagelog.txt and userlog.txt exports. messagelog.txt is a full
+# rewrite of every message, so it is kept infrequent. Both are also written on shutdown
+messagelogExportInterval = 30.0
+userlogExportInterval = 1.0
+
+# Minimum number of seconds between snapshots of the message store. Startup replays the journal written since the
+# last snapshot, so this bounds how much it replays after a crash. A clean shutdown always takes a snapshot
+messageSnapshotInterval = 60.0
+
+# How durable a change must be before it is acknowledged: 'fsync' after every batch of changes, 'periodic' fsync
+# at most every journalFsyncInterval seconds, or 'buffered' to leave it to the OS
+journalDurability = 'fsync'
+journalFsyncInterval = 1.0
+
+# Maximum number of live events queued for a subscriber, and what to do when a subscriber falls that far behind:
+# 'drop' new events or 'disconnect' the subscriber
+subscriberQueueSize = 256
+subscriberOverflowPolicy = 'drop'
+
+# Maximum number of commands in one BATCH request
+maxBatchSize = 1000
+
+# Maximum page size of a paged RDM, and the number of messages in each frame of an RDS stream
+maxRdmPageSize = 1000
+rdsPageSize = 100
+
+# Minimum number of the latest message changes kept for SYN, and the number of changes in each frame of a SYN
+# response. A client that last synced further back than the changes kept gets every message again
+syncHistory = 10000
+syncPageSize = 500
+
+# Maximum number of messages listed by a SRH search, the latest matches first
+maxSearchResults = 100
+
+# Room every connection starts in, whose messages are kept in the server directory, the directory other rooms keep
+# their messages in, and the maximum number of rooms, counting the default room
+defaultRoom = 'general'
+roomsDirectory = 'rooms'
+maxRooms = 100
+
+# Seconds per tick of the timer wheel, which is how late a timer may fire
+timerTickInterval = 0.1
+
+# Seconds an account stays locked out after running out of login attempts
+loginLockoutDuration = 10.0
+
+# Seconds a new connection has to log in before it is dropped, and seconds a logged in connection may go without
+# sending a request before it is dropped, unless it has subscribed to live events. 0 turns a timeout off
+loginTimeout = 60.0
+idleConnectionTimeout = 1800.0
+
+
+# Number of connections the kernel queues for the server to accept
+listenBacklog = 128
+
+# Maximum number of open client connections, and of connections logged in as the same user. Connections past either
+# limit are sent a rejection and closed. In workers mode the limits apply across every worker. 0 means no limit
+maxConnections = 1000
+maxConnectionsPerUser = 8
+# Seconds a rejected connection is held half closed while the client reads the rejection
+rejectionLinger = 1.0
+
+# Bytes of unsent output held for a connection before sending to it waits, and seconds a send may wait for the client
+# to read before the connection is dropped. 0 waits forever
+outputBufferSize = 256 * 1024
+writeTimeout = 30.0
+
+# Largest frame body or request, in bytes, accepted from a connection before and after it logs in. A connection that
+# declares a bigger one is dropped before any of it is buffered
+maxLoginFrameSize = 4 * 1024
+maxRequestSize = 16 * 1024 * 1024
+
+
+# Users allowed to issue admin commands such as STATS, read from admins.txt at startup
+adminUsers = ()
+
+# Port of the Prometheus metrics endpoint on localhost, set from the command line. 0 serves no endpoint
+metricsPort = 0
+# Seconds between a worker's reports of its metrics to the owner process in workers mode
+metricsReportInterval = 1.0
+
+# File to capture every frame clients send into, for replaying with benchmark/replayCapture.py. '' captures nothing.
+# In workers mode each worker writes to this path with its process id appended
+captureFile = ''
@@ -0,0 +1,80 @@
+'''
+In-memory registry of logged in users, with a session per connection, so a user logged in on several connections is
+listed once for each and stays active until the last one logs out.
+ATU responses are built once and cached until the next login or logout. userlog.txt is an export of the
+registry written in the background, so logins and logouts never wait on a file rewrite.
+'''
+
+class Session:
+    __slots__ = ('username', 'loginTime', 'addrName', 'udpPort')
+
+    def __init__(self, username, loginTime, addrName, udpPort):
+        self.username = username
+        self.loginTime = loginTime
+        self.addrName = addrName
+        self.udpPort = udpPort
+
+class SessionRegistry:
+    '''
+    lock guards every read and write of the registry
+    '''
+    def __init__(self, lock):
+        self.lock = lock
+        # Active sessions in login order. Sessions compare by identity, so this works as an ordered set
+        self._sessions = {}
+        # Cached ATU responses keyed by the username of the user asking
+        self._atuCache = {}
+        # Called with no arguments after every login and logout, e.g. to schedule a userlog.txt export
+        self.onChange = None
+
+    def login(self, session):
+        with self.lock:
+            self._sessions[session] = None
+            self._atuCache.clear()
+
+        self._changed()
+
+    '''
+    Remove a session. Does nothing if it has already been removed
+    '''
+    def logout(self, session):
+        with self.lock:
+            if session not in self._sessions:
+                return
+
+            del self._sessions[session]
+            self._atuCache.clear()
+
+        self._changed()
+
+    '''
+    Active user list for username, which excludes username itself. Empty if there are no other active users
+    '''
+    def atuResponse(self, username):
+        with self.lock:
+            response = self._atuCache.get(username)
+
+            if response is None:
+                response = ''.join(
+                    f'{session.username}, {session.addrName}, {session.udpPort}, active since {session.loginTime}\n'
+                    for session in self._sessions if session.username != username
+                )
+                self._atuCache[username] = response
+
+        return response
+
+    '''
+    Render the registry in the userlog.txt format
+    '''
+    def exportUserlog(self):
+        with self.lock:
+            sessions = list(self._sessions)
+
+        return ''.join(
+            f'{userlogNumber}; {session.loginTime}; {session.username}; {session.addrName}; {session.udpPort}\n'
+            for userlogNumber, session in enumerate(sessions, 1)
+        )
+
+    def _changed(self):
+        if self.onChange:
+            self.onChange()
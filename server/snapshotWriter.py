@@ -0,0 +1,69 @@
+'''
+Background writer that keeps a file in sync with in-memory server state.
+Changes only mark the snapshot as dirty, and a single thread rewrites the file at most once per interval,
+so bursts of changes are coalesced into one rewrite and never block the connection threads.
+'''
+
+import os
+import threading
+
+class SnapshotWriter:
+    '''
+    render is called with no arguments from the writer thread and must return the full file contents, as text or
+    as bytes
+    '''
+    def __init__(self, path, render, interval):
+        self.path = path
+        self._render = render
+        self._interval = interval
+        self._dirty = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(name=f'SnapshotWriter-{path}', target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    '''
+    Request a rewrite of the snapshot file
+    '''
+    def markDirty(self):
+        self._dirty.set()
+
+    '''
+    Write any pending changes and stop the writer thread
+    '''
+    def stop(self):
+        self._stopped.set()
+        self._dirty.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            self.writeNow()
+
+    '''
+    Rewrite the snapshot file from the current state, replacing it atomically
+    '''
+    def writeNow(self):
+        contents = self._render()
+
+        tmpPath = f'{self.path}.tmp'
+        with open(tmpPath, 'wb' if isinstance(contents, bytes) else 'w') as snapshot:
+            snapshot.write(contents)
+        os.replace(tmpPath, self.path)
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+
+            # A failed rewrite leaves the previous file in place, and the next change tries again
+            try:
+                self.writeNow()
+            except Exception as error:
+                print(f'{self.path} could not be written ({error!r})')
+
+            if self._stopped.is_set():
+                return
+
+            # Coalesce further changes during the interval into the next rewrite. Stopping cuts the wait short
+            self._stopped.wait(self._interval)
@@ -1,9 +1,21 @@
 '''
-Thread lock objects
+Thread lock objects. Each one records how long it is waited for and held, see metrics.InstrumentedLock
 '''
 
-import threading
+from metrics import InstrumentedLock, InstrumentedReadWriteLock
 
-loginDataLock = threading.Lock()
-userlogLock = threading.Lock()
-messagelogLock = threading.Lock()
+loginDataLock = InstrumentedLock('loginData')
+userlogLock = InstrumentedLock('userlog')
+# A reader-writer lock, so reads of the messages run alongside each other. Readers take messagelogLock.shared
+messagelogLock = InstrumentedReadWriteLock('messagelog')
+admissionLock = InstrumentedLock('admission')
+
+# Every lock above, for metrics
+locks = (loginDataLock, userlogLock, messagelogLock, messagelogLock.shared, admissionLock)
+
+'''
+A reader-writer lock for the messages of a room other than the default room, which uses messagelogLock. Each room
+has its own, so rooms never wait on each other
+'''
+def roomMessagelogLock(room):
+    return InstrumentedReadWriteLock(f'messagelog.{room}')
@@ -0,0 +1,123 @@
+'''
+Hashed timer wheel running every timer of the server on one thread.
+
+Time is cut into ticks of tickInterval seconds, and the wheel has a ring of slots, one per tick. A timer due in n
+ticks goes in the slot n ticks ahead of the current one, along with how many full turns of the wheel it has to wait
+first. Every tick the wheel moves to the next slot and fires the timers there whose turns are up. Scheduling and
+cancelling a timer are O(1) and every timer is one small object, so thousands of lockouts and connection deadlines
+cost no more threads than one. Timers fire up to one tick late.
+
+Callbacks run on the wheel's thread, so they must be quick and must not block.
+'''
+
+import math
+import time
+import threading
+
+class Timer:
+    __slots__ = ('callback', 'args', 'slot', 'rounds')
+
+    def __init__(self, callback, args, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        # Full turns of the wheel left before the timer is due
+        self.rounds = rounds
+
+class TimerWheel:
+    def __init__(self, tickInterval=0.1, slotCount=512):
+        self.tickInterval = tickInterval
+        self._slots = [set() for _ in range(slotCount)]
+        self._tick = 0
+        self._count = 0
+        self._stopping = False
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(name='TimerWheel', target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+    '''
+    Call callback(*args) on the wheel's thread in delay seconds. Returns a Timer that can be cancelled
+    '''
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, math.ceil(delay / self.tickInterval))
+
+        with self._condition:
+            slot = (self._tick + ticks) % len(self._slots)
+            timer = Timer(callback, args, slot, (ticks - 1) // len(self._slots))
+            self._slots[slot].add(timer)
+            self._count += 1
+
+            # The wheel sleeps while it has no timers
+            if self._count == 1:
+                self._condition.notify()
+
+        return timer
+
+    '''
+    Cancel a timer. Does nothing if it has already fired or been cancelled
+    '''
+    def cancel(self, timer):
+        with self._condition:
+            bucket = self._slots[timer.slot]
+
+            if timer in bucket:
+                bucket.remove(timer)
+                self._count -= 1
+
+    def _run(self):
+        nextTick = time.monotonic() + self.tickInterval
+
+        while True:
+            with self._condition:
+                if not self._count and not self._stopping:
+                    while not self._count and not self._stopping:
+                        self._condition.wait()
+                    nextTick = time.monotonic() + self.tickInterval
+
+                if self._stopping:
+                    return
+
+                remaining = nextTick - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                nextTick += self.tickInterval
+                due = self._advance()
+
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as error:
+                    print(f'Timer callback {timer.callback.__qualname__} failed: {error!r}')
+
+    '''
+    Move to the next slot. Returns the timers that are due, having removed them from the wheel
+    '''
+    def _advance(self):
+        self._tick += 1
+        bucket = self._slots[self._tick % len(self._slots)]
+        due = []
+
+        for timer in bucket:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+
+        for timer in due:
+            bucket.remove(timer)
+
+        self._count -= len(due)
+
+        return due
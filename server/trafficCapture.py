@@ -0,0 +1,132 @@
+'''
+Capture of the traffic clients send to the server, for replaying real workloads with benchmark/replayCapture.py.
+
+A capture file starts with captureMagic and the wall clock time the capture started, as a big-endian double. Then
+come records, each a big-endian double of seconds since the capture started, a 4 byte connection id, a 1 byte record
+kind, a 4 byte payload length and the payload:
+- OPEN: a connection was accepted. The payload is its 'address:port'
+- FRAME: a frame was received, exactly as it arrived. Frames are numbered from 0 in each connection
+- REPLY: the server finished handling the request or login in a frame. The payload is the frame number as a 4 byte
+  unsigned int
+- CLOSE: the connection closed
+
+Frames are captured as sent, so a capture holds the passwords of every login. In workers mode each worker process
+writes its own capture file.
+'''
+
+import time
+import struct
+import itertools
+import threading
+
+captureMagic = b'TOOMCAP1'
+captureStartStruct = struct.Struct('!d')
+recordHeaderStruct = struct.Struct('!dIBI')
+frameNumberStruct = struct.Struct('!I')
+
+# Record kinds
+OPEN = 1
+FRAME = 2
+REPLY = 3
+CLOSE = 4
+
+# Bytes of records buffered before they are written to the capture file
+captureBufferSize = 256 * 1024
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb', buffering=captureBufferSize)
+        self._startedAt = time.monotonic()
+        self._connectionIds = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self._file.write(captureMagic + captureStartStruct.pack(time.time()))
+
+    '''
+    Record a new connection. Returns the id to record its frames under
+    '''
+    def openConnection(self, address):
+        connectionId = next(self._connectionIds)
+        self.record(connectionId, OPEN, address.encode('utf-8'))
+
+        return connectionId
+
+    def record(self, connectionId, kind, payload=b''):
+        header = recordHeaderStruct.pack(time.monotonic() - self._startedAt, connectionId, kind, len(payload))
+
+        with self._lock:
+            if self._file.closed:
+                return
+
+            self._file.write(header)
+            self._file.write(payload)
+
+    def recordFrame(self, connectionId, frame):
+        self.record(connectionId, FRAME, bytes(frame))
+
+    def recordReply(self, connectionId, frameNumber):
+        self.record(connectionId, REPLY, frameNumberStruct.pack(frameNumber))
+
+    def closeConnection(self, connectionId):
+        self.record(connectionId, CLOSE)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class CapturedConnection:
+    __slots__ = ('connectionId', 'address', 'openedAt', 'closedAt', 'frames', 'replies')
+
+    def __init__(self, connectionId, address, openedAt):
+        self.connectionId = connectionId
+        self.address = address
+        # Seconds since the capture started
+        self.openedAt = openedAt
+        self.closedAt = None
+        # (seconds since the capture started, frame) of each frame, in the order they arrived
+        self.frames = []
+        # Seconds since the capture started that each frame's reply was finished, keyed by frame number
+        self.replies = {}
+
+'''
+Read a capture file. Returns the wall clock time the capture started and its connections in the order they opened.
+A capture cut short by a crash is read up to its last whole record
+'''
+def readCapture(path):
+    with open(path, 'rb') as captureFile:
+        data = captureFile.read()
+
+    if not data.startswith(captureMagic):
+        raise ValueError(f'{path} is not a capture file')
+
+    startedAt, = captureStartStruct.unpack_from(data, len(captureMagic))
+    offset = len(captureMagic) + captureStartStruct.size
+    connections = {}
+
+    while offset + recordHeaderStruct.size <= len(data):
+        at, connectionId, kind, payloadLength = recordHeaderStruct.unpack_from(data, offset)
+        payloadStart = offset + recordHeaderStruct.size
+        offset = payloadStart + payloadLength
+
+        if offset > len(data):
+            break
+
+        payload = data[payloadStart:offset]
+
+        if kind == OPEN:
+            connections[connectionId] = CapturedConnection(connectionId, payload.decode('utf-8'), at)
+            continue
+
+        connection = connections.get(connectionId)
+        if connection is None:
+            continue
+
+        if kind == FRAME:
+            connection.frames.append((at, payload))
+        elif kind == REPLY:
+            connection.replies[frameNumberStruct.unpack(payload)[0]] = at
+        elif kind == CLOSE:
+            connection.closedAt = at
+
+    return startedAt, list(connections.values())